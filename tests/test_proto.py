@@ -0,0 +1,55 @@
+import asyncio
+import socket
+import struct
+
+import pytest
+
+from usbip_toolkit.proto import (
+    URB_MAX_BYTES,
+    USBIPClientFramer,
+    USBIPClientPacketType,
+    read_usbip_client_packet_async,
+)
+from usbip_toolkit.proto_struct import StructCodec, build_cmd_submit
+
+
+def cmd_submit_hdr(direction, transfer_buffer_length):
+    # just the fixed part, however much payload transfer_buffer_length promises
+    buf = bytearray(build_cmd_submit(1, 47, 6, 1, 1, 0))
+    struct.pack_into(">I", buf, 12, direction)
+    struct.pack_into(">i", buf, 24, transfer_buffer_length)
+    return bytes(buf)
+
+
+def read_framer(data):
+    a, b = socket.socketpair()
+    with a, b:
+        a.sendall(data)
+        a.shutdown(socket.SHUT_WR)
+        return USBIPClientFramer(b, StructCodec).read_packet()
+
+
+def read_async(data):
+    async def read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await read_usbip_client_packet_async(reader, StructCodec)
+
+    return asyncio.run(read())
+
+
+@pytest.mark.parametrize("read", [read_framer, read_async])
+@pytest.mark.parametrize("direction", [0, 1])
+@pytest.mark.parametrize("length", [URB_MAX_BYTES + 1, 0x7FFFFFFF])
+def test_oversized_urb_rejected(read, direction, length):
+    # before anything is allocated for the payload
+    with pytest.raises(ValueError):
+        read(cmd_submit_hdr(direction, length))
+
+
+@pytest.mark.parametrize("read", [read_framer, read_async])
+def test_largest_urb_read(read):
+    cmsg, cmsg_ty = read(cmd_submit_hdr(1, URB_MAX_BYTES))
+    assert cmsg_ty == USBIPClientPacketType.USBIPCommandRequest
+    assert cmsg.body.transfer_buffer_length == URB_MAX_BYTES
@@ -0,0 +1,174 @@
+import errno
+import socket
+import time
+from itertools import count
+from threading import Event, Thread
+
+import pytest
+
+from usbip_toolkit.client import USBIPClient
+from usbip_toolkit.device import (
+    SinkEndpoint,
+    USBDevice,
+    config_descriptor,
+    device_descriptor,
+    interface_descriptor,
+    langid_descriptor,
+    reference_endpoints,
+    serve_sim_link,
+)
+from usbip_toolkit.proto_struct import RET_SUBMIT
+from usbip_toolkit.sim_bridge import USBIPSimBridgeServer
+from usbip_toolkit.sim_bridge_classic import USBIPSimBridgeServer_classic
+from usbip_toolkit.transport import connect_endpoint, parse_endpoint
+from usbip_toolkit.urb_engine import RetryPolicy
+from usbip_toolkit.usb import DescType
+
+_names = count()
+
+
+class Sim:
+    # the reference device on a sim link, until stop() hangs up on the bridge
+    def __init__(self, endpoint, **device_kwargs):
+        self.sink = SinkEndpoint(0x02, keep=True)
+        self.dev = USBDevice(
+            [e for e in reference_endpoints() if e.addr != 0x02] + [self.sink], **device_kwargs
+        )
+        # set by every packet from the bridge
+        self.polled = Event()
+        handle_packet = self.dev.handle_packet
+
+        def handle(buf):
+            self.polled.set()
+            return handle_packet(buf)
+
+        self.dev.handle_packet = handle
+        self.sock = connect_endpoint(parse_endpoint(endpoint), 5.0)
+        self.thread = Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        try:
+            serve_sim_link(self.dev, self.sock)
+        except OSError:
+            # hung up on while answering
+            pass
+
+    def submit_polled(self, client, *args):
+        # -> the seqnum of a URB the bridge has got as far as the simulator
+        self.polled.clear()
+        seqnum = client.submit(*args)
+        assert self.polled.wait(5.0)
+        return seqnum
+
+    def stop(self):
+        self.sock.shutdown(socket.SHUT_RDWR)
+        self.thread.join()
+        self.sock.close()
+
+
+def import_when_ready(endpoint, busid, timeout=5.0):
+    # -> a client with busid imported. The bridge listens only once its serve thread runs, and
+    # sees a client close its connection only some time after it has.
+    deadline = time.monotonic() + timeout
+    while True:
+        client = None
+        try:
+            client = USBIPClient(endpoint=endpoint, timeout=timeout)
+            client.import_device(busid)
+            return client
+        except (ConnectionRefusedError, ValueError):
+            if client is not None:
+                client.close()
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+
+
+def wait_for(pred, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not pred():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.mark.parametrize("bridge_cls", [USBIPSimBridgeServer, USBIPSimBridgeServer_classic])
+def test_sim_restart(bridge_cls):
+    n = next(_names)
+    usbip_endpoint = f"pair:test-restart-usbip-{n}"
+    sim_endpoint = f"pair:test-restart-sim-{n}"
+    br = bridge_cls(
+        usbip_endpoint=usbip_endpoint,
+        sim_endpoint=sim_endpoint,
+        retry=RetryPolicy(backoff_max=1e-4),
+    )
+    Thread(target=br.serve, daemon=True).start()
+    sim = Sim(sim_endpoint)
+    data = bytes(range(256)) * 8
+
+    with import_when_ready(usbip_endpoint, "47-6.0") as client:
+        # EP1 IN NAKs until EP1 OUT loops something back
+        seqnum = sim.submit_polled(client, 1, 1, 512)
+        sim.stop()
+        reply = client.read_reply()
+        assert (reply.command, reply.seqnum) == (RET_SUBMIT, seqnum)
+        assert reply.body.status == -errno.ESHUTDOWN
+
+        # a restarted simulator is taken, and its device set up from scratch
+        sim = Sim(sim_endpoint)
+        seqnum = client.submit(2, 0, len(data), data)
+        reply = client.read_reply()
+        assert (reply.seqnum, reply.body.status) == (seqnum, 0)
+        assert sim.sink.data == data
+
+        # the simulator goes away under a URB again, and the client leaves with another one
+        # waiting for the next simulator
+        seqnum = sim.submit_polled(client, 1, 1, 512)
+        sim.stop()
+        reply = client.read_reply()
+        assert (reply.seqnum, reply.body.status) == (seqnum, -errno.ESHUTDOWN)
+        client.submit(2, 0, len(data), data)
+
+    # the device is released all the same, and URBs wait for the next simulator
+    with import_when_ready(usbip_endpoint, "47-6.0") as client:
+        seqnum = client.submit(2, 0, len(data), data)
+        sim = Sim(sim_endpoint)
+        reply = client.read_reply()
+        assert (reply.seqnum, reply.body.status) == (seqnum, 0)
+    sim.stop()
+
+
+@pytest.mark.parametrize("bridge_cls", [USBIPSimBridgeServer, USBIPSimBridgeServer_classic])
+def test_sim_restart_other_device(bridge_cls):
+    # a restarted simulator may run another design, nothing the first one's descriptors said
+    # is left over once the new one is probed
+    n = next(_names)
+    usbip_endpoint = f"pair:test-restart-usbip-{n}"
+    sim_endpoint = f"pair:test-restart-sim-{n}"
+    br = bridge_cls(
+        usbip_endpoint=usbip_endpoint, sim_endpoint=sim_endpoint, probe_descriptors=True
+    )
+    Thread(target=br.serve, daemon=True).start()
+    wait_for(lambda: len(br.registry))
+    cache = next(iter(br.registry)).descriptors
+    sim = Sim(sim_endpoint, idVendor=0x1234, product="first")
+    wait_for(lambda: cache.string(2) == "first")
+    with import_when_ready(usbip_endpoint, "47-6.0") as client:
+        assert client.udev.idVendor == 0x1234
+    sim.stop()
+
+    # no strings at all this time
+    descriptors = {
+        DescType.DEVICE: device_descriptor(0x5678, 2, iManufacturer=0, iProduct=0),
+        DescType.CONFIGURATION: config_descriptor([interface_descriptor(0, reference_endpoints())]),
+        DescType.STRING: langid_descriptor(),
+    }
+    sim = Sim(sim_endpoint, descriptors=descriptors)
+    wait_for(lambda: cache.device is not None and cache.device.idVendor == 0x5678)
+    assert cache.string(1) is None and cache.string(2) is None
+    with import_when_ready(usbip_endpoint, "47-6.0") as client:
+        assert client.udev.idVendor == 0x5678
+        seqnum = client.submit(2, 0, 512, bytes(512))
+        reply = client.read_reply()
+        assert (reply.seqnum, reply.body.status) == (seqnum, 0)
+    sim.stop()
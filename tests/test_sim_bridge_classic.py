@@ -0,0 +1,133 @@
+import errno
+import socket
+import struct
+import time
+from itertools import count
+from threading import Thread
+
+import pytest
+
+from usbip_toolkit.client import USBIPClient
+from usbip_toolkit.device import USBDevice, run_sim_device
+from usbip_toolkit.proto_struct import RET_UNLINK
+from usbip_toolkit.sim_bridge_classic import USBIPSimBridgeServer_classic
+from usbip_toolkit.transport import connect_endpoint, parse_endpoint
+from usbip_toolkit.urb_engine import RetryPolicy
+
+_names = count()
+
+
+@pytest.fixture
+def bridge_client():
+    # -> (bridge, client) with the client's device imported and the reference device as the
+    # simulator, over pair: links
+    def connect(**kwargs):
+        n = next(_names)
+        sim_endpoint = f"pair:test-classic-sim-{n}"
+        br = USBIPSimBridgeServer_classic(
+            usbip_endpoint=f"pair:test-classic-usbip-{n}", sim_endpoint=sim_endpoint, **kwargs
+        )
+        br.serve(listen=False)
+        br.usbip_server.serve()
+        Thread(
+            target=run_sim_device,
+            args=(USBDevice(),),
+            kwargs=dict(endpoint=sim_endpoint),
+            daemon=True,
+        ).start()
+        client = USBIPClient(endpoint=f"pair:test-classic-usbip-{n}", timeout=5.0)
+        client.import_device("47-6.0")
+        clients.append(client)
+        return br, client
+
+    clients = []
+    yield connect
+    for client in clients:
+        client.close()
+
+
+def import_when_released(timeout=5.0, **kwargs):
+    # -> a client with 47-6.0 imported, the bridge releases a device only some time after its
+    # client went away
+    deadline = time.monotonic() + timeout
+    while True:
+        client = USBIPClient(timeout=timeout, **kwargs)
+        try:
+            client.import_device("47-6.0")
+            return client
+        except ValueError:
+            client.close()
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+
+
+@pytest.mark.parametrize(
+    "direction, ep",
+    [
+        # EP1 IN NAKs until EP1 OUT loops something back
+        (1, 1),
+        # EP1 OUT NAKs once 64 packets are looped back and nobody reads them
+        (0, 1),
+    ],
+)
+def test_unlink_parked_urbs_over_budget(bridge_client, direction, ep):
+    size = 64 * 1024
+    br, client = bridge_client(client_budget=size, retry=RetryPolicy(backoff_max=1e-4))
+    data = bytes(size) if direction == 0 else b""
+    seqnums = [client.submit(ep, direction, size, data) for _ in range(3)]
+    unlinks = {client.unlink(seqnum) for seqnum in seqnums}
+    for _ in seqnums:
+        reply = client.read_reply()
+        assert reply.command == RET_UNLINK
+        assert reply.body.status == -errno.ECONNRESET
+        unlinks.remove(reply.seqnum)
+    assert next(iter(br.registry)).backend.budget.used == 0
+
+
+def test_reset_client_releases_device():
+    n = next(_names)
+    sim_endpoint = f"pair:test-classic-sim-{n}"
+    br = USBIPSimBridgeServer_classic(usbip_endpoint="tcp://127.0.0.1:0", sim_endpoint=sim_endpoint)
+    br.serve(listen=False)
+    br.usbip_server.serve()
+    port = br.usbip_server.serv_sock.getsockname()[1]
+    Thread(
+        target=run_sim_device,
+        args=(USBDevice(),),
+        kwargs=dict(endpoint=sim_endpoint),
+        daemon=True,
+    ).start()
+    client = USBIPClient(port=port, timeout=5.0)
+    client.import_device("47-6.0")
+    # closing with SO_LINGER 0 resets the connection
+    client.sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+    client.close()
+    import_when_released(port=port).close()
+
+
+def test_unlink_over_budget_without_sim():
+    # URBs waiting for a simulator to connect hold the budget, the client's unlinks and EOF
+    # still get read
+    n = next(_names)
+    size = 64 * 1024
+    usbip_endpoint = f"pair:test-classic-usbip-{n}"
+    sim_endpoint = f"pair:test-classic-sim-{n}"
+    br = USBIPSimBridgeServer_classic(
+        usbip_endpoint=usbip_endpoint, sim_endpoint=sim_endpoint, client_budget=size
+    )
+    br.serve(listen=False)
+    br.usbip_server.serve()
+    for _ in range(2):
+        with import_when_released(endpoint=usbip_endpoint) as client:
+            seqnums = [client.submit(2, 0, size, bytes(size)) for _ in range(3)]
+            unlinks = {client.unlink(seqnum) for seqnum in seqnums}
+            for _ in seqnums:
+                reply = client.read_reply()
+                assert reply.command == RET_UNLINK
+                assert reply.body.status == -errno.ECONNRESET
+                unlinks.remove(reply.seqnum)
+            # leaves with a URB still waiting
+            client.submit(2, 0, size, bytes(size))
+    # the bridge waits for a simulator in a thread that would keep the process alive
+    connect_endpoint(parse_endpoint(sim_endpoint)).close()
@@ -0,0 +1,99 @@
+import errno
+from collections import deque
+
+import pytest
+
+from usbip_toolkit.device import SinkEndpoint, USBDevice, reference_endpoints
+from usbip_toolkit.proto_struct import StructCodec, build_cmd_submit
+from usbip_toolkit.urb_engine import RetryPolicy, URBEngine, URBScheduler, run_urb
+from usbip_toolkit.usb import stall_packet
+
+OUT_DATA = bytes(i % 251 for i in range(6 * 1024))
+
+
+class NakSink(SinkEndpoint):
+    # bulk OUT sink that NAKs whenever the next entry of pattern is False
+    def __init__(self, pattern):
+        super().__init__(0x02, keep=True)
+        self.pattern = deque(pattern)
+
+    def out_ready(self):
+        return self.pattern.popleft() if self.pattern else True
+
+
+def bulk_out(dev, eng, data):
+    q = deque()
+
+    def write(bufs):
+        for buf in bufs:
+            resp = dev.handle_packet(buf)
+            if resp is not None:
+                q.append(resp)
+
+    urb = StructCodec.parse_cmd(build_cmd_submit(1, 47, 6, 0, 2, len(data), transfer_buffer=data))
+    return StructCodec.parse_ret(run_urb(eng.submit(urb), write, q.popleft), 0)
+
+
+@pytest.mark.parametrize("window", [1, 2, 4, 8])
+@pytest.mark.parametrize("ping", [True, False])
+@pytest.mark.parametrize(
+    "pattern",
+    [
+        [False],
+        [True, False],
+        [True, True, False, False, True, False],
+        [False, True, False, True, False, True, False],
+    ],
+)
+def test_bulk_out_window_naks(window, ping, pattern):
+    sink = NakSink(pattern)
+    dev = USBDevice([e for e in reference_endpoints() if e.addr != 0x02] + [sink])
+    eng = URBEngine(StructCodec, bulk_window=window, retry=RetryPolicy(ping=ping, backoff_min=0))
+    ret = bulk_out(dev, eng, OUT_DATA)
+    assert ret.body.status == 0
+    assert sink.data == OUT_DATA
+
+
+def test_bulk_out_window_stall():
+    sink = NakSink([])
+    sink.halted = True
+    dev = USBDevice([e for e in reference_endpoints() if e.addr != 0x02] + [sink])
+    eng = URBEngine(StructCodec, bulk_window=4)
+    ret = bulk_out(dev, eng, OUT_DATA)
+    assert ret.body.status == -errno.EPIPE
+
+
+def run_sched(sched, dev, first_resp=None):
+    # -> every RET_SUBMIT, parsed, once the scheduler has nothing left to do. first_resp stands
+    # in for the device's first answer.
+    res = []
+    while sched.busy:
+        bufs, nresp, done = sched.step()
+        resps = [r for r in map(dev.handle_packet, bufs) if r is not None]
+        if first_resp is not None and resps:
+            resps[0], first_resp = first_resp, None
+        if nresp:
+            sched.responses(resps[-nresp:])
+        res += [StructCodec.parse_ret(ret) for ret in done]
+    return res
+
+
+def test_set_address_failure():
+    dev = USBDevice()
+    eng = URBEngine(StructCodec)
+    sched = URBScheduler(eng)
+    urb = build_cmd_submit(1, 47, 6, 0, 2, len(OUT_DATA), transfer_buffer=OUT_DATA)
+    sched.submit(StructCodec.parse_cmd(urb))
+    sched.submit(StructCodec.parse_cmd(build_cmd_submit(2, 47, 6, 1, 1, 512)))
+    # the URBs queued behind a SET_ADDRESS the device did not ACK fail, and the next URB
+    # sets the address again
+    rets = run_sched(sched, dev, stall_packet())
+    assert sorted((ret.seqnum, ret.body.status) for ret in rets) == [
+        (1, -errno.EPROTO),
+        (2, -errno.EPROTO),
+    ]
+    sched.submit(
+        StructCodec.parse_cmd(build_cmd_submit(3, 47, 6, 0, 2, 512, transfer_buffer=bytes(512)))
+    )
+    [ret] = run_sched(sched, dev)
+    assert (ret.seqnum, ret.body.status) == (3, 0)
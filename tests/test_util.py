@@ -0,0 +1,26 @@
+import socket
+
+import pytest
+
+from usbip_toolkit.util import get_tcp_server_socket
+
+
+@pytest.fixture
+def localhost_ipv6_first(monkeypatch):
+    # getaddrinfo as glibc answers it where /etc/hosts maps localhost to ::1 as well
+    getaddrinfo = socket.getaddrinfo
+
+    def ipv6_first(host, port, family=0, *args, **kwargs):
+        res = getaddrinfo(host, port, family, *args, **kwargs)
+        if host == "localhost" and family == socket.AF_UNSPEC:
+            res = [(socket.AF_INET6, socket.SOCK_STREAM, 6, "", ("::1", port, 0, 0))] + res
+        return res
+
+    monkeypatch.setattr(socket, "getaddrinfo", ipv6_first)
+
+
+def test_localhost_listens_on_ipv4(localhost_ipv6_first):
+    with get_tcp_server_socket(0) as serv:
+        serv.listen()
+        with socket.create_connection(("127.0.0.1", serv.getsockname()[1]), timeout=5.0):
+            pass
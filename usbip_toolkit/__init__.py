@@ -1,3 +1,12 @@
-from usbip_toolkit import proto, sim_bridge, tools, usb
+import importlib
+
+from usbip_toolkit import proto, proto_struct, usb
 
 __version__ = "0.1.0"
+
+
+def __getattr__(name):
+    # the bridges and tools are imported when first used, importing the package stays cheap
+    if name in ("sim_bridge", "tools"):
+        return importlib.import_module(f"usbip_toolkit.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
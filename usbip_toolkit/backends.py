@@ -0,0 +1,32 @@
+import importlib
+
+# Bridge backends by name. Only the one asked for is imported, so starting a bridge doesn't pay
+# for the others, and the reactive ones can be left out: their packages are optional extras.
+
+# name -> "module:class"
+BACKENDS = {
+    "asyncio": "usbip_toolkit.sim_bridge:USBIPSimBridgeServer",
+    "classic": "usbip_toolkit.sim_bridge_classic:USBIPSimBridgeServer_classic",
+    "aioreactive": "usbip_toolkit.sim_bridge_aioreactive:USBIPSimBridgeServer_aioreactive",
+    "reactivex": "usbip_toolkit.sim_bridge_rx:USBIPSimBridgeServer_rx",
+}
+# name -> the extra in setup.cfg that installs what the backend needs
+EXTRAS = {
+    "aioreactive": "aioreactive",
+    "reactivex": "rx",
+}
+
+
+def load_backend(name: str):
+    # -> the backend's bridge class, ImportError naming the extra to install if its packages
+    # are missing
+    mod_name, cls_name = BACKENDS[name].split(":")
+    try:
+        mod = importlib.import_module(mod_name)
+    except ModuleNotFoundError as e:
+        if name not in EXTRAS or e.name.startswith("usbip_toolkit"):
+            raise
+        raise ImportError(
+            f"the {name} bridge needs {e.name}, install usbip_toolkit[{EXTRAS[name]}]"
+        ) from e
+    return getattr(mod, cls_name)
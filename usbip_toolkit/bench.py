@@ -0,0 +1,389 @@
+import multiprocessing
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from threading import Thread
+
+import usbip_toolkit
+from usbip_toolkit.backends import load_backend
+from usbip_toolkit.client import USBIPClient
+from usbip_toolkit.crc import crc16_backend
+from usbip_toolkit.device import USBDevice, reference_endpoints, run_sim_device
+from usbip_toolkit.log import setup_logging
+from usbip_toolkit.proto import URB_ISO_ASAP, iso_descriptors
+from usbip_toolkit.proto_struct import get_codec
+from usbip_toolkit.usb import Dir, Recip, Type, bmRequestType_val
+
+# End-to-end benchmark of a bridge variant. The bridge runs in a process of its own so its CPU
+# time and allocations can be read without the other two parties in them, the reference
+# USBDevice runs in another on the bridge's sim port and a USBIPClient here imports the device
+# and sweeps transfer kind, direction, size and queue depth over one connection.
+
+# the backends.BACKENDS benchmarked, their classes take (usbip_port, sim_port, codec=,
+# bulk_window=, sim_endpoint=)
+BRIDGES = ("asyncio", "classic")
+# transports the device can reach the bridge over
+SIM_LINKS = ("tcp", "unix", "shm")
+
+BULK_EP = 2
+BULK_MAX_PACKET_SIZE = 512
+CONTROL_MAX_SIZE = 0xFFFF
+# one packet every microframe, so iso cases run at 8000 packets a second at most
+ISO_EP = 3
+ISO_PACKET_SIZE = 1024
+
+DEFAULT_BULK_SIZES = (0, 512, 4096, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024)
+DEFAULT_CONTROL_SIZES = (0, 64, 512, 4096)
+DEFAULT_ISO_SIZES = (8 * 1024, 64 * 1024)
+DEFAULT_DEPTHS = (1, 4, 16)
+
+
+class BenchDevice(USBDevice):
+    # vendor requests for the control sweep: BENCH_READ returns wLength bytes, BENCH_NOP is a
+    # control transfer without a data stage
+    BENCH_READ = 0x5A
+    BENCH_NOP = 0x5B
+
+    def __init__(self):
+        super().__init__(reference_endpoints(iso=True))
+        self._pattern = bytes(range(256)) * (CONTROL_MAX_SIZE // 256 + 1)
+
+    def control_in(self, bmRequestType, bRequest, wValue, wIndex, wLength):
+        if bmRequestType >> 5 & 3 == Type.VENDOR and bRequest == self.BENCH_READ:
+            return self._pattern[:wLength]
+        return super().control_in(bmRequestType, bRequest, wValue, wIndex, wLength)
+
+    def control_out(self, bmRequestType, bRequest, wValue, wIndex, data) -> bool:
+        if bmRequestType >> 5 & 3 == Type.VENDOR and bRequest == self.BENCH_NOP:
+            return True
+        return super().control_out(bmRequestType, bRequest, wValue, wIndex, data)
+
+
+def _device_main(sim_endpoint: str):
+    setup_logging("WARNING")
+    run_sim_device(BenchDevice(), endpoint=sim_endpoint)
+
+
+def _process_stats() -> dict:
+    return {
+        "cpu_s": time.process_time(),
+        "blocks": sys.getallocatedblocks(),
+        "traced_peak": tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None,
+    }
+
+
+def _stats_loop(conn):
+    while True:
+        try:
+            req = conn.recv()
+        except EOFError:
+            return
+        if req == "reset" and tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        conn.send(_process_stats())
+
+
+def _bridge_main(name, usbip_port, sim_endpoint, codec_name, bulk_window, trace_allocs, stats_conn):
+    setup_logging("WARNING")
+    if trace_allocs:
+        tracemalloc.start()
+    bridge = load_backend(name)(
+        usbip_port,
+        codec=get_codec(codec_name),
+        bulk_window=bulk_window,
+        sim_endpoint=sim_endpoint,
+    )
+    Thread(target=_stats_loop, args=(stats_conn,), name="bench_stats", daemon=True).start()
+    bridge.serve()
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def percentile(sorted_vals, pct: float):
+    if not sorted_vals:
+        return 0
+    return sorted_vals[min(len(sorted_vals) - 1, int(len(sorted_vals) * pct / 100))]
+
+
+def _control_setup(size: int) -> bytes:
+    if not size:
+        req_type = bmRequestType_val(Recip.DEVICE, Type.VENDOR, Dir.OUT)
+        return bytes([req_type, BenchDevice.BENCH_NOP]) + bytes(6)
+    req_type = bmRequestType_val(Recip.DEVICE, Type.VENDOR, Dir.IN)
+    return bytes([req_type, BenchDevice.BENCH_READ, 0, 0, 0, 0]) + size.to_bytes(2, "little")
+
+
+class BenchCase:
+    __slots__ = ("kind", "direction", "size", "depth", "count")
+
+    def __init__(self, kind: str, direction: str, size: int, depth: int, count: int):
+        self.kind = kind
+        self.direction = direction
+        self.size = size
+        self.depth = depth
+        self.count = count
+
+    def __repr__(self):
+        return f"{self.kind} {self.direction} {self.size} B x{self.count} depth {self.depth}"
+
+
+def sweep_cases(
+    kinds=("control", "bulk"),
+    directions=("in", "out"),
+    bulk_sizes=DEFAULT_BULK_SIZES,
+    control_sizes=DEFAULT_CONTROL_SIZES,
+    iso_sizes=DEFAULT_ISO_SIZES,
+    depths=DEFAULT_DEPTHS,
+    budget_bytes: int = 8 * 1024 * 1024,
+    min_urbs: int = 2,
+    max_urbs: int = 2000,
+) -> list:
+    # Each case moves about budget_bytes, within [min_urbs, max_urbs] URBs. Control transfers
+    # are device-to-host reads, size 0 a request without a data stage. Iso URBs are made of
+    # ISO_PACKET_SIZE packets.
+    cases = []
+    for kind in kinds:
+        if kind == "control":
+            plan = [("in" if size else "out", size) for size in control_sizes]
+        elif kind == "iso":
+            plan = [(d, size) for d in directions for size in iso_sizes]
+        else:
+            plan = [(d, size) for d in directions for size in bulk_sizes]
+        for direction, size in plan:
+            count = min(max_urbs, max(min_urbs, budget_bytes // max(size, 1)))
+            for depth in depths:
+                cases.append(BenchCase(kind, direction, size, depth, count))
+    return cases
+
+
+def run_case(client: USBIPClient, case: BenchCase, max_seconds: float = 0) -> dict:
+    # keeps case.depth URBs outstanding, -> per-URB latencies and totals seen by the client.
+    # With max_seconds set no new URBs are submitted after that long.
+    kwargs = {}
+    if case.kind == "control":
+        args = (0, int(case.direction == "in"), case.size, b"", _control_setup(case.size))
+    elif case.kind == "iso":
+        direction = int(case.direction == "in")
+        args = (ISO_EP, direction, case.size, bytes(case.size * (direction ^ 1)))
+        kwargs = {
+            "transfer_flags": URB_ISO_ASAP,
+            "interval": 1,
+            "iso_packet_descriptor": iso_descriptors(
+                [ISO_PACKET_SIZE] * (case.size // ISO_PACKET_SIZE)
+            ),
+        }
+    elif case.direction == "out":
+        args = (BULK_EP, 0, case.size, bytes(case.size))
+    else:
+        args = (BULK_EP, 1, case.size)
+    submitted = {}
+    latencies = []
+    nbytes = 0
+    errors = 0
+    nsent = 0
+    count = case.count
+    start = time.perf_counter_ns()
+    deadline = start + int(max_seconds * 1e9) if max_seconds else None
+    while len(latencies) < count:
+        if deadline is not None and time.perf_counter_ns() > deadline:
+            count = nsent
+            if len(latencies) == count:
+                break
+        while nsent < count and nsent - len(latencies) < case.depth:
+            t = time.perf_counter_ns()
+            submitted[client.submit(*args, **kwargs)] = t
+            nsent += 1
+        ret = client.read_reply()
+        latencies.append(time.perf_counter_ns() - submitted.pop(ret.seqnum))
+        if ret.body.status or ret.body.error_count:
+            errors += 1
+        nbytes += len(ret.body.transfer_buffer) if args[1] else case.size
+    return {
+        "elapsed_ns": time.perf_counter_ns() - start,
+        "latencies_ns": latencies,
+        "bytes": nbytes,
+        "errors": errors,
+    }
+
+
+def _connect(port: int, timeout: float = 10.0) -> USBIPClient:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return USBIPClient(port=port)
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def bench_bridge(
+    name: str,
+    cases,
+    codec: str = "struct",
+    bulk_window: int = 8,
+    trace_allocs: bool = False,
+    max_seconds: float = 0,
+    progress=None,
+    sim_link: str = "tcp",
+) -> list:
+    # sim_link is one of SIM_LINKS, how the device reaches the bridge
+    ctx = multiprocessing.get_context("spawn")
+    usbip_port = _free_port()
+    sim_path = None
+    if sim_link == "tcp":
+        sim_endpoint = f"tcp://localhost:{_free_port()}"
+    else:
+        sim_path = os.path.join(tempfile.gettempdir(), f"usbiptk-bench-{os.getpid()}.sock")
+        sim_endpoint = f"{sim_link}:{sim_path}"
+    stats, bridge_stats = ctx.Pipe()
+    bridge = ctx.Process(
+        target=_bridge_main,
+        args=(
+            name,
+            usbip_port,
+            sim_endpoint,
+            codec,
+            bulk_window,
+            trace_allocs,
+            bridge_stats,
+        ),
+        name=f"bench_{name}",
+        daemon=True,
+    )
+    device = ctx.Process(
+        target=_device_main, args=(sim_endpoint,), name="bench_device", daemon=True
+    )
+    bridge.start()
+    device.start()
+    results = []
+    try:
+        client = _connect(usbip_port)
+        busid = client.import_device("47-6.0").busid
+        # addresses the device, so the first case doesn't pay for it
+        client.submit(0, 1, 18, setup=bytes([0x80, 6, 0, 1, 0, 0, 18, 0]))
+        client.read_reply()
+        for case in cases:
+            stats.send("reset")
+            before = stats.recv()
+            cpu = time.process_time()
+            res = run_case(client, case, max_seconds)
+            cpu = time.process_time() - cpu
+            stats.send("stats")
+            after = stats.recv()
+            lats = sorted(res["latencies_ns"])
+            n = len(lats)
+            elapsed = res["elapsed_ns"] / 1e9
+            result = {
+                "bridge": name,
+                "sim_link": sim_link,
+                "busid": busid,
+                "kind": case.kind,
+                "direction": case.direction,
+                "size": case.size,
+                "depth": case.depth,
+                "urbs": n,
+                "bytes": res["bytes"],
+                "errors": res["errors"],
+                "elapsed_s": elapsed,
+                "urbs_per_sec": n / elapsed,
+                "mb_per_sec": res["bytes"] / elapsed / (1024 * 1024),
+                "latency_us": {
+                    "p50": percentile(lats, 50) / 1000,
+                    "p99": percentile(lats, 99) / 1000,
+                    "max": lats[-1] / 1000,
+                },
+                "bridge_cpu_us_per_urb": (after["cpu_s"] - before["cpu_s"]) * 1e6 / n,
+                "client_cpu_us_per_urb": cpu * 1e6 / n,
+                # net blocks left allocated, CPython keeps no count of allocations made
+                "alloc_blocks_per_urb": (after["blocks"] - before["blocks"]) / n,
+                "tracemalloc_peak_bytes": after["traced_peak"],
+            }
+            results.append(result)
+            if progress is not None:
+                progress(result)
+        client.close()
+    finally:
+        bridge.terminate()
+        device.terminate()
+        bridge.join()
+        device.join()
+        if sim_path is not None and os.path.exists(sim_path):
+            os.unlink(sim_path)
+    return results
+
+
+def _time_to_connect(cmd, port: int, timeout: float) -> float:
+    # -> seconds from starting cmd until something accepts connections on port
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                socket.create_connection(("localhost", port)).close()
+                return time.perf_counter() - t0
+            except ConnectionRefusedError:
+                if proc.poll() is not None:
+                    raise RuntimeError(f"{cmd} exited with {proc.returncode}")
+                if time.perf_counter() - t0 > timeout:
+                    raise
+                time.sleep(0.001)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def _time_run(cmd) -> float:
+    t0 = time.perf_counter()
+    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - t0
+
+
+def bench_startup(name: str, runs: int = 5, timeout: float = 30.0) -> dict:
+    # Cold starts of usbiptk-sim-bridge with backend name, each in a fresh interpreter: until
+    # its usbip port accepts a connection, what a CI test starting a bridge waits for. The
+    # bare interpreter and the CLI's --help are timed alongside to tell startup cost apart
+    # from imports.
+    cli = [sys.executable, "-m", "usbip_toolkit.tools.usbiptk_sim_bridge", "--backend", name]
+    listen, cli_help, interp = [], [], []
+    for _ in range(runs):
+        port = _free_port()
+        cmd = cli + [
+            "--usbip-listen",
+            f"tcp://localhost:{port}",
+            "--sim-listen",
+            f"tcp://localhost:{_free_port()}",
+            "--log-level",
+            "warning",
+        ]
+        listen.append(_time_to_connect(cmd, port, timeout))
+        cli_help.append(_time_run(cli + ["--help"]))
+        interp.append(_time_run([sys.executable, "-c", "pass"]))
+    res = {"bridge": name, "runs": runs}
+    for key, vals in (("listen_ms", listen), ("help_ms", cli_help), ("interpreter_ms", interp)):
+        vals = sorted(v * 1000 for v in vals)
+        res[key] = {"p50": percentile(vals, 50), "min": vals[0], "max": vals[-1]}
+    return res
+
+
+def bench_meta(codec: str, bulk_window: int) -> dict:
+    return {
+        "usbip_toolkit": usbip_toolkit.__version__,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "cpu_count": multiprocessing.cpu_count(),
+        "codec": codec,
+        "bulk_window": bulk_window,
+        "crc16": crc16_backend(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
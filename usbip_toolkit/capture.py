@@ -0,0 +1,560 @@
+import errno
+import itertools
+import os
+import queue
+import struct
+import sys
+import time
+from array import array
+from threading import Lock, Thread
+
+from usbip_toolkit.proto import (
+    ISO_ACTUAL_LENGTH,
+    ISO_FIELDS,
+    ISO_LENGTH,
+    ISO_OFFSET,
+    ISO_STATUS,
+)
+from usbip_toolkit.proto_struct import (
+    CMD_SUBMIT,
+    CMD_UNLINK,
+    RET_SUBMIT,
+    RET_UNLINK,
+    parse_cmd_common_hdr,
+    parse_command_reply,
+)
+
+# pcapng capture of both bridge links. Raw simulator packets (PID, payload and CRC as built by
+# usb.py) go out as LINKTYPE_USB_2_0, one interface per simulator. USB/IP URBs go out as usbmon
+# submit/complete records (LINKTYPE_USB_LINUX_MMAPPED), so Wireshark shows them like a capture
+# taken on the client's vhci bus. All blocks are little-endian, timestamps are nanoseconds.
+
+LINKTYPE_USB_LINUX_MMAPPED = 220
+LINKTYPE_USB_2_0 = 288
+
+_BT_SHB = 0x0A0D0D0A
+_BT_IDB = 0x00000001
+_BT_EPB = 0x00000006
+_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+_OPT_ENDOFOPT = 0
+_OPT_SHB_USERAPPL = 4
+_OPT_IF_NAME = 2
+_OPT_IF_TSRESOL = 9
+_OPT_EPB_FLAGS = 2
+
+EPB_INBOUND = 1
+EPB_OUTBOUND = 2
+
+_block_hdr = struct.Struct("<II")
+_shb_body = struct.Struct("<IHHq")
+_idb_body = struct.Struct("<HHI")
+_block_len = struct.Struct("<I")
+_opt_hdr = struct.Struct("<HH")
+_epb_hdr = struct.Struct("<IIIIIII")
+# epb_flags option, opt_endofopt, trailing block length
+_epb_flags_tail = struct.Struct("<HHIHHI")
+_EPB_MIN_LEN = _epb_hdr.size + _block_len.size
+_EPB_FLAGS_LEN = _epb_flags_tail.size - _block_len.size
+_END_OF_OPTS = _opt_hdr.pack(_OPT_ENDOFOPT, 0)
+_PAD = bytes(3)
+
+# struct usbmon_packet, 64 bytes in the mmapped flavour
+_usbmon_hdr = struct.Struct("<QBBBBHbbqiiII8siiII")
+assert _usbmon_hdr.size == 64
+# an iso record's setup field is error_count and numdesc, and its ndesc struct usbmon_isodesc
+# (status, offset, length, padding) follow the header ahead of the data
+_usbmon_iso_rec = struct.Struct("<ii")
+_USBMON_ISODESC_SIZE = 16
+
+USBMON_ISO = 0
+USBMON_INTR = 1
+USBMON_CTRL = 2
+USBMON_BULK = 3
+
+
+def _pad4(n: int) -> int:
+    return -n & 3
+
+
+def _option(code: int, val: bytes) -> bytes:
+    return _opt_hdr.pack(code, len(val)) + val + _PAD[: _pad4(len(val))]
+
+
+def _block(block_type: int, body: bytes) -> bytes:
+    total = 12 + len(body)
+    return _block_hdr.pack(block_type, total) + body + _block_len.pack(total)
+
+
+def shb_block(userappl: str = "usbip-toolkit") -> bytes:
+    body = _shb_body.pack(_BYTE_ORDER_MAGIC, 1, 0, -1)
+    body += _option(_OPT_SHB_USERAPPL, userappl.encode()) + _END_OF_OPTS
+    return _block(_BT_SHB, body)
+
+
+def idb_block(linktype: int, name: str, snaplen: int = 0) -> bytes:
+    body = _idb_body.pack(linktype, 0, snaplen)
+    body += _option(_OPT_IF_NAME, name.encode()) + _option(_OPT_IF_TSRESOL, b"\x09")
+    return _block(_BT_IDB, body + _END_OF_OPTS)
+
+
+class PcapngWriter:
+    # Packets are queued as (iface, ts_ns, flags, hdr, data) and encoded into enhanced packet
+    # blocks by a writer thread, so a tap only pays for a tuple and a queue put. hdr and data
+    # are written back to back and must not be mutated after they are queued.
+    #
+    # With max_bytes set the capture rotates: path "trace.pcapng" becomes trace_00000.pcapng,
+    # trace_00001.pcapng, ... each a complete section with every interface re-declared, and
+    # with max_files set only that many of the newest files are kept.
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = 0,
+        max_files: int = 0,
+        bufsize: int = 1 << 20,
+        background: bool = True,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.bufsize = bufsize
+        self.interfaces = []
+        self._nifaces = 0
+        self._file = None
+        self._file_idx = 0
+        self._paths = []
+        self._nbytes = 0
+        self._open()
+        self._lock = Lock()
+        self._queue = None
+        self._thread = None
+        if background:
+            self._queue = queue.SimpleQueue()
+            self._thread = Thread(target=self._writer_loop, name="pcapng", daemon=True)
+            self._thread.start()
+
+    def _next_path(self) -> str:
+        if not self.max_bytes:
+            return self.path
+        stem, ext = os.path.splitext(self.path)
+        return f"{stem}_{self._file_idx:05d}{ext or '.pcapng'}"
+
+    def _open(self):
+        path = self._next_path()
+        self._file_idx += 1
+        self._file = open(path, "wb", buffering=self.bufsize)
+        self._paths.append(path)
+        if self.max_files and len(self._paths) > self.max_files:
+            os.unlink(self._paths.pop(0))
+        self._nbytes = 0
+        self._write(shb_block())
+        for linktype, name in self.interfaces:
+            self._write(idb_block(linktype, name))
+
+    def _write(self, buf):
+        self._file.write(buf)
+        self._nbytes += len(buf)
+
+    def _rotate(self):
+        self._file.close()
+        self._open()
+
+    @staticmethod
+    def _encode(out: list, iface: int, ts_ns: int, flags: int, hdr, data) -> int:
+        caplen = len(data) if hdr is None else len(hdr) + len(data)
+        pad = -caplen & 3
+        total = _EPB_MIN_LEN + caplen + pad + (_EPB_FLAGS_LEN if flags else 0)
+        out.append(
+            _epb_hdr.pack(_BT_EPB, total, iface, ts_ns >> 32, ts_ns & 0xFFFFFFFF, caplen, caplen)
+        )
+        if hdr is not None:
+            out.append(hdr)
+        out.append(data)
+        if flags:
+            out.append(_PAD[:pad] + _epb_flags_tail.pack(_OPT_EPB_FLAGS, 4, flags, 0, 0, total))
+        else:
+            out.append(_PAD[:pad] + _block_len.pack(total))
+        return total
+
+    def _emit(self, items):
+        # encodes a batch of queued items into one write, rotating between items as needed
+        out = []
+        nbytes = self._nbytes
+        for item in items:
+            iface = item[0]
+            if iface < 0:
+                # interface declaration, goes into every file from now on
+                self.interfaces.append(item[1:])
+                blk = idb_block(*item[1:])
+                out.append(blk)
+                nbytes += len(blk)
+                continue
+            _, ts_ns, flags, hdr, data = item
+            if type(data) is list:
+                for buf in data:
+                    nbytes += self._encode(out, iface, ts_ns, flags, None, buf)
+            else:
+                nbytes += self._encode(out, iface, ts_ns, flags, hdr, data)
+            if self.max_bytes and nbytes >= self.max_bytes:
+                self._file.write(b"".join(out))
+                out = []
+                self._rotate()
+                nbytes = self._nbytes
+        if out:
+            self._file.write(b"".join(out))
+        self._nbytes = nbytes
+
+    def _submit(self, item):
+        if self._queue is not None:
+            self._queue.put(item)
+        else:
+            with self._lock:
+                self._emit((item,))
+
+    def _writer_loop(self):
+        q = self._queue
+        while True:
+            items = [q.get()]
+            while len(items) < 4096:
+                try:
+                    items.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in items
+            if stop:
+                items = items[: items.index(None)]
+            self._emit(items)
+            if stop:
+                break
+            if q.empty():
+                # idle, make what we have visible to readers
+                self._file.flush()
+        self._file.close()
+
+    def add_interface(self, linktype: int, name: str) -> int:
+        # interface ids are handed out in call order, which is also their order in the file
+        iface = self._nifaces
+        self._nifaces += 1
+        self._submit((-1, linktype, name))
+        return iface
+
+    def write_packet(self, iface: int, data, ts_ns: int = None, flags: int = 0, hdr=None):
+        self._submit((iface, time.time_ns() if ts_ns is None else ts_ns, flags, hdr, data))
+
+    def write_packets(self, iface: int, bufs: list, ts_ns: int = None, flags: int = 0):
+        # a burst sharing one timestamp, queued as a single item
+        self._submit((iface, time.time_ns() if ts_ns is None else ts_ns, flags, None, bufs))
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        elif self._file is not None:
+            self._file.close()
+        self._file = None
+
+
+def _options(buf, off: int, end: int):
+    while off + _opt_hdr.size <= end:
+        code, length = _opt_hdr.unpack_from(buf, off)
+        if code == _OPT_ENDOFOPT:
+            return
+        off += _opt_hdr.size
+        yield code, buf[off : off + length]
+        off += length + _pad4(length)
+
+
+def _tsresol_ns(tsresol: int):
+    # -> (multiplier, divisor) taking a timestamp in if_tsresol units to nanoseconds
+    if tsresol & 0x80:
+        return 1_000_000_000, 1 << (tsresol & 0x7F)
+    if tsresol <= 9:
+        return 10 ** (9 - tsresol), 1
+    return 1, 10 ** (tsresol - 9)
+
+
+def iter_pcapng(path: str):
+    # -> (linktype, if_name, ts_ns, epb_flags, data) per packet. Reads what PcapngWriter writes,
+    # little-endian sections with enhanced packet blocks; other block types are skipped.
+    with open(path, "rb") as f:
+        buf = memoryview(f.read())
+    ifaces = []
+    off = 0
+    while off + _block_hdr.size <= len(buf):
+        block_type, total = _block_hdr.unpack_from(buf, off)
+        if total < 12 or off + total > len(buf):
+            raise ValueError(f"{path}: truncated block at offset {off}")
+        body_off = off + _block_hdr.size
+        body_end = off + total - _block_len.size
+        if block_type == _BT_SHB:
+            if _shb_body.unpack_from(buf, body_off)[0] != _BYTE_ORDER_MAGIC:
+                raise ValueError(f"{path}: only little-endian pcapng is supported")
+            ifaces = []
+        elif block_type == _BT_IDB:
+            linktype = _idb_body.unpack_from(buf, body_off)[0]
+            name = None
+            scale = _tsresol_ns(6)
+            for code, val in _options(buf, body_off + _idb_body.size, body_end):
+                if code == _OPT_IF_NAME:
+                    name = bytes(val).decode(errors="replace")
+                elif code == _OPT_IF_TSRESOL:
+                    scale = _tsresol_ns(val[0])
+            ifaces.append((linktype, name, scale))
+        elif block_type == _BT_EPB:
+            iface, ts_hi, ts_lo, caplen, _ = _epb_hdr.unpack_from(buf, off)[2:]
+            linktype, name, (mul, div) = ifaces[iface]
+            data_off = off + _epb_hdr.size
+            flags = 0
+            for code, val in _options(buf, data_off + caplen + _pad4(caplen), body_end):
+                if code == _OPT_EPB_FLAGS:
+                    flags = _block_len.unpack_from(val)[0]
+            ts_ns = ((ts_hi << 32 | ts_lo) * mul) // div
+            yield linktype, name, ts_ns, flags, bytes(buf[data_off : data_off + caplen])
+        off += total
+
+
+def usbmon_xfer_type(urb) -> int:
+    # USB/IP does not carry the transfer type, best guess from the URB itself
+    if urb.ep == 0:
+        return USBMON_CTRL
+    if urb.body.number_of_packets > 0:
+        return USBMON_ISO
+    return USBMON_BULK
+
+
+def _usbmon_isodescs(iso, completed: bool) -> bytes:
+    # USB/IP iso_packet_descriptor -> usbmon_isodescs, whose length is actual_length once the
+    # URB has completed
+    res = array("i", bytes(len(iso) * 4))
+    res[0::4] = iso[ISO_STATUS::ISO_FIELDS]
+    res[1::4] = iso[ISO_OFFSET::ISO_FIELDS]
+    res[2::4] = iso[ISO_ACTUAL_LENGTH if completed else ISO_LENGTH :: ISO_FIELDS]
+    if sys.byteorder == "big":
+        res.byteswap()
+    return res.tobytes()
+
+
+class _SubmittedURB:
+    __slots__ = ("xfer_type", "epnum", "devnum", "busnum", "interval")
+
+    def __init__(self, xfer_type, epnum, devnum, busnum, interval):
+        self.xfer_type = xfer_type
+        self.epnum = epnum
+        self.devnum = devnum
+        self.busnum = busnum
+        self.interval = interval
+
+
+class UsbmonPacket:
+    __slots__ = (
+        "id",
+        "type",
+        "xfer_type",
+        "epnum",
+        "devnum",
+        "busnum",
+        "status",
+        "length",
+        "setup",
+        "interval",
+        "start_frame",
+        "xfer_flags",
+        "error_count",
+        "iso",
+        "data",
+    )
+
+    def __init__(self, buf):
+        (
+            self.id,
+            self.type,
+            self.xfer_type,
+            self.epnum,
+            self.devnum,
+            self.busnum,
+            flag_setup,
+            _,
+            _,
+            _,
+            self.status,
+            self.length,
+            len_cap,
+            setup,
+            self.interval,
+            self.start_frame,
+            self.xfer_flags,
+            ndesc,
+        ) = _usbmon_hdr.unpack_from(buf)
+        self.setup = setup if flag_setup == 0 else bytes(8)
+        # iso records: a USB/IP iso_packet_descriptor whose usbmon lengths went into length
+        # for a submit and actual_length for a completion
+        self.error_count = 0
+        self.iso = None
+        off = _usbmon_hdr.size
+        if self.xfer_type == USBMON_ISO and ndesc:
+            self.error_count = _usbmon_iso_rec.unpack(setup)[0]
+            descs = array("i")
+            descs.frombytes(buf[off : off + ndesc * _USBMON_ISODESC_SIZE])
+            if sys.byteorder == "big":
+                descs.byteswap()
+            iso = array("i", bytes(len(descs) * 4))
+            iso[ISO_STATUS::ISO_FIELDS] = descs[0::4]
+            iso[ISO_OFFSET::ISO_FIELDS] = descs[1::4]
+            iso[ISO_LENGTH if self.type == ord("S") else ISO_ACTUAL_LENGTH :: ISO_FIELDS] = descs[
+                2::4
+            ]
+            self.iso = iso
+            off += ndesc * _USBMON_ISODESC_SIZE
+        self.data = buf[off : off + len_cap]
+
+    def __repr__(self):
+        return (
+            f"UsbmonPacket({chr(self.type)} id={self.id:#x} {self.busnum}:{self.devnum}:"
+            f"{self.epnum:#04x} status={self.status} length={self.length})"
+        )
+
+
+class CaptureTap:
+    # What the bridges call into. Sim links get an interface each, every USB/IP connection
+    # shares the usbmon interface and is told apart by the top half of the usbmon URB id.
+
+    def __init__(self, writer: PcapngWriter):
+        self.writer = writer
+        self.usbip_iface = writer.add_interface(LINKTYPE_USB_LINUX_MMAPPED, "usbip")
+        self._conn_ids = itertools.count()
+        # per connection, seqnum -> _SubmittedURB and unlink seqnum -> unlinked seqnum
+        self._submitted = {}
+        self._unlinks = {}
+
+    def close(self):
+        self.writer.close()
+
+    def add_sim_link(self, name: str) -> int:
+        return self.writer.add_interface(LINKTYPE_USB_2_0, name)
+
+    def sim_h2d(self, iface: int, bufs: list, ts_ns: int = None):
+        # bufs is the list of packets handed to the sim in one write
+        self.writer.write_packets(iface, bufs, ts_ns, EPB_OUTBOUND)
+
+    def sim_d2h(self, iface: int, buf, ts_ns: int = None):
+        self.writer.write_packet(iface, buf, ts_ns, EPB_INBOUND)
+
+    def new_connection(self) -> int:
+        conn = next(self._conn_ids)
+        self._submitted[conn] = {}
+        self._unlinks[conn] = {}
+        return conn
+
+    def _usbmon(
+        self,
+        urb_id,
+        kind,
+        sub,
+        status,
+        length,
+        data,
+        setup,
+        ts_ns,
+        start_frame,
+        flags,
+        iso=None,
+        error_count=0,
+    ):
+        ts_sec, ts_nsec = divmod(ts_ns, 1_000_000_000)
+        ndesc = 0
+        if iso is not None:
+            ndesc = len(iso) // ISO_FIELDS
+            setup = _usbmon_iso_rec.pack(error_count, ndesc)
+        hdr = _usbmon_hdr.pack(
+            urb_id,
+            kind,
+            sub.xfer_type,
+            sub.epnum,
+            sub.devnum,
+            sub.busnum,
+            0 if setup is not None and iso is None else ord("-"),
+            0 if len(data) else ord("<" if sub.epnum & 0x80 else ">"),
+            ts_sec,
+            ts_nsec // 1000,
+            status,
+            length,
+            len(data),
+            setup if setup is not None else bytes(8),
+            sub.interval,
+            start_frame,
+            flags,
+            ndesc,
+        )
+        if iso is not None:
+            hdr += _usbmon_isodescs(iso, kind == ord("C"))
+        inbound = EPB_INBOUND if kind == ord("C") else EPB_OUTBOUND
+        self.writer.write_packet(self.usbip_iface, data, ts_ns, inbound, hdr)
+
+    def usbip_cmd(self, conn: int, urb, ts_ns: int = None):
+        ts_ns = time.time_ns() if ts_ns is None else ts_ns
+        if urb.command == CMD_UNLINK:
+            self._unlinks[conn][urb.seqnum] = urb.body.seqnum
+            return
+        if urb.command != CMD_SUBMIT:
+            return
+        body = urb.body
+        xfer_type = usbmon_xfer_type(urb)
+        epnum = urb.ep | (0x80 if urb.direction else 0)
+        sub = _SubmittedURB(xfer_type, epnum, urb.devid_devnum, urb.devid_busnum, body.interval)
+        self._submitted[conn][urb.seqnum] = sub
+        self._usbmon(
+            conn << 32 | urb.seqnum,
+            ord("S"),
+            sub,
+            -errno.EINPROGRESS,
+            body.transfer_buffer_length,
+            body.transfer_buffer,
+            bytes(body.setup) if xfer_type == USBMON_CTRL else None,
+            ts_ns,
+            body.start_frame,
+            body.transfer_flags,
+            body.iso_packet_descriptor,
+        )
+
+    def usbip_ret(self, conn: int, buf, ts_ns: int = None):
+        # buf is an encoded RET_SUBMIT or RET_UNLINK as sent to the client
+        ts_ns = time.time_ns() if ts_ns is None else ts_ns
+        hdr = parse_cmd_common_hdr(buf)
+        if hdr.command == RET_SUBMIT:
+            sub = self._submitted[conn].pop(hdr.seqnum, None)
+            if sub is None:
+                return
+            # only an IN URB's reply carries data
+            body = parse_command_reply(buf, sub.epnum >> 7).body
+            self._usbmon(
+                conn << 32 | hdr.seqnum,
+                ord("C"),
+                sub,
+                body.status,
+                body.actual_length,
+                body.transfer_buffer,
+                None,
+                ts_ns,
+                body.start_frame,
+                0,
+                body.iso_packet_descriptor,
+                body.error_count,
+            )
+            return
+        ret = parse_command_reply(buf)
+        if ret.command == RET_UNLINK:
+            seqnum = self._unlinks[conn].pop(ret.seqnum, None)
+            if ret.body.status == 0 or seqnum is None:
+                return
+            # the cancelled URB never gets a RET_SUBMIT, complete it here like usbmon would
+            sub = self._submitted[conn].pop(seqnum, None)
+            if sub is not None:
+                self._usbmon(
+                    conn << 32 | seqnum, ord("C"), sub, ret.body.status, 0, b"", None, ts_ns, 0, 0
+                )
+
+    def usbip_closed(self, conn: int):
+        self._submitted.pop(conn, None)
+        self._unlinks.pop(conn, None)
@@ -0,0 +1,149 @@
+import struct
+
+from usbip_toolkit.proto import *
+from usbip_toolkit.proto_struct import (
+    RET_SUBMIT,
+    RET_UNLINK,
+    CmdCommonHdr,
+    RetSubmitBody,
+    RetUnlinkBody,
+    build_cmd_submit,
+    build_cmd_unlink,
+)
+from usbip_toolkit.transport import connect_endpoint, parse_endpoint, tcp_endpoint
+from usbip_toolkit.util import recv_exact
+
+# A blocking USB/IP client that talks to a bridge the way vhci-hcd does, for benchmarks and
+# tests that have no kernel to import with. One thread may submit while another reads replies.
+
+_ret_hdr = struct.Struct(">IIHHIIiiiii8x")
+_OP_HDR_SIZE = OpCommonHdr.sizeof()
+_UDEV_SIZE = USBDevice.sizeof()
+_UINF_SIZE = USBInterface.sizeof()
+
+
+class USBIPClient:
+    def __init__(
+        self, host: str = "localhost", port: int = 3240, timeout: float = None, endpoint=None
+    ):
+        # endpoint, a URL or Endpoint, connects somewhere other than TCP host:port
+        self.sock = connect_endpoint(parse_endpoint(endpoint or tcp_endpoint(host, port)))
+        self.sock.settimeout(timeout)
+        self.udev = None
+        self._seqnum = 0
+        # seqnum -> direction, RET_SUBMIT only carries a transfer buffer for IN URBs
+        self._directions = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+    def _recv(self, nbytes: int) -> bytes:
+        buf = recv_exact(self.sock, nbytes)
+        if buf is None:
+            raise ConnectionError("USB/IP server closed the connection")
+        return bytes(buf)
+
+    def _op(self, code, body: dict) -> bytes:
+        # -> the reply's common header, raises if the op failed
+        self.sock.sendall(OpRequest.build({"code": code, "status": ST_OK, "body": body}))
+        hdr = self._recv(_OP_HDR_SIZE)
+        status = OpCommonHdr.parse(hdr).status
+        if status != ST_OK:
+            raise ValueError(f"USB/IP {code} failed: status {status}")
+        return hdr
+
+    def devlist(self) -> list:
+        # -> [(udev, uinf)], the server closes the connection afterwards
+        buf = self._op(UBSIPCode.REQ_DEVLIST, {})
+        ndev = self._recv(4)
+        buf += ndev
+        for _ in range(int.from_bytes(ndev, "big")):
+            udev = self._recv(_UDEV_SIZE)
+            # bNumInterfaces is the last byte of usbip_usb_device
+            buf += udev + self._recv(udev[-1] * _UINF_SIZE)
+        return [(dev.udev, dev.uinf) for dev in OpDevListReply.parse(buf).body.devs]
+
+    def import_device(self, busid: str):
+        hdr = self._op(UBSIPCode.REQ_IMPORT, {"busid": busid})
+        self.udev = OpImportReply.parse(hdr + self._recv(_UDEV_SIZE)).body.udev
+        return self.udev
+
+    def submit(
+        self,
+        ep: int,
+        direction: int,
+        length: int,
+        data=b"",
+        setup: bytes = bytes(8),
+        transfer_flags: int = 0,
+        interval: int = 0,
+        start_frame: int = 0,
+        iso_packet_descriptor=None,
+    ) -> int:
+        # iso_packet_descriptor as made by proto.iso_descriptors() makes it an iso URB
+        self._seqnum += 1
+        seqnum = self._seqnum
+        self._directions[seqnum] = direction
+        self.sock.sendall(
+            build_cmd_submit(
+                seqnum,
+                self.udev.busnum,
+                self.udev.devnum,
+                direction,
+                ep,
+                length,
+                setup=setup,
+                transfer_buffer=data,
+                transfer_flags=transfer_flags,
+                interval=interval,
+                start_frame=start_frame,
+                iso_packet_descriptor=iso_packet_descriptor,
+            )
+        )
+        return seqnum
+
+    def unlink(self, seqnum: int) -> int:
+        self._seqnum += 1
+        self.sock.sendall(
+            build_cmd_unlink(self._seqnum, self.udev.busnum, self.udev.devnum, 0, 0, seqnum)
+        )
+        return self._seqnum
+
+    def read_reply(self) -> CmdCommonHdr:
+        (
+            command,
+            seqnum,
+            busnum,
+            devnum,
+            direction,
+            ep,
+            status,
+            actual_length,
+            start_frame,
+            number_of_packets,
+            error_count,
+        ) = _ret_hdr.unpack(self._recv(_ret_hdr.size))
+        if command == 4:
+            return CmdCommonHdr(
+                RET_UNLINK, seqnum, busnum, devnum, direction, ep, RetUnlinkBody(status)
+            )
+        if command != 3:
+            raise ValueError(f"not a USB/IP command reply: {command}")
+        tbuf = b""
+        if self._directions.pop(seqnum, 0) == 1 and actual_length > 0:
+            tbuf = self._recv(actual_length)
+        iso = None
+        if number_of_packets > 0:
+            iso = iso_descriptors_from_bytes(
+                self._recv(number_of_packets * ISO_PACKET_DESCRIPTOR_SIZE)
+            )
+        body = RetSubmitBody(
+            status, actual_length, start_frame, number_of_packets, error_count, tbuf, iso
+        )
+        return CmdCommonHdr(RET_SUBMIT, seqnum, busnum, devnum, direction, ep, body)
@@ -0,0 +1,119 @@
+import struct
+import time
+
+from usbip_toolkit._tables import _crc16_table
+
+# USB CRC16 is the reflected 0x8005 polynomial (CRC-16/USB). binascii.crc_hqx is CCITT 0x1021
+# and zlib only does CRC-32, so neither can compute it; native speed comes from crcmod's C
+# extension when it is installed, otherwise from a pure-Python slice-by-8 table walk.
+
+
+def _crc16_bytewise(buf) -> int:
+    crc = 0xFFFF
+    for b in buf:
+        crc = (crc >> 8) ^ _crc16_table[(crc ^ b) & 0xFF]
+    return crc ^ 0xFFFF
+
+
+_slice8_tables = None
+
+
+def _build_slice8_tables():
+    # t1[s] advances the CRC state s over 16 zero bits, t2..t4 over 32, 48 and 64
+    global _slice8_tables
+    t1 = []
+    for s in range(1 << 16):
+        s = (s >> 8) ^ _crc16_table[s & 0xFF]
+        s = (s >> 8) ^ _crc16_table[s & 0xFF]
+        t1.append(s)
+    t2 = [t1[s] for s in t1]
+    t3 = [t1[s] for s in t2]
+    t4 = [t1[s] for s in t3]
+    _slice8_tables = (t1, t2, t3, t4)
+    return _slice8_tables
+
+
+def _crc16_slice8(buf) -> int:
+    t1, t2, t3, t4 = _slice8_tables or _build_slice8_tables()
+    crc = 0xFFFF
+    n8 = len(buf) & ~7
+    # each step consumes 8 bytes as four little-endian words
+    for w0, w1, w2, w3 in struct.iter_unpack("<4H", memoryview(buf)[:n8]):
+        crc = t4[crc ^ w0] ^ t3[w1] ^ t2[w2] ^ t1[w3]
+    for b in memoryview(buf)[n8:]:
+        crc = (crc >> 8) ^ _crc16_table[(crc ^ b) & 0xFF]
+    return crc ^ 0xFFFF
+
+
+def _load_crcmod():
+    try:
+        # the pure-Python crcmod fallback is slower than slice8, only take the C extension
+        import crcmod._crcfunext  # noqa: F401
+        import crcmod.predefined
+    except ImportError:
+        return None
+    return crcmod.predefined.mkPredefinedCrcFun("crc-16-usb")
+
+
+CRC16_BACKENDS = {
+    "bytewise": _crc16_bytewise,
+    "slice8": _crc16_slice8,
+}
+
+_crcmod_fn = _load_crcmod()
+if _crcmod_fn is not None:
+    CRC16_BACKENDS["crcmod"] = _crcmod_fn
+
+_crc16_backend = "crcmod" if _crcmod_fn is not None else "slice8"
+_crc16_fn = CRC16_BACKENDS[_crc16_backend]
+
+
+def crc16_backend() -> str:
+    return _crc16_backend
+
+
+def set_crc16_backend(name: str):
+    global _crc16_backend, _crc16_fn
+    try:
+        _crc16_fn = CRC16_BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"unknown CRC16 backend {name!r}, have {', '.join(CRC16_BACKENDS)}")
+    _crc16_backend = name
+
+
+def crc16_val(buf) -> int:
+    return _crc16_fn(buf)
+
+
+def crc16(buf) -> bytes:
+    return _crc16_fn(buf).to_bytes(2, "little")
+
+
+def crc16_many(bufs) -> list:
+    fn = _crc16_fn
+    return [fn(buf).to_bytes(2, "little") for buf in bufs]
+
+
+def crc16_chunks(buf, chunk_size: int) -> list:
+    mv = memoryview(buf)
+    return crc16_many(mv[off : off + chunk_size] for off in range(0, len(mv), chunk_size))
+
+
+def bench_crc16(sizes=(64, 512, 16 * 1024), total_bytes: int = 4 * 1024 * 1024):
+    results = {}
+    for name, fn in CRC16_BACKENDS.items():
+        fn(b"warm up tables")
+        for size in sizes:
+            buf = bytes(range(256)) * (size // 256) + bytes(size % 256)
+            niter = max(1, total_bytes // size)
+            start = time.perf_counter()
+            for _ in range(niter):
+                fn(buf)
+            elapsed = time.perf_counter() - start
+            results[(name, size)] = niter * size / elapsed / 1e6
+    return results
+
+
+if __name__ == "__main__":
+    for (name, size), mbps in bench_crc16().items():
+        print(f"{name:>8} {size:>6} B: {mbps:8.1f} MB/s")
@@ -0,0 +1,166 @@
+import struct
+
+from usbip_toolkit.usb import DescType, config_total_length, parse_config_endpoints
+
+# What the bridge knows about a device from its descriptors. The URB engine files every
+# complete GET_DESCRIPTOR response it relays here (or reads them itself when it probes the
+# device at attach), the registry builds the import and devlist replies from it and the engine
+# can answer repeated GET_DESCRIPTORs from it without a trip to the simulator. Descriptors are
+# kept raw, keyed like the request that read them; the parsed views are built on demand.
+
+_device_desc = struct.Struct("<BBHBBBBHHHBBBB")
+DEVICE_DESCRIPTOR_SIZE = _device_desc.size
+
+# descriptor types whose wTotalLength covers the descriptors that follow them
+_TOTAL_LENGTH_TYPES = frozenset(
+    (DescType.CONFIGURATION >> 8, DescType.OTHER_SPEED >> 8, 0x0F)  # 0x0F is BOS
+)
+
+
+class DeviceDescriptor:
+    __slots__ = (
+        "bcdUSB",
+        "bDeviceClass",
+        "bDeviceSubClass",
+        "bDeviceProtocol",
+        "bMaxPacketSize0",
+        "idVendor",
+        "idProduct",
+        "bcdDevice",
+        "iManufacturer",
+        "iProduct",
+        "iSerialNumber",
+        "bNumConfigurations",
+    )
+
+    def __init__(self, buf):
+        (
+            _,
+            _,
+            self.bcdUSB,
+            self.bDeviceClass,
+            self.bDeviceSubClass,
+            self.bDeviceProtocol,
+            self.bMaxPacketSize0,
+            self.idVendor,
+            self.idProduct,
+            self.bcdDevice,
+            self.iManufacturer,
+            self.iProduct,
+            self.iSerialNumber,
+            self.bNumConfigurations,
+        ) = _device_desc.unpack_from(buf)
+
+    def __repr__(self):
+        return (
+            f"DeviceDescriptor({self.idVendor:04x}:{self.idProduct:04x}, "
+            f"bcdDevice={self.bcdDevice:04x}, {self.bNumConfigurations} configurations)"
+        )
+
+
+def descriptor_complete(buf) -> bool:
+    # a GET_DESCRIPTOR response that wasn't cut short by the request's wLength
+    if len(buf) < 2 or buf[0] < 2:
+        return False
+    if buf[1] in _TOTAL_LENGTH_TYPES:
+        return len(buf) >= config_total_length(buf) > 0
+    return len(buf) >= buf[0]
+
+
+def parse_config_interfaces(buf) -> list:
+    # configuration descriptor -> [(bInterfaceClass, bInterfaceSubClass, bInterfaceProtocol)]
+    # of every interface's alternate setting 0
+    res = []
+    off = 0
+    while off + 2 <= len(buf):
+        blen = buf[off]
+        if blen < 2 or off + blen > len(buf):
+            break
+        if buf[off + 1] == DescType.INTERFACE >> 8 and blen >= 8 and buf[off + 3] == 0:
+            res.append(tuple(buf[off + 5 : off + 8]))
+        off += blen
+    return res
+
+
+class DescriptorCache:
+    def __init__(self):
+        # (wValue, wIndex) of the GET_DESCRIPTOR -> the complete descriptor
+        self._descs = {}
+        # bConfigurationValue last set, 0 while the device is unconfigured
+        self.configuration = 0
+
+    def __len__(self):
+        return len(self._descs)
+
+    def clear(self):
+        self._descs = {}
+        self.configuration = 0
+
+    def store(self, wValue: int, wIndex: int, buf) -> bool:
+        # -> True if buf was a complete descriptor of the requested type and is now cached
+        if not descriptor_complete(buf) or buf[1] != wValue >> 8:
+            return False
+        self._descs[wValue, wIndex] = bytes(buf)
+        return True
+
+    def get(self, wValue: int, wIndex: int = 0):
+        return self._descs.get((wValue, wIndex))
+
+    def lookup(self, setup):
+        # -> what the device answers the GET_DESCRIPTOR in setup with, None if not cached
+        buf = self._descs.get(
+            (int.from_bytes(setup[2:4], "little"), int.from_bytes(setup[4:6], "little"))
+        )
+        if buf is None:
+            return None
+        return buf[: int.from_bytes(setup[6:8], "little")]
+
+    @property
+    def device(self):
+        buf = self._descs.get((DescType.DEVICE, 0))
+        return DeviceDescriptor(buf) if buf is not None else None
+
+    def config(self, index: int):
+        # the configuration descriptor GET_DESCRIPTOR reads by index
+        return self._descs.get((DescType.CONFIGURATION | index, 0))
+
+    def config_by_value(self, value: int):
+        # the configuration descriptor SET_CONFIGURATION selects by bConfigurationValue
+        for (wValue, _), buf in list(self._descs.items()):
+            if wValue >> 8 == DescType.CONFIGURATION >> 8 and buf[5] == value:
+                return buf
+        return None
+
+    @property
+    def active_config(self):
+        # the configuration in use, or while unconfigured the one a host would pick first
+        if self.configuration:
+            return self.config_by_value(self.configuration)
+        return self.config(0)
+
+    def interfaces(self):
+        # -> [(class, subclass, protocol)] of the active configuration, None if not cached
+        buf = self.active_config
+        return parse_config_interfaces(buf) if buf is not None else None
+
+    def endpoints(self, value: int = None):
+        # -> {(bInterfaceNumber, bAlternateSetting): [EndpointInfo]} of a configuration
+        buf = self.active_config if value is None else self.config_by_value(value)
+        return parse_config_endpoints(buf) if buf is not None else {}
+
+    @property
+    def langids(self) -> list:
+        buf = self._descs.get((DescType.STRING, 0))
+        return list(struct.unpack_from(f"<{(buf[0] - 2) // 2}H", buf, 2)) if buf else []
+
+    def string(self, index: int, langid: int = None):
+        # -> the decoded string descriptor, in the device's first language by default
+        if not index:
+            return None
+        if langid is None:
+            langids = self.langids
+            if not langids:
+                return None
+            langid = langids[0]
+        buf = self._descs.get((DescType.STRING | index, langid))
+        return buf[2 : buf[0]].decode("utf-16-le", "replace") if buf is not None else None
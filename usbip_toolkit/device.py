@@ -0,0 +1,697 @@
+import socket
+import struct
+from collections import deque
+
+from usbip_toolkit.crc import crc16
+from usbip_toolkit.log import sim_log
+from usbip_toolkit.transport import connect_endpoint, parse_endpoint, tcp_endpoint
+from usbip_toolkit.usb import *
+
+# A pure-Python high-speed USB device to stand in for the HDL simulator. It takes the raw
+# packets the URB engine sends (tokens, DATAx, handshakes), checks their CRCs and answers
+# every token addressed to it the way a device would: ep0 runs the standard control requests
+# against a pluggable set of descriptors, the other endpoints are Endpoint objects. Attach it
+# over the length-prefixed sim protocol with serve_sim_link()/run_sim_device(), over a
+# shared-memory link with serve_shm_link(), or in-process through exchange(), the interface
+# ReplaySim offers the URB scheduler.
+
+_len_prefix = struct.Struct(">I")
+_setup_fields = struct.Struct("<BBHHH")
+
+_TOKEN_PIDS = frozenset((PID.TOK_OUT, PID.TOK_IN, PID.TOK_SETUP, PID.SPC_PING))
+_DATA_PIDS = frozenset((PID.DAT_DATA0, PID.DAT_DATA1, PID.DAT_DATA2, PID.DAT_MDATA))
+# PID of a high-bandwidth iso IN transaction by the number of transactions left in the
+# microframe, this one included
+_ISO_IN_PIDS = (None, PID.DAT_DATA0, PID.DAT_DATA1, PID.DAT_DATA2)
+
+LANGID_EN_US = 0x0409
+
+
+def device_descriptor(
+    idVendor: int,
+    idProduct: int,
+    bcdDevice: int = 0,
+    bMaxPacketSize0: int = 64,
+    iManufacturer: int = 1,
+    iProduct: int = 2,
+    iSerialNumber: int = 0,
+    bDeviceClass: int = 0,
+    bDeviceSubClass: int = 0,
+    bDeviceProtocol: int = 0,
+    bcdUSB: int = 0x0200,
+    bNumConfigurations: int = 1,
+) -> bytes:
+    return struct.pack(
+        "<BBHBBBBHHHBBBB",
+        18,
+        DescType.DEVICE >> 8,
+        bcdUSB,
+        bDeviceClass,
+        bDeviceSubClass,
+        bDeviceProtocol,
+        bMaxPacketSize0,
+        idVendor,
+        idProduct,
+        bcdDevice,
+        iManufacturer,
+        iProduct,
+        iSerialNumber,
+        bNumConfigurations,
+    )
+
+
+def endpoint_descriptor(
+    bEndpointAddress: int, bmAttributes: int, wMaxPacketSize: int, bInterval: int = 0
+) -> bytes:
+    return struct.pack(
+        "<BBBBHB",
+        7,
+        DescType.ENDPOINT >> 8,
+        bEndpointAddress,
+        bmAttributes,
+        wMaxPacketSize,
+        bInterval,
+    )
+
+
+def interface_descriptor(
+    bInterfaceNumber: int,
+    endpoints=(),
+    bInterfaceClass: int = 0xFF,
+    bInterfaceSubClass: int = 0,
+    bInterfaceProtocol: int = 0,
+    bAlternateSetting: int = 0,
+    iInterface: int = 0,
+) -> bytes:
+    # endpoints are Endpoint objects, their descriptors follow the interface's
+    hdr = struct.pack(
+        "<BBBBBBBBB",
+        9,
+        DescType.INTERFACE >> 8,
+        bInterfaceNumber,
+        bAlternateSetting,
+        len(endpoints),
+        bInterfaceClass,
+        bInterfaceSubClass,
+        bInterfaceProtocol,
+        iInterface,
+    )
+    return hdr + b"".join(ep.descriptor() for ep in endpoints)
+
+
+def config_descriptor(
+    interfaces,
+    bConfigurationValue: int = 1,
+    bmAttributes: int = 0x80,
+    bMaxPower: int = 50,
+    iConfiguration: int = 0,
+) -> bytes:
+    # interfaces are interface_descriptor()s, each with its endpoints
+    body = b"".join(interfaces)
+    hdr = struct.pack(
+        "<BBHBBBBB",
+        9,
+        DescType.CONFIGURATION >> 8,
+        9 + len(body),
+        len(interfaces),
+        bConfigurationValue,
+        iConfiguration,
+        bmAttributes,
+        bMaxPower,
+    )
+    return hdr + body
+
+
+def string_descriptor(s: str) -> bytes:
+    buf = s.encode("utf-16-le")
+    return bytes([2 + len(buf), DescType.STRING >> 8]) + buf
+
+
+def langid_descriptor(*langids) -> bytes:
+    langids = langids or (LANGID_EN_US,)
+    return bytes([2 + 2 * len(langids), DescType.STRING >> 8]) + struct.pack(
+        f"<{len(langids)}H", *langids
+    )
+
+
+class Endpoint:
+    # A non-control endpoint. in_packet() peeks at the next IN payload, None NAKs the token, and
+    # in_done() consumes it once the host ACKs; an unACKed payload is sent again. out_ready()
+    # False NAKs an OUT/PING, otherwise every new (correctly toggled) payload goes to out_packet().
+
+    def __init__(
+        self, addr: int, max_packet_size: int = 512, ep_type: int = EPType.BULK, interval: int = 0
+    ):
+        self.addr = addr
+        self.max_packet_size = max_packet_size
+        self.ep_type = ep_type
+        self.interval = interval
+        self.toggle = False
+        self.halted = False
+
+    @property
+    def is_in(self) -> bool:
+        return bool(self.addr & Dir.IN)
+
+    def descriptor(self) -> bytes:
+        return endpoint_descriptor(self.addr, self.ep_type, self.max_packet_size, self.interval)
+
+    def reset(self):
+        self.toggle = False
+        self.halted = False
+
+    def in_packet(self):
+        return None
+
+    def in_done(self):
+        pass
+
+    def out_ready(self) -> bool:
+        return False
+
+    def out_packet(self, buf):
+        pass
+
+
+class SinkEndpoint(Endpoint):
+    # OUT endpoint that accepts everything, keeping it only if asked to
+    def __init__(self, addr: int = 0x02, max_packet_size: int = 512, keep: bool = False):
+        super().__init__(addr, max_packet_size)
+        self.keep = keep
+        self.data = bytearray()
+        self.nbytes = 0
+        self.npackets = 0
+
+    def out_ready(self) -> bool:
+        return True
+
+    def out_packet(self, buf):
+        self.nbytes += len(buf)
+        self.npackets += 1
+        if self.keep:
+            self.data += buf
+
+
+class SourceEndpoint(Endpoint):
+    # IN endpoint that never NAKs. With transfer_size 0 it streams full packets of pattern,
+    # otherwise it ends every transfer_size bytes with a short packet (a ZLP if need be) so URBs
+    # of any length complete.
+
+    def __init__(
+        self,
+        addr: int = 0x82,
+        max_packet_size: int = 512,
+        transfer_size: int = 0,
+        pattern: bytes = bytes(range(256)),
+    ):
+        super().__init__(addr, max_packet_size)
+        self.transfer_size = transfer_size
+        reps = -(-max_packet_size // len(pattern))
+        self.payload = (pattern * reps)[:max_packet_size]
+        self._off = 0
+        self.nbytes = 0
+
+    def in_packet(self):
+        if not self.transfer_size:
+            return self.payload
+        return self.payload[: min(self.max_packet_size, self.transfer_size - self._off)]
+
+    def in_done(self):
+        n = len(self.in_packet())
+        self.nbytes += n
+        if not self.transfer_size:
+            return
+        self._off += n
+        if n < self.max_packet_size:
+            self._off = 0
+
+
+class LoopbackInEndpoint(Endpoint):
+    # IN half of a loopback, sends back what its LoopbackOutEndpoint received packet for packet,
+    # so short packets still end transfers, and NAKs while there is nothing to send
+    def __init__(self, addr: int = 0x81, max_packet_size: int = 512, depth: int = 64):
+        super().__init__(addr, max_packet_size)
+        # packets buffered before the OUT side NAKs
+        self.depth = depth
+        self.packets = deque()
+
+    def reset(self):
+        super().reset()
+        self.packets.clear()
+
+    def in_packet(self):
+        return self.packets[0] if self.packets else None
+
+    def in_done(self):
+        self.packets.popleft()
+
+
+class LoopbackOutEndpoint(Endpoint):
+    def __init__(self, loop: LoopbackInEndpoint, addr: int = 0x01, max_packet_size: int = 512):
+        super().__init__(addr, max_packet_size)
+        self.loop = loop
+
+    def out_ready(self) -> bool:
+        return len(self.loop.packets) < self.loop.depth
+
+    def out_packet(self, buf):
+        self.loop.packets.append(bytes(buf))
+
+
+class IsoEndpoint(Endpoint):
+    # Isochronous: no handshakes, toggles or NAKs. An IN endpoint with nothing to send answers
+    # with a zero-length packet, in_done() follows in_packet() straight away. With mult > 1
+    # in_packet() may return up to mult packets' worth for one microframe, and out_packet()
+    # gets a microframe's MDATA transactions joined up.
+
+    def __init__(self, addr: int, max_packet_size: int = 1024, interval: int = 1, mult: int = 1):
+        super().__init__(addr, max_packet_size, EPType.ISO, interval)
+        self.mult = mult
+        # the rest of the microframe's IN payload, or the OUT payload so far
+        self._in_chunks = deque()
+        self._out = bytearray()
+
+    def descriptor(self) -> bytes:
+        wMaxPacketSize = self.max_packet_size | (self.mult - 1) << 11
+        return endpoint_descriptor(self.addr, self.ep_type, wMaxPacketSize, self.interval)
+
+    def reset(self):
+        super().reset()
+        self._in_chunks.clear()
+        self._out.clear()
+
+
+class IsoSourceEndpoint(IsoEndpoint):
+    # sends size bytes of pattern every service interval
+    def __init__(
+        self,
+        addr: int = 0x83,
+        max_packet_size: int = 1024,
+        interval: int = 1,
+        mult: int = 1,
+        size: int = None,
+        pattern: bytes = bytes(range(256)),
+    ):
+        super().__init__(addr, max_packet_size, interval, mult)
+        size = max_packet_size * mult if size is None else size
+        self.payload = (pattern * -(-size // len(pattern)))[:size]
+        self.nbytes = 0
+        self.npackets = 0
+
+    def in_packet(self):
+        return self.payload
+
+    def in_done(self):
+        self.nbytes += len(self.payload)
+        self.npackets += 1
+
+
+class IsoSinkEndpoint(IsoEndpoint):
+    def __init__(
+        self,
+        addr: int = 0x03,
+        max_packet_size: int = 1024,
+        interval: int = 1,
+        mult: int = 1,
+        keep: bool = False,
+    ):
+        super().__init__(addr, max_packet_size, interval, mult)
+        self.keep = keep
+        self.packets = []
+        self.nbytes = 0
+        self.npackets = 0
+
+    def out_packet(self, buf):
+        self.nbytes += len(buf)
+        self.npackets += 1
+        if self.keep:
+            self.packets.append(bytes(buf))
+
+
+def reference_endpoints(
+    loopback_depth: int = 64, source_transfer_size: int = 0, iso: bool = False
+) -> list:
+    # EP1 OUT loops back to EP1 IN, EP2 OUT is a sink, EP2 IN a source, and with iso set
+    # EP3 OUT is an isochronous sink and EP3 IN an isochronous source, both every microframe
+    loop = LoopbackInEndpoint(0x81, depth=loopback_depth)
+    eps = [
+        LoopbackOutEndpoint(loop, 0x01),
+        loop,
+        SinkEndpoint(0x02),
+        SourceEndpoint(0x82, transfer_size=source_transfer_size),
+    ]
+    if iso:
+        eps += [IsoSinkEndpoint(0x03), IsoSourceEndpoint(0x83)]
+    return eps
+
+
+class USBDevice:
+    def __init__(
+        self,
+        endpoints=None,
+        descriptors: dict = None,
+        idVendor: int = 0x16D0,
+        idProduct: int = 0x0F3B,
+        bcdDevice: int = 0,
+        max_packet_size0: int = 64,
+        manufacturer: str = "usbip-toolkit",
+        product: str = "reference device",
+    ):
+        if endpoints is None:
+            endpoints = reference_endpoints()
+        self.endpoints = {ep.addr: ep for ep in endpoints}
+        self.max_packet_size0 = max_packet_size0
+        # wValue of GET_DESCRIPTOR (DescType | index) -> descriptor, string descriptors are
+        # served for any LANGID
+        if descriptors is None:
+            descriptors = {
+                DescType.DEVICE: device_descriptor(
+                    idVendor, idProduct, bcdDevice, bMaxPacketSize0=max_packet_size0
+                ),
+                DescType.CONFIGURATION: config_descriptor(
+                    [interface_descriptor(0, list(self.endpoints.values()))]
+                ),
+                DescType.STRING: langid_descriptor(),
+                DescType.STRING | 1: string_descriptor(manufacturer),
+                DescType.STRING | 2: string_descriptor(product),
+            }
+        self.descriptors = descriptors
+        self.addr = 0
+        self.configuration = 0
+        self.frame_num = 0
+        self.crc_errors = 0
+        self.pid_errors = 0
+        # (PID, endpoint number) of the last OUT/SETUP token addressed to us
+        self._token = None
+        # endpoint whose IN payload waits on the host's ACK, None for ep0 and False for none
+        self._in_pending = False
+        # ep0: "idle", "in" (data stage), "out" (data stage), "status_in", "status_out", "stall"
+        self._ctrl_stage = "idle"
+        self._ctrl_toggle = False
+        self._ctrl_setup = None
+        self._ctrl_data = b""
+        self._ctrl_off = 0
+        self._pending_addr = None
+
+    # packet level
+
+    def handle_packet(self, pkt):
+        # -> the device's response to one packet, or None if it stays quiet
+        pid = pkt[0] & 0xF
+        if pkt[0] >> 4 != pid ^ 0xF:
+            self.pid_errors += 1
+            return None
+        if pid in _TOKEN_PIDS:
+            self._in_pending = False
+            self._token = None
+            if len(pkt) != 3:
+                self.pid_errors += 1
+                return None
+            addr = pkt[1] & 0x7F
+            ep = ((pkt[2] & 7) << 1) | (pkt[1] >> 7)
+            if token_addr_packet(pid, addr, ep) != pkt:
+                self.crc_errors += 1
+                return None
+            if addr != self.addr:
+                return None
+            if pid == PID.TOK_IN:
+                return self._in_token(ep)
+            if pid == PID.SPC_PING:
+                ep_obj = self.endpoints.get(ep)
+                if ep_obj is None or ep_obj.halted:
+                    return stall_packet()
+                return ack_packet() if ep_obj.out_ready() else nack_packet()
+            self._token = pid, ep
+            return None
+        if pid in _DATA_PIDS:
+            token = self._token
+            self._token = None
+            if token is None or len(pkt) < 3:
+                return None
+            payload = pkt[1:-2]
+            if crc16(payload) != pkt[-2:]:
+                self.crc_errors += 1
+                return None
+            if token[0] == PID.TOK_SETUP:
+                return self._setup(payload)
+            return self._out_data(token[1], pid, payload)
+        if pid == PID.HND_ACK:
+            ep = self._in_pending
+            self._in_pending = False
+            if ep is None:
+                self._ctrl_in_acked()
+            elif ep:
+                ep.toggle = not ep.toggle
+                ep.in_done()
+            return None
+        if pid == PID.TOK_SOF:
+            self.frame_num = pkt[1] | (pkt[2] & 7) << 8
+        return None
+
+    def exchange(self, bufs, nresp: int) -> list:
+        # in-process stand-in for a sim link round trip
+        resps = []
+        for buf in bufs:
+            resp = self.handle_packet(buf)
+            if resp is not None:
+                resps.append(resp)
+        if len(resps) != nresp:
+            raise ValueError(f"device answered {len(resps)} packets, engine wants {nresp}")
+        return resps
+
+    def _in_token(self, ep):
+        if ep == 0:
+            return self._ctrl_in()
+        ep_obj = self.endpoints.get(Dir.IN | ep)
+        if ep_obj is None or ep_obj.halted:
+            return stall_packet()
+        if ep_obj.ep_type == EPType.ISO:
+            return self._iso_in(ep_obj)
+        payload = ep_obj.in_packet()
+        if payload is None:
+            return nack_packet()
+        self._in_pending = ep_obj
+        return data_packet(payload, odd=ep_obj.toggle)
+
+    def _iso_in(self, ep_obj):
+        chunks = ep_obj._in_chunks
+        if not chunks:
+            mps = ep_obj.max_packet_size
+            payload = (ep_obj.in_packet() or b"")[: mps * ep_obj.mult]
+            ep_obj.in_done()
+            chunks.extend(payload[off : off + mps] for off in range(0, len(payload), mps))
+            if not chunks:
+                chunks.append(b"")
+        return data_pid_packet(_ISO_IN_PIDS[len(chunks)], chunks.popleft())
+
+    def _out_data(self, ep, pid, payload):
+        odd = pid == PID.DAT_DATA1
+        if ep == 0:
+            return self._ctrl_out(odd, payload)
+        ep_obj = self.endpoints.get(ep)
+        if ep_obj is None or ep_obj.halted:
+            return stall_packet()
+        if ep_obj.ep_type == EPType.ISO:
+            # no handshake, MDATA says more of this microframe's payload follows
+            ep_obj._out += payload
+            if pid != PID.DAT_MDATA:
+                ep_obj.out_packet(ep_obj._out)
+                ep_obj._out.clear()
+            return None
+        if not ep_obj.out_ready():
+            return nack_packet()
+        if odd == ep_obj.toggle:
+            ep_obj.toggle = not odd
+            ep_obj.out_packet(payload)
+        # a stale toggle is a retransmission of a packet whose ACK got lost, ACK it again
+        return ack_packet()
+
+    # control endpoint
+
+    def _setup(self, payload):
+        # a SETUP can't be NAKed or STALLed and always resets the control pipe
+        if len(payload) != 8:
+            self._ctrl_stage = "stall"
+            return ack_packet()
+        self._ctrl_setup = bmRequestType, bRequest, wValue, wIndex, wLength = _setup_fields.unpack(
+            payload
+        )
+        self._ctrl_toggle = True
+        self._ctrl_off = 0
+        self._pending_addr = None
+        if bmRequestType & Dir.IN:
+            data = self.control_in(bmRequestType, bRequest, wValue, wIndex, wLength)
+            if data is None:
+                self._ctrl_stage = "stall"
+            else:
+                self._ctrl_data = bytes(data[:wLength])
+                self._ctrl_stage = "in" if wLength else "status_out"
+        elif wLength:
+            self._ctrl_data = bytearray()
+            self._ctrl_stage = "out"
+        else:
+            self._ctrl_request_out(b"")
+        return ack_packet()
+
+    def _ctrl_request_out(self, data):
+        bmRequestType, bRequest, wValue, wIndex, _ = self._ctrl_setup
+        if self.control_out(bmRequestType, bRequest, wValue, wIndex, bytes(data)):
+            self._ctrl_stage = "status_in"
+        else:
+            self._ctrl_stage = "stall"
+
+    def _ctrl_in(self):
+        stage = self._ctrl_stage
+        if stage == "in":
+            chunk = self._ctrl_data[self._ctrl_off : self._ctrl_off + self.max_packet_size0]
+            self._in_pending = None
+            return data_packet(chunk, odd=self._ctrl_toggle)
+        if stage == "status_in":
+            self._in_pending = None
+            return data_packet(b"", odd=True)
+        if stage == "stall":
+            return stall_packet()
+        return nack_packet()
+
+    def _ctrl_in_acked(self):
+        if self._ctrl_stage == "in":
+            n = min(self.max_packet_size0, len(self._ctrl_data) - self._ctrl_off)
+            self._ctrl_off += n
+            self._ctrl_toggle = not self._ctrl_toggle
+            if n < self.max_packet_size0 or self._ctrl_off >= self._ctrl_setup[4]:
+                self._ctrl_stage = "status_out"
+        elif self._ctrl_stage == "status_in":
+            self._ctrl_stage = "idle"
+            if self._pending_addr is not None:
+                sim_log.debug("device address %d", self._pending_addr)
+                self.addr = self._pending_addr
+                self._pending_addr = None
+
+    def _ctrl_out(self, odd, payload):
+        stage = self._ctrl_stage
+        if stage == "out":
+            if odd == self._ctrl_toggle:
+                self._ctrl_toggle = not odd
+                self._ctrl_data += payload
+                if len(payload) < self.max_packet_size0 or len(self._ctrl_data) >= (
+                    self._ctrl_setup[4]
+                ):
+                    self._ctrl_request_out(self._ctrl_data)
+            return ack_packet()
+        if stage == "in" or stage == "status_out":
+            # status stage, the host may end the data stage early
+            self._ctrl_stage = "idle"
+            return ack_packet()
+        if stage == "stall":
+            return stall_packet()
+        return ack_packet()
+
+    # standard requests, override to add class or vendor ones
+
+    def control_in(self, bmRequestType, bRequest, wValue, wIndex, wLength):
+        # -> data for a device-to-host request, None to STALL it
+        recip = bmRequestType & 0x1F
+        if (bmRequestType >> 5) & 3 != Type.STANDARD:
+            return None
+        if bRequest == Req.GET_DESCRIPTOR:
+            return self.descriptors.get(wValue)
+        if bRequest == Req.GET_CONFIGURATION:
+            return bytes([self.configuration])
+        if bRequest == Req.GET_INTERFACE:
+            return bytes(1)
+        if bRequest == Req.GET_STATUS:
+            if recip == Recip.ENDPOINT:
+                ep = self.endpoints.get(wIndex & 0x8F)
+                return None if ep is None else bytes([ep.halted, 0])
+            return bytes(2)
+        return None
+
+    def control_out(self, bmRequestType, bRequest, wValue, wIndex, data) -> bool:
+        # -> False to STALL a host-to-device request
+        recip = bmRequestType & 0x1F
+        if (bmRequestType >> 5) & 3 != Type.STANDARD:
+            return False
+        if bRequest == Req.SET_ADDRESS:
+            # takes effect once the status stage completes
+            self._pending_addr = wValue & 0x7F
+            return True
+        if bRequest == Req.SET_CONFIGURATION or bRequest == Req.SET_INTERFACE:
+            if bRequest == Req.SET_CONFIGURATION:
+                self.configuration = wValue & 0xFF
+            for ep in self.endpoints.values():
+                ep.reset()
+            return True
+        if bRequest in (Req.CLEAR_FEATURE, Req.SET_FEATURE):
+            if recip == Recip.ENDPOINT and wValue == Feature.ENDPOINT_HALT:
+                ep = self.endpoints.get(wIndex & 0x8F)
+                if ep is None:
+                    return False
+                ep.halted = bRequest == Req.SET_FEATURE
+                ep.toggle = False
+                return True
+            return recip == Recip.DEVICE
+        sim_log.warning("device STALLing request %02x %02x", bmRequestType, bRequest)
+        return False
+
+
+def serve_sim_link(dev: USBDevice, sock: socket.socket):
+    # answers length-prefixed packets until the bridge hangs up, every response to a batch of
+    # packets goes out in one send
+    buf = bytearray()
+    while True:
+        data = sock.recv(1 << 16)
+        if not data:
+            return
+        buf += data
+        out = []
+        off = 0
+        while off + 4 <= len(buf):
+            nbytes = _len_prefix.unpack_from(buf, off)[0]
+            end = off + 4 + nbytes
+            if end > len(buf):
+                break
+            resp = dev.handle_packet(bytes(buf[off + 4 : end]))
+            if resp is not None:
+                out.append(_len_prefix.pack(len(resp)))
+                out.append(resp)
+            off = end
+        del buf[:off]
+        if out:
+            sock.sendall(b"".join(out))
+
+
+def serve_shm_link(dev: USBDevice, link):
+    # the same over a shm.ShmLink, every packet already in the ring is answered in one batch
+    while True:
+        buf = link.recv()
+        if buf is None:
+            return
+        out = []
+        while buf is not None:
+            resp = dev.handle_packet(buf)
+            if resp is not None:
+                out.append(resp)
+            buf = link.rx.get()
+        if out and not link.send(out):
+            return
+
+
+def run_sim_device(
+    dev: USBDevice,
+    host: str = "localhost",
+    port: int = 2443,
+    connect_timeout: float = 10.0,
+    endpoint=None,
+):
+    # connects to a bridge's sim port, or the sim link at endpoint (a URL or Endpoint),
+    # retrying until it is listening
+    endpoint = parse_endpoint(endpoint or tcp_endpoint(host, port))
+    conn = connect_endpoint(endpoint, connect_timeout)
+    sim_log.info("device connected to sim link %s", endpoint)
+    try:
+        if endpoint.scheme == "shm":
+            serve_shm_link(dev, conn)
+        else:
+            serve_sim_link(dev, conn)
+    finally:
+        conn.close()
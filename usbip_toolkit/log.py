@@ -0,0 +1,93 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+# Channels, each a stdlib logger so levels and handlers can be set per channel:
+#   usbip_toolkit.sim    raw simulator packets and sim connections
+#   usbip_toolkit.usbip  USB/IP packets, ops and client connections
+#   usbip_toolkit.urb    URB engine transactions and scheduling
+# Per-packet dumps are DEBUG. Hot paths check isEnabledFor() before building anything, and hex
+# dumps are passed as LazyHex args so the formatting itself happens in whichever thread emits.
+
+log = logging.getLogger("usbip_toolkit")
+sim_log = logging.getLogger("usbip_toolkit.sim")
+usbip_log = logging.getLogger("usbip_toolkit.usbip")
+urb_log = logging.getLogger("usbip_toolkit.urb")
+
+CHANNELS = {
+    "sim": sim_log,
+    "usbip": usbip_log,
+    "urb": urb_log,
+}
+
+DEBUG = logging.DEBUG
+LOG_FORMAT = "%(relativeCreated)10.3f %(name)-19s %(levelname)-7s %(message)s"
+
+
+class LazyHex:
+    __slots__ = ("buf",)
+
+    def __init__(self, buf):
+        self.buf = buf
+
+    def __str__(self):
+        return self.buf.hex(" ")
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    # QueueHandler.prepare() formats the message in the logging thread, skip that and leave it
+    # to the listener. The args must not be mutated after the call, LazyHex buffers included.
+    def prepare(self, record):
+        return record
+
+
+_listener = None
+
+
+def setup_logging(
+    level="INFO", channel_levels=None, background: bool = True, stream=None, fmt: str = None
+):
+    # channel_levels maps channel name ("sim", "usbip", "urb") to a level for that channel
+    global _listener
+    stop_logging()
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(logging.Formatter(fmt or LOG_FORMAT))
+    for h in list(log.handlers):
+        log.removeHandler(h)
+    if background:
+        q = queue.SimpleQueue()
+        log.addHandler(_DeferredQueueHandler(q))
+        _listener = logging.handlers.QueueListener(q, handler)
+        _listener.start()
+    else:
+        log.addHandler(handler)
+    log.setLevel(level)
+    log.propagate = False
+    for name, logger in CHANNELS.items():
+        logger.setLevel((channel_levels or {}).get(name, logging.NOTSET))
+
+
+def stop_logging():
+    # flushes the background writer, records logged afterwards are dropped
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def parse_channel_levels(specs) -> dict:
+    # ["sim=DEBUG", "urb=info"] -> {"sim": "DEBUG", "urb": "INFO"}
+    res = {}
+    for spec in specs or ():
+        name, sep, level = spec.partition("=")
+        if not sep or name not in CHANNELS:
+            raise ValueError(
+                f"bad log channel spec {spec!r}, want one of {', '.join(CHANNELS)}=LEVEL"
+            )
+        res[name] = level.upper()
+    return res
+
+
+atexit.register(stop_logging)
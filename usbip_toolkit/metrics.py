@@ -0,0 +1,396 @@
+import json
+import os
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Lock, Thread
+
+from usbip_toolkit.log import log
+from usbip_toolkit.usb import PID
+
+# In-process metrics. Hot paths hold on to a labelled child and bump a plain attribute or list
+# slot on it, nothing is formatted, locked or allocated per event. Gauges are pulled: they
+# hold a function that is only called when the registry is collected, so queue depths cost
+# nothing until someone looks. Collection gives a JSON-able snapshot or Prometheus text.
+#
+# Histograms bucket integers (the latencies here are nanoseconds) by bit length, a value v
+# lands in bucket v.bit_length(), so every bucket's upper bound is a power of two.
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n: int = 1):
+        self.value += n
+
+
+class _GaugeChild:
+    __slots__ = ("value", "fn")
+
+    def __init__(self):
+        self.value = 0
+        self.fn = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, fn):
+        # fn() is called at collection time and replaces value
+        self.fn = fn
+
+    def get(self):
+        return self.fn() if self.fn is not None else self.value
+
+
+_NBUCKETS = 64
+
+
+class _HistogramChild:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        self.counts = [0] * _NBUCKETS
+        self.sum = 0
+
+    def observe(self, value: int, n: int = 1):
+        # n observations of value
+        self.counts[value.bit_length()] += n
+        self.sum += value * n
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+
+class _Family:
+    type = None
+    child_cls = None
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = Lock()
+
+    def labels(self, *values):
+        # -> the child for these label values, callers on hot paths should keep it
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}, got {values}")
+            with self._lock:
+                child = self._children.setdefault(values, self.child_cls())
+        return child
+
+    def remove(self, *values):
+        with self._lock:
+            self._children.pop(values, None)
+
+    def children(self):
+        with self._lock:
+            return list(self._children.items())
+
+
+class Counter(_Family):
+    type = "counter"
+    child_cls = _CounterChild
+
+    def samples(self):
+        for values, child in self.children():
+            yield values, child.value
+
+
+class Gauge(_Family):
+    type = "gauge"
+    child_cls = _GaugeChild
+
+    def samples(self):
+        for values, child in self.children():
+            try:
+                yield values, child.get()
+            except Exception:
+                log.debug("gauge %s%s failed", self.name, values, exc_info=True)
+
+
+class Histogram(_Family):
+    type = "histogram"
+    child_cls = _HistogramChild
+
+    def __init__(self, name: str, help: str, labelnames=(), scale: float = 1e-9, min_bits=10):
+        super().__init__(name, help, labelnames)
+        # exported bounds are 2 ** i * scale, nanoseconds to seconds by default, and buckets
+        # below 2 ** min_bits are folded into the first one
+        self.scale = scale
+        self.min_bits = min_bits
+
+    def samples(self):
+        # -> (label values, (cumulative [(upper bound, count)], sum, count))
+        for values, child in self.children():
+            counts = list(child.counts)
+            total = sum(counts)
+            top = max((i for i, n in enumerate(counts) if n), default=self.min_bits)
+            buckets = []
+            cum = sum(counts[: self.min_bits + 1])
+            buckets.append(((1 << self.min_bits) * self.scale, cum))
+            for i in range(self.min_bits + 1, max(top, self.min_bits) + 1):
+                cum += counts[i]
+                buckets.append(((1 << i) * self.scale, cum))
+            yield values, (buckets, child.sum * self.scale, total)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._families = {}
+        self._lock = Lock()
+
+    def _family(self, cls, name, help, labelnames, **kwargs):
+        # get-or-create, so every device's engine can ask for the same family
+        with self._lock:
+            fam = self._families.get(name)
+            if fam is None:
+                fam = self._families[name] = cls(name, help, labelnames, **kwargs)
+            elif not isinstance(fam, cls) or fam.labelnames != tuple(labelnames):
+                raise ValueError(f"metric {name} already registered as a different {fam.type}")
+            return fam
+
+    def counter(self, name: str, help: str, labelnames=()) -> Counter:
+        return self._family(Counter, name, help, labelnames)
+
+    def gauge(self, name: str, help: str, labelnames=()) -> Gauge:
+        return self._family(Gauge, name, help, labelnames)
+
+    def histogram(self, name: str, help: str, labelnames=(), **kwargs) -> Histogram:
+        return self._family(Histogram, name, help, labelnames, **kwargs)
+
+    def families(self):
+        with self._lock:
+            return list(self._families.values())
+
+    def snapshot(self) -> dict:
+        res = {}
+        for fam in self.families():
+            samples = []
+            for values, val in fam.samples():
+                sample = {"labels": dict(zip(fam.labelnames, values))}
+                if fam.type == "histogram":
+                    buckets, total, count = val
+                    sample["buckets"] = [[le, n] for le, n in buckets]
+                    sample["sum"] = total
+                    sample["count"] = count
+                else:
+                    sample["value"] = val
+                samples.append(sample)
+            res[fam.name] = {"type": fam.type, "help": fam.help, "samples": samples}
+        return res
+
+    def prometheus_text(self) -> str:
+        return render_prometheus(self.snapshot())
+
+
+def render_prometheus(snapshot: dict) -> str:
+    # a snapshot() in the Prometheus text format, also for snapshots merged from several
+    # registries
+    lines = []
+    for name, fam in snapshot.items():
+        lines.append(f"# HELP {name} {_escape_help(fam['help'])}")
+        lines.append(f"# TYPE {name} {fam['type']}")
+        for sample in fam["samples"]:
+            labels = list(sample["labels"].items())
+            if fam["type"] != "histogram":
+                lines.append(f"{name}{_labels(labels)} {_num(sample['value'])}")
+                continue
+            count = sample["count"]
+            for le, n in sample["buckets"]:
+                lines.append(f"{name}_bucket{_labels(labels + [('le', _num(le))])} {n}")
+            lines.append(f"{name}_bucket{_labels(labels + [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {_num(sample['sum'])}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def _escape_help(s: str) -> str:
+    return s.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _labels(labels) -> str:
+    if not labels:
+        return ""
+    parts = []
+    for k, v in labels:
+        v = str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _num(v) -> str:
+    return repr(float(v)) if isinstance(v, float) else str(int(v))
+
+
+class URBMetrics:
+    # the URB engine's and scheduler's view of a registry, for one device
+
+    def __init__(self, registry: MetricsRegistry, busid: str):
+        self.registry = registry
+        self.busid = busid
+        self._urbs = registry.counter(
+            "usbip_urbs_total",
+            "URBs completed by transfer type and endpoint",
+            ("busid", "type", "ep", "direction"),
+        )
+        self._errors = registry.counter(
+            "usbip_urb_errors_total", "URBs completed with a non-zero status", ("busid", "status")
+        )
+        nbytes = registry.counter(
+            "usbip_urb_bytes_total",
+            "URB payload bytes, out is host to device",
+            ("busid", "direction"),
+        )
+        self.bytes_out = nbytes.labels(busid, "out")
+        self.bytes_in = nbytes.labels(busid, "in")
+        self._resps = registry.counter(
+            "usbip_sim_responses_total",
+            "Packets received from the simulator by PID, NAK and STALL included",
+            ("busid", "pid"),
+        )
+        # by PID, filled in as PIDs are first seen
+        self._resp_pids = [None] * 16
+        self.urb_latency = registry.histogram(
+            "usbip_urb_latency_seconds",
+            "Time from a URB's CMD_SUBMIT being queued to its RET_SUBMIT",
+            ("busid",),
+        ).labels(busid)
+        phases = registry.histogram(
+            "usbip_control_phase_seconds",
+            "Control transfer stages, simulator round trips included",
+            ("busid", "phase"),
+        )
+        self.control_setup = phases.labels(busid, "setup")
+        self.control_data = phases.labels(busid, "data")
+        self.control_status = phases.labels(busid, "status")
+        packets = registry.histogram(
+            "usbip_bulk_packet_seconds",
+            "Bulk round trip per packet, a window's round trip is shared by its packets",
+            ("busid", "direction"),
+        )
+        self.bulk_out_packet = packets.labels(busid, "out")
+        self.bulk_in_packet = packets.labels(busid, "in")
+        self.descriptor_hits = registry.counter(
+            "usbip_descriptor_cache_hits_total",
+            "GET_DESCRIPTOR requests answered from the descriptor cache",
+            ("busid",),
+        ).labels(busid)
+        self._urb_children = {}
+
+    def urb_done(self, kind: str, ep: int, direction: int, status: int):
+        child = self._urb_children.get((kind, ep, direction))
+        if child is None:
+            child = self._urb_children[kind, ep, direction] = self._urbs.labels(
+                self.busid, kind, ep, "in" if direction else "out"
+            )
+        child.value += 1
+        if status:
+            self._errors.labels(self.busid, status).value += 1
+
+    def responses(self, resps):
+        pids = self._resp_pids
+        for resp in resps:
+            pid = resp[0] & 0xF
+            child = pids[pid]
+            if child is None:
+                child = pids[pid] = self._resps.labels(self.busid, _pid_name(pid))
+            child.value += 1
+
+    def queue_gauge(self, queue: str, fn):
+        # fn() -> current depth of one of the bridge's queues for this device
+        self.registry.gauge(
+            "usbip_queue_depth", "Items waiting in a bridge queue", ("busid", "queue")
+        ).labels(self.busid, queue).set_function(fn)
+
+    def queue_bytes_gauge(self, queue: str, fn):
+        # fn() -> bytes held by one of the bridge's queues for this device
+        self.registry.gauge(
+            "usbip_queue_bytes", "Bytes held in a bridge queue", ("busid", "queue")
+        ).labels(self.busid, queue).set_function(fn)
+
+    def budget_stalls(self):
+        # -> the counter child to bump when a client's reader waits for its byte budget
+        return self.registry.counter(
+            "usbip_budget_stalls_total",
+            "Times a usbip client was not read because its byte budget was spent",
+            ("busid",),
+        ).labels(self.busid)
+
+    def write_buffer_gauge(self, link: str, fn):
+        # fn() -> bytes written to one of the device's sockets but not yet sent
+        self.registry.gauge(
+            "usbip_write_buffer_bytes", "Bytes buffered for a socket write", ("busid", "link")
+        ).labels(self.busid, link).set_function(fn)
+
+
+def _pid_name(pid: int) -> str:
+    # PID.HND_NACK -> "NACK"
+    try:
+        return PID(pid).name.partition("_")[2]
+    except ValueError:
+        return f"0x{pid:x}"
+
+
+def serve_prometheus(registry: MetricsRegistry, port: int, host: str = "localhost"):
+    # -> the server, already serving /metrics from a daemon thread
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            log.debug("metrics: " + fmt, *args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name="metrics_http", daemon=True).start()
+    log.info("serving metrics on http://%s:%d/metrics", host, server.server_port)
+    return server
+
+
+class JSONDumper:
+    # rewrites path with a registry snapshot every interval seconds, and once more on stop()
+
+    def __init__(self, registry: MetricsRegistry, path: str, interval: float = 10.0):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self._stop = Event()
+        self._thread = Thread(target=self._loop, name="metrics_json", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.dump()
+
+    def dump(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"time": time.time(), "metrics": self.registry.snapshot()}, f)
+        # readers never see a half-written file
+        os.replace(tmp, self.path)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.dump()
+            except OSError:
+                log.warning("metrics dump to %s failed", self.path, exc_info=True)
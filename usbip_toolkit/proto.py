@@ -1,8 +1,14 @@
+import asyncio
 import enum
 import socket
+import struct
+import sys
+from array import array
 
 from construct import *
 
+from usbip_toolkit.util import recv_exact_into
+
 # fmt: off
 
 USBIP_VERSION_NUM = 0x0111
@@ -33,12 +39,20 @@ OP_DEVLIST        = 0x05
 OP_REQ_DEVLIST    = (OP_REQUEST | OP_DEVLIST)
 OP_REP_DEVLIST    = (OP_REPLY   | OP_DEVLIST)
 
+# op reply status, as in usbip_common.h
+ST_OK             = 0x00
+ST_NA             = 0x01
+ST_DEV_BUSY       = 0x02
+ST_DEV_ERR        = 0x03
+ST_NODEV          = 0x04
+ST_ERROR          = 0x05
+
 BusID             = PaddedString(SYSFS_BUS_ID_SIZE, "utf8")
 USBIPVersion      = "version" / Const(USBIP_VERSION_NUM, Int16ub)
 USBIPStatus       = "status" / Int32ub
 
 UBSIPCode = Enum(Int16ub,
-    REQ_DEVINFO  = OP_REQ_DEVLIST,
+    REQ_DEVINFO  = OP_REQ_DEVINFO,
     REP_DEVINFO  = OP_REP_DEVINFO,
     REQ_IMPORT   = OP_REQ_IMPORT,
     REP_IMPORT   = OP_REP_IMPORT,
@@ -237,11 +251,135 @@ CmdCommonHdrTuple = (
 
 CmdCommonHdr = Struct(*CmdCommonHdrTuple)
 
+# URB_ISO_ASAP in transfer_flags, start_frame is ignored and the URB follows the previous one
+URB_ISO_ASAP      = 0x0002
+
+IsoPacketDescriptor = Struct(
+    "offset" / Int32ub,
+    "length" / Int32ub,
+    "actual_length" / Int32ub,
+    "status" / Int32sb
+)
+
+ISO_PACKET_DESCRIPTOR_SIZE = IsoPacketDescriptor.sizeof()
+
+# fmt: on
+
+# Both codecs hand out iso_packet_descriptor as one flat array("i") holding offset, length,
+# actual_length and status of each packet in turn, or None for a URB without packets, so the
+# engine never builds an object per packet. The construct definition still spells out the
+# wire layout, the adapter only converts.
+ISO_OFFSET = 0
+ISO_LENGTH = 1
+ISO_ACTUAL_LENGTH = 2
+ISO_STATUS = 3
+ISO_FIELDS = 4
+assert array("i").itemsize * ISO_FIELDS == ISO_PACKET_DESCRIPTOR_SIZE
+
+# the descriptors are big-endian on the wire
+_ISO_SWAP = sys.byteorder == "little"
+# bounds what a bogus number_of_packets can make a reader allocate
+ISO_MAX_PACKETS = 1024
+# and a bogus transfer_buffer_length, before any byte budget gets to see the URB
+URB_MAX_BYTES = 64 * 1024 * 1024
+
+
+def iso_descriptors_from_bytes(buf) -> array:
+    res = array("i")
+    res.frombytes(buf)
+    if _ISO_SWAP:
+        res.byteswap()
+    return res
+
+
+def check_iso_descriptors(descs, transfer_buffer_length=None):
+    # offset, length and actual_length are unsigned on the wire but held signed, a packet
+    # 2 GiB or more into the buffer reads back negative. Raises ValueError for those, and for
+    # packets past transfer_buffer_length when it is given.
+    offsets = descs[ISO_OFFSET::ISO_FIELDS]
+    lengths = descs[ISO_LENGTH::ISO_FIELDS]
+    if min(offsets) < 0 or min(lengths) < 0 or min(descs[ISO_ACTUAL_LENGTH::ISO_FIELDS]) < 0:
+        raise ValueError("iso packet descriptor offset or length of 2 GiB or more")
+    if transfer_buffer_length is not None:
+        end = max(off + length for off, length in zip(offsets, lengths))
+        if end > transfer_buffer_length:
+            raise ValueError(
+                f"iso packet ends at {end}, past transfer_buffer_length {transfer_buffer_length}"
+            )
+
+
+def iso_descriptors_to_bytes(descs) -> bytes:
+    if _ISO_SWAP:
+        descs = array("i", descs)
+        descs.byteswap()
+    return descs.tobytes()
+
+
+def iso_descriptors(lengths, offsets=None) -> array:
+    # -> descriptors for packets of these lengths, laid out back to back unless offsets says
+    # otherwise
+    res = array("i", bytes(4 * ISO_FIELDS * len(lengths)))
+    off = 0
+    for i, length in enumerate(lengths):
+        res[i * ISO_FIELDS + ISO_OFFSET] = off if offsets is None else offsets[i]
+        res[i * ISO_FIELDS + ISO_LENGTH] = length
+        off += length
+    return res
+
+
+def iso_packet_count(number_of_packets: int) -> int:
+    # non-iso URBs may say 0 or 0xffffffff
+    return max(number_of_packets, 0)
+
+
+class IsoPacketDescriptorArray(Adapter):
+    def _decode(self, obj, context, path):
+        if not obj:
+            return None
+        try:
+            res = array(
+                "i", (v for d in obj for v in (d.offset, d.length, d.actual_length, d.status))
+            )
+        except OverflowError:
+            raise ValueError("iso packet descriptor offset or length of 2 GiB or more") from None
+        # a CMD_SUBMIT's packets must lie within its buffer
+        check_iso_descriptors(res, context.get("transfer_buffer_length"))
+        return res
+
+    def _encode(self, obj, context, path):
+        if obj is None:
+            return []
+        return [
+            {
+                "offset": obj[i + ISO_OFFSET],
+                "length": obj[i + ISO_LENGTH],
+                "actual_length": obj[i + ISO_ACTUAL_LENGTH],
+                "status": obj[i + ISO_STATUS],
+            }
+            for i in range(0, len(obj), ISO_FIELDS)
+        ]
+
+
+def _ret_transfer_len(this):
+    # Every RET_SUBMIT header carries direction 0, only the URB knows whether the reply has
+    # data: an OUT reply counts the bytes sent in actual_length without carrying them. Pass
+    # urb_direction= to parse() and build() when it is known.
+    urb_direction = this._root._params.get("urb_direction")
+    has_data = this._.direction ^ 1 if urb_direction is None else urb_direction
+    return this.actual_length * has_data
+
+
+_IsoPacketDescriptors = "iso_packet_descriptor" / IsoPacketDescriptorArray(
+    IsoPacketDescriptor[lambda this: iso_packet_count(this.number_of_packets)]
+)
+
+# fmt: off
+
 CmdSubmitBodyPrefixTuple = (
     "transfer_flags" / Int32ub,
     "transfer_buffer_length" / Int32sb,
-    "start_frame" / Const(0, Int32sb), # ISO not supported
-    "number_of_packets" / Const(0, Int32sb), # ISO not supported
+    "start_frame" / Int32sb,
+    "number_of_packets" / Int32sb,
     "interval" / Int32sb,
     "setup" / Bytes(8),
 )
@@ -251,7 +389,7 @@ CmdSubmitBodyPrefix = Struct(*CmdSubmitBodyPrefixTuple)
 CmdSubmitBody = Struct(
     *CmdSubmitBodyPrefixTuple,
     "transfer_buffer" / Bytes(this.transfer_buffer_length * (this._.direction ^ 1)),
-    # iso_packet_descriptor not used/supported
+    _IsoPacketDescriptors,
 )
 
 CmdSubmit = Struct(
@@ -262,12 +400,12 @@ CmdSubmit = Struct(
 RetSubmitBody = Struct(
     "status" / Int32sb,
     "actual_length" / Int32sb,
-    "start_frame" / Const(0, Int32sb), # ISO not supported
-    "number_of_packets" / Const(0, Int32sb), # ISO not supported
+    "start_frame" / Int32sb,
+    "number_of_packets" / Int32sb,
     "error_count" / Int32sb,
     Padding(8),
-    "transfer_buffer" / Bytes(this.actual_length * (this._.direction ^ 1)),
-    # iso_packet_descriptor not used/supported
+    "transfer_buffer" / Bytes(_ret_transfer_len),
+    _IsoPacketDescriptors,
 )
 
 RetSubmit = Struct(
@@ -291,7 +429,7 @@ RetUnlinkBody = Struct(
 )
 
 RetUnlink = Struct(
-    *CommonHdr(UBSIPCommandEnum.CMD_SUBMIT),
+    *CommonHdr(UBSIPCommandEnum.RET_UNLINK),
     "body" / RetUnlinkBody
 )
 
@@ -324,66 +462,230 @@ class USBIPServerPacketType(enum.IntEnum):
     USBIPCommandReply = enum.auto()
 
 
-def read_usbip_client_packet(sock: socket.socket):
-    buf = bytearray()
-    first_2bytes = sock.recv(2)
-    if not first_2bytes:
-        return None, None
-    buf += first_2bytes
-    if first_2bytes == USBIPVersion.build(None):
-        # OpCommonHdr
-        rest_op_cmn_hdr_buf = sock.recv(OpCommonHdr.sizeof() - len(buf))
-        if not rest_op_cmn_hdr_buf:
-            return None, None
-        buf += rest_op_cmn_hdr_buf
-        cmn_hdr = OpCommonHdr.parse(buf)
-        body_ty = {
-            UBSIPCode.REQ_DEVINFO: OpDevInfoRequestBody,
-            UBSIPCode.REQ_IMPORT: OpImportRequestBody,
-            UBSIPCode.REQ_EXPORT: OpExportRequestBody,
-            UBSIPCode.REQ_UNEXPORT: OpUnexportRequestBody,
-            UBSIPCode.REQ_DEVLIST: OpDevListRequestBody,
-        }[cmn_hdr.code]
-        body_buf = sock.recv(body_ty.sizeof())
-        if not body_buf:
+class ConstructCodec:
+    name = "construct"
+
+    @staticmethod
+    def parse_cmd(buf, transfer_buffer=None):
+        # with transfer_buffer passed separately, buf is the rest: the 48 byte header and any
+        # iso packet descriptors
+        if transfer_buffer is not None:
+            buf = (
+                bytes(buf[:_CMD_FIXED_SIZE]) + bytes(transfer_buffer) + bytes(buf[_CMD_FIXED_SIZE:])
+            )
+        return USBIPCommandRequest.parse(buf)
+
+    @staticmethod
+    def parse_ret(buf, urb_direction=None):
+        return USBIPCommandReply.parse(buf, urb_direction=urb_direction)
+
+    @staticmethod
+    def build_cmd(msg) -> bytes:
+        if msg.command in (UBSIPCommandEnum.CMD_SUBMIT, UBSIPCommandEnum.CMD_UNLINK):
+            return USBIPCommandRequest.build(msg)
+        return USBIPCommandReply.build(msg)
+
+    @staticmethod
+    def build_ret_submit(
+        cmd_msg,
+        status=0,
+        transfer_buffer=b"",
+        actual_length=None,
+        error_count=0,
+        start_frame=0,
+        iso_packet_descriptor=None,
+    ):
+        if actual_length is None:
+            actual_length = len(transfer_buffer)
+        npackets = 0 if iso_packet_descriptor is None else len(iso_packet_descriptor) // ISO_FIELDS
+        return RetSubmit.build(
+            {
+                **cmd_ret_hdr(cmd_msg),
+                "command": UBSIPCommandEnum.RET_SUBMIT,
+                "body": {
+                    "status": status,
+                    "error_count": error_count,
+                    "actual_length": actual_length,
+                    "start_frame": start_frame,
+                    "number_of_packets": npackets,
+                    "transfer_buffer": bytes(transfer_buffer),
+                    "iso_packet_descriptor": iso_packet_descriptor,
+                },
+            },
+            urb_direction=cmd_msg.direction,
+        )
+
+    @staticmethod
+    def build_ret_unlink(cmd_msg, status=0):
+        return USBIPCommandReply.build(
+            {
+                **cmd_ret_hdr(cmd_msg),
+                "command": UBSIPCommandEnum.RET_UNLINK,
+                "body": {"status": status},
+            }
+        )
+
+
+_OP_REQUEST_BODIES = {
+    UBSIPCode.REQ_DEVINFO: OpDevInfoRequestBody,
+    UBSIPCode.REQ_IMPORT: OpImportRequestBody,
+    UBSIPCode.REQ_EXPORT: OpExportRequestBody,
+    UBSIPCode.REQ_UNEXPORT: OpUnexportRequestBody,
+    UBSIPCode.REQ_DEVLIST: OpDevListRequestBody,
+}
+
+_OP_COMMON_HDR_SIZE = OpCommonHdr.sizeof()
+
+
+def _op_request_size(cmn_hdr) -> int:
+    body = _OP_REQUEST_BODIES.get(cmn_hdr.code)
+    if body is None:
+        raise ValueError(f"bad op request code: {int(cmn_hdr.code):#06x}")
+    return _OP_COMMON_HDR_SIZE + body.sizeof()
+
+
+# CMD_SUBMIT and CMD_UNLINK are both 48 bytes before the transfer buffer
+_CMD_FIXED_SIZE = CmdCommonHdr.sizeof() + CmdSubmitBodyPrefix.sizeof()
+assert _CMD_FIXED_SIZE == CmdCommonHdr.sizeof() + CmdUnlinkBody.sizeof()
+# command, direction, transfer_buffer_length, number_of_packets
+_cmd_lens = struct.Struct(">I8xI8xi4xi")
+_cmd_submit_val = UBSIPCommandEnum.encmapping[UBSIPCommandEnum.CMD_SUBMIT]
+_usbip_version_bytes = USBIPVersion.build(None)
+
+
+def _cmd_submit_rest(direction: int, transfer_len: int, npackets: int) -> int:
+    # -> bytes of a CMD_SUBMIT after its fixed part: the OUT payload, then iso descriptors
+    # IN URBs are capped too, their reply data is gathered before the budget is charged for it
+    if transfer_len > URB_MAX_BYTES or direction == 0 and transfer_len < 0:
+        raise ValueError(f"bad transfer_buffer_length: {transfer_len}")
+    if npackets > ISO_MAX_PACKETS:
+        raise ValueError(f"bad number_of_packets: {npackets}")
+    return transfer_len * (direction ^ 1) + iso_packet_count(npackets) * ISO_PACKET_DESCRIPTOR_SIZE
+
+
+class USBIPClientFramer:
+    def __init__(
+        self,
+        sock: socket.socket,
+        codec=ConstructCodec,
+        bufsize: int = 64 * 1024,
+        readahead: bool = True,
+        verify: bool = False,
+    ):
+        self.sock = sock
+        self.codec = codec
+        self.readahead = readahead
+        self.verify = verify
+        self._buf = bytearray(max(bufsize, _CMD_FIXED_SIZE))
+        self._mv = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+    def _fill(self, n: int) -> bool:
+        if self._end - self._start >= n:
+            return True
+        if self._start + n > len(self._buf):
+            avail = self._end - self._start
+            if n > len(self._buf):
+                buf = bytearray(n)
+                buf[:avail] = self._mv[self._start : self._end]
+                self._buf, self._mv = buf, memoryview(buf)
+            else:
+                self._mv[:avail] = self._mv[self._start : self._end]
+            self._start, self._end = 0, avail
+        while self._end - self._start < n:
+            want = len(self._buf) - self._end if self.readahead else n - (self._end - self._start)
+            nread = self.sock.recv_into(self._mv[self._end :], want)
+            if not nread:
+                return False
+            self._end += nread
+        return True
+
+    def _take(self, n: int) -> memoryview:
+        res = self._mv[self._start : self._start + n]
+        self._start += n
+        return res
+
+    def _read_into(self, dst: memoryview) -> bool:
+        avail = min(self._end - self._start, len(dst))
+        dst[:avail] = self._take(avail)
+        rem = dst[avail:]
+        if not rem:
+            return True
+        if self.readahead and len(rem) < len(self._buf) // 2:
+            if not self._fill(len(rem)):
+                return False
+            rem[:] = self._take(len(rem))
+            return True
+        # large transfer buffers are received straight into their final home
+        return recv_exact_into(self.sock, rem)
+
+    def read_packet(self):
+        if not self._fill(2):
             return None, None
-        buf += body_buf
-        print(f"opreq in buf: {buf.hex(' ')}")
-        res = OpRequest.parse(buf)
-        rebuilt_buf = OpRequest.build(res)
-        cpkt_ty = USBIPClientPacketType.USBIPOperationRequest
-    else:
-        # USBIPCommand
-        rest_cmd_cmn_hdr_buf = sock.recv(CmdCommonHdr.sizeof() - len(buf))
-        if not rest_cmd_cmn_hdr_buf:
-            return None, None
-        buf += rest_cmd_cmn_hdr_buf
-        cmn_hdr = CmdCommonHdr.parse(buf)
-        body_ty = {
-            UBSIPCommandEnum.CMD_SUBMIT: CmdSubmitBody,
-            UBSIPCommandEnum.CMD_UNLINK: CmdUnlinkBody,
-        }[cmn_hdr.command]
-        if body_ty is CmdSubmitBody:
-            tbuf = sock.recv(8)
-            if not tbuf:
+        if self._mv[self._start : self._start + 2] == _usbip_version_bytes:
+            if not self._fill(_OP_COMMON_HDR_SIZE):
+                return None, None
+            cmn_hdr = OpCommonHdr.parse(self._mv[self._start : self._start + _OP_COMMON_HDR_SIZE])
+            pkt_sz = _op_request_size(cmn_hdr)
+            if not self._fill(pkt_sz):
                 return None, None
-            buf += tbuf
-            transfer_len = int.from_bytes(tbuf[4:], "big")
-            print(f"transfer_len: {transfer_len}")
-            pkt_sz = CmdCommonHdr.sizeof() + CmdSubmitBodyPrefix.sizeof() + transfer_len
+            buf = bytes(self._take(pkt_sz))
+            res = OpRequest.parse(buf)
+            if self.verify and OpRequest.build(res) != buf:
+                raise ValueError(f"OpRequest rebuild mismatch for {buf.hex(' ')}")
+            return res, USBIPClientPacketType.USBIPOperationRequest
+        if not self._fill(_CMD_FIXED_SIZE):
+            return None, None
+        command, direction, transfer_len, npackets = _cmd_lens.unpack_from(self._buf, self._start)
+        if command == _cmd_submit_val:
+            pkt = bytearray(_CMD_FIXED_SIZE + _cmd_submit_rest(direction, transfer_len, npackets))
         else:
-            pkt_sz = CmdCommonHdr.sizeof() + CmdUnlinkBody.sizeof()
-        print(f"len(buf): {len(buf)} pkt_sz: {pkt_sz}")
-        rest = sock.recv(pkt_sz - len(buf))
-        if not rest:
+            pkt = bytearray(_CMD_FIXED_SIZE)
+        pkt_mv = memoryview(pkt)
+        pkt_mv[:_CMD_FIXED_SIZE] = self._take(_CMD_FIXED_SIZE)
+        if not self._read_into(pkt_mv[_CMD_FIXED_SIZE:]):
             return None, None
-        buf += rest
-        print(f"ipcmd in buf: {buf.hex(' ')}")
-        res = USBIPCommandRequest.parse(buf)
-        rebuilt_buf = USBIPCommandRequest.build(res)
-        cpkt_ty = USBIPClientPacketType.USBIPCommandRequest
-    assert buf == rebuilt_buf
-    return res, cpkt_ty
+        res = self.codec.parse_cmd(pkt_mv)
+        if self.verify and self.codec.build_cmd(res) != pkt:
+            raise ValueError(f"{self.codec.name} rebuild mismatch for seqnum {res.seqnum}")
+        return res, USBIPClientPacketType.USBIPCommandRequest
+
+
+def read_usbip_client_packet(sock: socket.socket, codec=ConstructCodec, verify: bool = False):
+    # unbuffered, so nothing past the end of the packet is consumed from sock
+    framer = USBIPClientFramer(sock, codec, bufsize=0, readahead=False, verify=verify)
+    return framer.read_packet()
+
+
+async def read_usbip_client_packet_async(
+    reader: asyncio.StreamReader, codec=ConstructCodec, verify: bool = False
+):
+    try:
+        hdr = await reader.readexactly(2)
+        if hdr == _usbip_version_bytes:
+            hdr += await reader.readexactly(_OP_COMMON_HDR_SIZE - 2)
+            cmn_hdr = OpCommonHdr.parse(hdr)
+            buf = hdr + await reader.readexactly(_op_request_size(cmn_hdr) - len(hdr))
+            res = OpRequest.parse(buf)
+            if verify and OpRequest.build(res) != buf:
+                raise ValueError(f"OpRequest rebuild mismatch for {buf.hex(' ')}")
+            return res, USBIPClientPacketType.USBIPOperationRequest
+        hdr += await reader.readexactly(_CMD_FIXED_SIZE - 2)
+        command, direction, transfer_len, npackets = _cmd_lens.unpack_from(hdr)
+        tbuf = b""
+        if command == _cmd_submit_val:
+            rest = _cmd_submit_rest(direction, transfer_len, npackets)
+            if direction == 0:
+                tbuf = await reader.readexactly(transfer_len)
+            if rest > len(tbuf):
+                hdr += await reader.readexactly(rest - len(tbuf))
+        res = codec.parse_cmd(hdr, tbuf) if tbuf else codec.parse_cmd(hdr)
+    except asyncio.IncompleteReadError:
+        return None, None
+    if verify and codec.build_cmd(res) != hdr[:_CMD_FIXED_SIZE] + tbuf + hdr[_CMD_FIXED_SIZE:]:
+        raise ValueError(f"{codec.name} rebuild mismatch for seqnum {res.seqnum}")
+    return res, USBIPClientPacketType.USBIPCommandRequest
 
 
 def cmd_ret_hdr(cmd_msg):
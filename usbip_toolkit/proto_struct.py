@@ -0,0 +1,483 @@
+import struct
+
+from usbip_toolkit.proto import (
+    ISO_FIELDS,
+    ISO_PACKET_DESCRIPTOR_SIZE,
+    ConstructCodec,
+    UBSIPCommandEnum,
+    check_iso_descriptors,
+    iso_descriptors_from_bytes,
+    iso_descriptors_to_bytes,
+    iso_packet_count,
+)
+
+# Precompiled struct.Struct equivalents of the construct definitions in proto.py for the
+# CMD_SUBMIT/RET_SUBMIT/CMD_UNLINK/RET_UNLINK hot path. Layouts must stay byte-for-byte
+# identical to CmdCommonHdr, CmdSubmitBody, CmdUnlinkBody, RetSubmitBody and RetUnlinkBody.
+# iso_packet_descriptor is the same flat array("i") the construct adapter gives, or None.
+
+# fmt: off
+CMD_SUBMIT = UBSIPCommandEnum.CMD_SUBMIT
+CMD_UNLINK = UBSIPCommandEnum.CMD_UNLINK
+RET_SUBMIT = UBSIPCommandEnum.RET_SUBMIT
+RET_UNLINK = UBSIPCommandEnum.RET_UNLINK
+
+_CMD_CODES = UBSIPCommandEnum.decmapping
+
+_cmd_common_hdr   = struct.Struct(">IIHHII")
+_cmd_submit_body  = struct.Struct(">Iiiii8s")
+_cmd_unlink_body  = struct.Struct(">I24x")
+_ret_submit_body  = struct.Struct(">iiiii8x")
+_ret_unlink_body  = struct.Struct(">i24x")
+
+_cmd_submit       = struct.Struct(_cmd_common_hdr.format + _cmd_submit_body.format[1:])
+_cmd_unlink       = struct.Struct(_cmd_common_hdr.format + _cmd_unlink_body.format[1:])
+_ret_submit       = struct.Struct(_cmd_common_hdr.format + _ret_submit_body.format[1:])
+_ret_unlink       = struct.Struct(_cmd_common_hdr.format + _ret_unlink_body.format[1:])
+
+CMD_COMMON_HDR_SIZE = _cmd_common_hdr.size
+CMD_SUBMIT_SIZE     = _cmd_submit.size
+CMD_UNLINK_SIZE     = _cmd_unlink.size
+RET_SUBMIT_SIZE     = _ret_submit.size
+RET_UNLINK_SIZE     = _ret_unlink.size
+# fmt: on
+
+
+def command_val(command) -> int:
+    if isinstance(command, int):
+        return command
+    ival = getattr(command, "int", None)
+    if ival is not None:
+        return ival
+    return UBSIPCommandEnum.encmapping[command]
+
+
+def _command_enum(val: int):
+    # EnumIntegerString so comparisons against UBSIPCommandEnum.* behave like construct's
+    return _CMD_CODES.get(val, val)
+
+
+class CmdCommonHdr:
+    __slots__ = ("command", "seqnum", "devid_busnum", "devid_devnum", "direction", "ep", "body")
+
+    def __init__(self, command, seqnum, devid_busnum, devid_devnum, direction, ep, body=None):
+        self.command = command
+        self.seqnum = seqnum
+        self.devid_busnum = devid_busnum
+        self.devid_devnum = devid_devnum
+        self.direction = direction
+        self.ep = ep
+        self.body = body
+
+    def __repr__(self):
+        return (
+            f"{type(self).__name__}(command={self.command!s}, seqnum={self.seqnum}, "
+            f"devid={self.devid_busnum}-{self.devid_devnum}, direction={self.direction}, "
+            f"ep={self.ep}, body={self.body!r})"
+        )
+
+
+class CmdSubmitBody:
+    __slots__ = (
+        "transfer_flags",
+        "transfer_buffer_length",
+        "start_frame",
+        "number_of_packets",
+        "interval",
+        "setup",
+        "transfer_buffer",
+        "iso_packet_descriptor",
+    )
+
+    def __init__(
+        self,
+        transfer_flags,
+        transfer_buffer_length,
+        start_frame,
+        number_of_packets,
+        interval,
+        setup,
+        transfer_buffer,
+        iso_packet_descriptor=None,
+    ):
+        self.transfer_flags = transfer_flags
+        self.transfer_buffer_length = transfer_buffer_length
+        self.start_frame = start_frame
+        self.number_of_packets = number_of_packets
+        self.interval = interval
+        self.setup = setup
+        self.transfer_buffer = transfer_buffer
+        self.iso_packet_descriptor = iso_packet_descriptor
+
+    def __repr__(self):
+        iso = ""
+        if self.iso_packet_descriptor is not None:
+            iso = f", start_frame={self.start_frame}, number_of_packets={self.number_of_packets}"
+        return (
+            f"CmdSubmitBody(transfer_flags={self.transfer_flags:#x}, "
+            f"transfer_buffer_length={self.transfer_buffer_length}, interval={self.interval}, "
+            f"setup={bytes(self.setup).hex()}, transfer_buffer=<{len(self.transfer_buffer)} bytes>"
+            f"{iso})"
+        )
+
+
+class CmdUnlinkBody:
+    __slots__ = ("seqnum",)
+
+    def __init__(self, seqnum):
+        self.seqnum = seqnum
+
+    def __repr__(self):
+        return f"CmdUnlinkBody(seqnum={self.seqnum})"
+
+
+class RetSubmitBody:
+    __slots__ = (
+        "status",
+        "actual_length",
+        "start_frame",
+        "number_of_packets",
+        "error_count",
+        "transfer_buffer",
+        "iso_packet_descriptor",
+    )
+
+    def __init__(
+        self,
+        status,
+        actual_length,
+        start_frame,
+        number_of_packets,
+        error_count,
+        transfer_buffer,
+        iso_packet_descriptor=None,
+    ):
+        self.status = status
+        self.actual_length = actual_length
+        self.start_frame = start_frame
+        self.number_of_packets = number_of_packets
+        self.error_count = error_count
+        self.transfer_buffer = transfer_buffer
+        self.iso_packet_descriptor = iso_packet_descriptor
+
+    def __repr__(self):
+        iso = ""
+        if self.iso_packet_descriptor is not None:
+            iso = f", start_frame={self.start_frame}, number_of_packets={self.number_of_packets}"
+        return (
+            f"RetSubmitBody(status={self.status}, actual_length={self.actual_length}, "
+            f"error_count={self.error_count}, transfer_buffer=<{len(self.transfer_buffer)} bytes>"
+            f"{iso})"
+        )
+
+
+class RetUnlinkBody:
+    __slots__ = ("status",)
+
+    def __init__(self, status):
+        self.status = status
+
+    def __repr__(self):
+        return f"RetUnlinkBody(status={self.status})"
+
+
+def _transfer_buffer(buf, off, length):
+    end = off + length
+    if len(buf) < end:
+        raise ValueError(f"truncated transfer_buffer: need {end} bytes, have {len(buf)}")
+    # slicing a memoryview keeps the payload zero-copy
+    return buf[off:end]
+
+
+def _iso_packet_descriptor(buf, off, number_of_packets, transfer_buffer_length=None):
+    npackets = iso_packet_count(number_of_packets)
+    if not npackets:
+        return None
+    end = off + npackets * ISO_PACKET_DESCRIPTOR_SIZE
+    if len(buf) < end:
+        raise ValueError(f"truncated iso_packet_descriptor: need {end} bytes, have {len(buf)}")
+    res = iso_descriptors_from_bytes(buf[off:end])
+    check_iso_descriptors(res, transfer_buffer_length)
+    return res
+
+
+def parse_cmd_common_hdr(buf) -> CmdCommonHdr:
+    command, seqnum, busnum, devnum, direction, ep = _cmd_common_hdr.unpack_from(buf)
+    return CmdCommonHdr(_command_enum(command), seqnum, busnum, devnum, direction, ep)
+
+
+def parse_command_request(buf, transfer_buffer=None) -> CmdCommonHdr:
+    # transfer_buffer lets a reader that received the payload separately skip re-joining it,
+    # buf then holds the rest: the header and any iso packet descriptors
+    command = _cmd_common_hdr.unpack_from(buf)[0]
+    if command == 1:
+        (
+            command,
+            seqnum,
+            busnum,
+            devnum,
+            direction,
+            ep,
+            transfer_flags,
+            transfer_buffer_length,
+            start_frame,
+            number_of_packets,
+            interval,
+            setup,
+        ) = _cmd_submit.unpack_from(buf)
+        tbuf_len = transfer_buffer_length * (direction ^ 1)
+        iso_off = CMD_SUBMIT_SIZE
+        if transfer_buffer is None:
+            transfer_buffer = _transfer_buffer(buf, CMD_SUBMIT_SIZE, tbuf_len)
+            iso_off += tbuf_len
+        elif len(transfer_buffer) != tbuf_len:
+            raise ValueError(f"transfer_buffer is {len(transfer_buffer)} bytes, need {tbuf_len}")
+        iso = None
+        if number_of_packets > 0:
+            iso = _iso_packet_descriptor(buf, iso_off, number_of_packets, transfer_buffer_length)
+        body = CmdSubmitBody(
+            transfer_flags,
+            transfer_buffer_length,
+            start_frame,
+            number_of_packets,
+            interval,
+            setup,
+            transfer_buffer,
+            iso,
+        )
+        return CmdCommonHdr(CMD_SUBMIT, seqnum, busnum, devnum, direction, ep, body)
+    elif command == 2:
+        command, seqnum, busnum, devnum, direction, ep, unlink_seqnum = _cmd_unlink.unpack_from(buf)
+        body = CmdUnlinkBody(unlink_seqnum)
+        return CmdCommonHdr(CMD_UNLINK, seqnum, busnum, devnum, direction, ep, body)
+    hdr = parse_cmd_common_hdr(buf)
+    raise ValueError(f"not a USB/IP command request: {hdr.command!s}")
+
+
+def parse_command_reply(buf, urb_direction=None) -> CmdCommonHdr:
+    # RET_SUBMIT headers always say direction 0, urb_direction is the submitted URB's and
+    # decides whether actual_length bytes of data follow
+    command = _cmd_common_hdr.unpack_from(buf)[0]
+    if command == 3:
+        (
+            command,
+            seqnum,
+            busnum,
+            devnum,
+            direction,
+            ep,
+            status,
+            actual_length,
+            start_frame,
+            number_of_packets,
+            error_count,
+        ) = _ret_submit.unpack_from(buf)
+        tbuf_len = actual_length * (direction ^ 1 if urb_direction is None else urb_direction)
+        iso = None
+        if number_of_packets > 0:
+            iso = _iso_packet_descriptor(buf, RET_SUBMIT_SIZE + tbuf_len, number_of_packets)
+        body = RetSubmitBody(
+            status,
+            actual_length,
+            start_frame,
+            number_of_packets,
+            error_count,
+            _transfer_buffer(buf, RET_SUBMIT_SIZE, tbuf_len),
+            iso,
+        )
+        return CmdCommonHdr(RET_SUBMIT, seqnum, busnum, devnum, direction, ep, body)
+    elif command == 4:
+        command, seqnum, busnum, devnum, direction, ep, status = _ret_unlink.unpack_from(buf)
+        body = RetUnlinkBody(status)
+        return CmdCommonHdr(RET_UNLINK, seqnum, busnum, devnum, direction, ep, body)
+    hdr = parse_cmd_common_hdr(buf)
+    raise ValueError(f"not a USB/IP command reply: {hdr.command!s}")
+
+
+def build_cmd_submit(
+    seqnum,
+    devid_busnum,
+    devid_devnum,
+    direction,
+    ep,
+    transfer_buffer_length,
+    setup=bytes(8),
+    transfer_buffer=b"",
+    transfer_flags=0,
+    interval=0,
+    start_frame=0,
+    number_of_packets=0,
+    iso_packet_descriptor=None,
+) -> bytes:
+    # number_of_packets follows iso_packet_descriptor when that is given
+    if iso_packet_descriptor is not None:
+        number_of_packets = len(iso_packet_descriptor) // ISO_FIELDS
+    hdr = _cmd_submit.pack(
+        1,
+        seqnum,
+        devid_busnum,
+        devid_devnum,
+        direction,
+        ep,
+        transfer_flags,
+        transfer_buffer_length,
+        start_frame,
+        number_of_packets,
+        interval,
+        setup,
+    )
+    if not direction:
+        assert len(transfer_buffer) == transfer_buffer_length
+        hdr += transfer_buffer
+    if iso_packet_descriptor is not None:
+        hdr += iso_descriptors_to_bytes(iso_packet_descriptor)
+    return hdr
+
+
+def build_cmd_unlink(seqnum, devid_busnum, devid_devnum, direction, ep, unlink_seqnum) -> bytes:
+    return _cmd_unlink.pack(2, seqnum, devid_busnum, devid_devnum, direction, ep, unlink_seqnum)
+
+
+def build_ret_submit(
+    seqnum,
+    status=0,
+    transfer_buffer=b"",
+    actual_length=None,
+    error_count=0,
+    devid_busnum=0,
+    devid_devnum=0,
+    direction=0,
+    ep=0,
+    start_frame=0,
+    number_of_packets=0,
+    iso_packet_descriptor=None,
+    urb_direction=None,
+) -> bytes:
+    # urb_direction as in parse_command_reply, an OUT URB's reply carries no data
+    if actual_length is None:
+        actual_length = len(transfer_buffer)
+    if iso_packet_descriptor is not None:
+        number_of_packets = len(iso_packet_descriptor) // ISO_FIELDS
+    hdr = _ret_submit.pack(
+        3,
+        seqnum,
+        devid_busnum,
+        devid_devnum,
+        direction,
+        ep,
+        status,
+        actual_length,
+        start_frame,
+        number_of_packets,
+        error_count,
+    )
+    has_data = direction ^ 1 if urb_direction is None else urb_direction
+    if has_data:
+        assert len(transfer_buffer) == actual_length
+        hdr += transfer_buffer
+    if iso_packet_descriptor is not None:
+        hdr += iso_descriptors_to_bytes(iso_packet_descriptor)
+    return hdr
+
+
+def build_ret_unlink(seqnum, status=0, devid_busnum=0, devid_devnum=0, direction=0, ep=0) -> bytes:
+    return _ret_unlink.pack(4, seqnum, devid_busnum, devid_devnum, direction, ep, status)
+
+
+def build_command(msg) -> bytes:
+    command = command_val(msg.command)
+    hdr = (msg.seqnum, msg.devid_busnum, msg.devid_devnum, msg.direction, msg.ep)
+    body = msg.body
+    if command == 1:
+        return build_cmd_submit(
+            *hdr,
+            body.transfer_buffer_length,
+            setup=body.setup,
+            transfer_buffer=bytes(body.transfer_buffer),
+            transfer_flags=body.transfer_flags,
+            interval=body.interval,
+            start_frame=body.start_frame,
+            number_of_packets=body.number_of_packets,
+            iso_packet_descriptor=body.iso_packet_descriptor,
+        )
+    elif command == 2:
+        return build_cmd_unlink(*hdr, body.seqnum)
+    elif command == 3:
+        return build_ret_submit(
+            msg.seqnum,
+            status=body.status,
+            transfer_buffer=bytes(body.transfer_buffer),
+            actual_length=body.actual_length,
+            error_count=body.error_count,
+            devid_busnum=msg.devid_busnum,
+            devid_devnum=msg.devid_devnum,
+            direction=msg.direction,
+            ep=msg.ep,
+            start_frame=body.start_frame,
+            number_of_packets=body.number_of_packets,
+            iso_packet_descriptor=body.iso_packet_descriptor,
+        )
+    elif command == 4:
+        return build_ret_unlink(
+            msg.seqnum,
+            status=body.status,
+            devid_busnum=msg.devid_busnum,
+            devid_devnum=msg.devid_devnum,
+            direction=msg.direction,
+            ep=msg.ep,
+        )
+    raise ValueError(f"unknown USB/IP command: {command}")
+
+
+class StructCodec:
+    name = "struct"
+
+    @staticmethod
+    def parse_cmd(buf, transfer_buffer=None):
+        return parse_command_request(buf, transfer_buffer)
+
+    @staticmethod
+    def parse_ret(buf, urb_direction=None):
+        return parse_command_reply(buf, urb_direction)
+
+    @staticmethod
+    def build_cmd(msg) -> bytes:
+        return build_command(msg)
+
+    @staticmethod
+    def build_ret_submit(
+        cmd_msg,
+        status=0,
+        transfer_buffer=b"",
+        actual_length=None,
+        error_count=0,
+        start_frame=0,
+        iso_packet_descriptor=None,
+    ):
+        return build_ret_submit(
+            cmd_msg.seqnum,
+            status=status,
+            transfer_buffer=bytes(transfer_buffer),
+            actual_length=actual_length,
+            error_count=error_count,
+            start_frame=start_frame,
+            iso_packet_descriptor=iso_packet_descriptor,
+            urb_direction=cmd_msg.direction,
+        )
+
+    @staticmethod
+    def build_ret_unlink(cmd_msg, status=0):
+        return build_ret_unlink(cmd_msg.seqnum, status=status)
+
+
+CODECS = {
+    ConstructCodec.name: ConstructCodec,
+    StructCodec.name: StructCodec,
+}
+
+
+def get_codec(name: str):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"unknown codec {name!r}, expected one of {', '.join(CODECS)}")
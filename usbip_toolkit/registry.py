@@ -0,0 +1,176 @@
+from threading import Lock
+
+from usbip_toolkit.log import usbip_log
+from usbip_toolkit.proto import *
+from usbip_toolkit.usb import USB_SPEED_HIGH
+
+# The registry is what the USB/IP side of a bridge sees: every exported device, the busid
+# clients import it by and whichever connection currently holds it. What services the URBs is
+# up to the bridge, it hangs its per-device simulator backend off ExportedDevice.backend and
+# the backend's DescriptorCache off ExportedDevice.descriptors. Once the cache has the device
+# and configuration descriptors the replies describe the device from them, until then from the
+# constructor's defaults.
+
+
+class ExportedDevice:
+    def __init__(
+        self,
+        busnum: int,
+        devnum: int,
+        backend=None,
+        idVendor: int = 0x16D0,
+        idProduct: int = 0x0F3B,
+        bcdDevice: int = 0,
+        speed: int = USB_SPEED_HIGH,
+        interfaces=((0, 0, 0),),
+        descriptors=None,
+    ):
+        self.busnum = busnum
+        self.devnum = devnum
+        self.busid = f"{busnum}-{devnum}.0"
+        self.backend = backend
+        self.idVendor = idVendor
+        self.idProduct = idProduct
+        self.bcdDevice = bcdDevice
+        self.speed = speed
+        # (bInterfaceClass, bInterfaceSubclass, bInterfaceProtocol) per interface
+        self.interfaces = tuple(interfaces)
+        # a descriptors.DescriptorCache, or None
+        self.descriptors = descriptors
+        self.owner = None
+
+    def __repr__(self):
+        desc = self.descriptors.device if self.descriptors is not None else None
+        ids = desc or self
+        return f"ExportedDevice({self.busid}, {ids.idVendor:04x}:{ids.idProduct:04x})"
+
+    def _interfaces(self):
+        interfaces = self.descriptors.interfaces() if self.descriptors is not None else None
+        return self.interfaces if interfaces is None else interfaces
+
+    def devinfo(self) -> dict:
+        # bNumInterfaces has to match the interfaces that follow it, even if the client
+        # changes configuration in between
+        interfaces = self._interfaces()
+        return {"udev": self.udev(interfaces), "uinf": self.uinf(interfaces)}
+
+    def udev(self, interfaces=None) -> dict:
+        if interfaces is None:
+            interfaces = self._interfaces()
+        udev = {
+            "path": "",
+            "busid": self.busid,
+            "busnum": self.busnum,
+            "devnum": self.devnum,
+            "speed": self.speed,
+            "idVendor": self.idVendor,
+            "idProduct": self.idProduct,
+            "bcdDevice": self.bcdDevice,
+            "bDeviceClass": 0,
+            "bDeviceSubClass": 0,
+            "bDeviceProtocol": 0,
+            "bConfigurationValue": 0,
+            "bNumConfigurations": 1,
+            "bNumInterfaces": len(interfaces),
+        }
+        desc = self.descriptors.device if self.descriptors is not None else None
+        if desc is not None:
+            for field in (
+                "idVendor",
+                "idProduct",
+                "bcdDevice",
+                "bDeviceClass",
+                "bDeviceSubClass",
+                "bDeviceProtocol",
+                "bNumConfigurations",
+            ):
+                udev[field] = getattr(desc, field)
+            udev["bConfigurationValue"] = self.descriptors.configuration
+        return udev
+
+    def uinf(self, interfaces=None) -> list:
+        if interfaces is None:
+            interfaces = self._interfaces()
+        return [
+            {"bInterfaceClass": c, "bInterfaceSubclass": s, "bInterfaceProtocol": p}
+            for c, s, p in interfaces
+        ]
+
+
+def _op_status_reply(code, status: int) -> bytes:
+    # usbipd only sends the common header when an op fails
+    return OpCommonHdr.build({"code": code, "status": status})
+
+
+class DeviceRegistry:
+    def __init__(self, devices=()):
+        self._devices = {}
+        # connections on different threads race to import
+        self._lock = Lock()
+        for dev in devices:
+            self.add(dev)
+
+    def add(self, dev: ExportedDevice):
+        if dev.busid in self._devices:
+            raise ValueError(f"busid {dev.busid} already registered")
+        self._devices[dev.busid] = dev
+
+    def remove(self, busid: str) -> ExportedDevice:
+        return self._devices.pop(busid)
+
+    def get(self, busid: str):
+        return self._devices.get(busid)
+
+    def __iter__(self):
+        return iter(list(self._devices.values()))
+
+    def __len__(self):
+        return len(self._devices)
+
+    def claim(self, busid: str, owner):
+        # -> (status, device), a device is exported to one connection at a time
+        with self._lock:
+            dev = self._devices.get(busid)
+            if dev is None:
+                return ST_NODEV, None
+            if dev.owner is not None:
+                return ST_DEV_BUSY, None
+            dev.owner = owner
+            return ST_OK, dev
+
+    def release(self, dev: ExportedDevice, owner):
+        with self._lock:
+            if dev.owner is owner:
+                dev.owner = None
+
+    def build_devlist_reply(self) -> bytes:
+        devs = [dev.devinfo() for dev in self]
+        return OpDevListReply.build({"status": ST_OK, "body": {"ndev": len(devs), "devs": devs}})
+
+    def build_devinfo_reply(self, busid: str) -> bytes:
+        dev = self.get(busid)
+        if dev is None:
+            return _op_status_reply(UBSIPCode.REP_DEVINFO, ST_NODEV)
+        return OpDevInfoReply.build({"status": ST_OK, "body": dev.devinfo()})
+
+    def build_import_reply(self, dev: ExportedDevice) -> bytes:
+        return OpImportReply.build({"status": ST_OK, "body": {"udev": dev.udev()}})
+
+    def handle_op(self, cmsg, owner):
+        # -> (reply, device now owned by owner or None), like usbipd the connection should be
+        # closed after any op that did not import a device
+        if cmsg.code == UBSIPCode.REQ_DEVLIST:
+            return self.build_devlist_reply(), None
+        if cmsg.code == UBSIPCode.REQ_DEVINFO:
+            return self.build_devinfo_reply(cmsg.body.busid), None
+        if cmsg.code == UBSIPCode.REQ_IMPORT:
+            status, dev = self.claim(cmsg.body.busid, owner)
+            if dev is None:
+                usbip_log.warning("import of %s refused: status %d", cmsg.body.busid, status)
+                return _op_status_reply(UBSIPCode.REP_IMPORT, status), None
+            return self.build_import_reply(dev), dev
+        if cmsg.code == UBSIPCode.REQ_EXPORT:
+            return _op_status_reply(UBSIPCode.REP_EXPORT, ST_NA), None
+        if cmsg.code == UBSIPCode.REQ_UNEXPORT:
+            return _op_status_reply(UBSIPCode.REP_UNEXPORT, ST_NA), None
+        raise NotImplementedError(repr(cmsg.code))
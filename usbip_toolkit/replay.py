@@ -0,0 +1,369 @@
+import errno
+import struct
+import time
+from collections import deque
+
+from usbip_toolkit.capture import (
+    EPB_OUTBOUND,
+    LINKTYPE_USB_2_0,
+    LINKTYPE_USB_LINUX_MMAPPED,
+    USBMON_ISO,
+    UsbmonPacket,
+    iter_pcapng,
+)
+from usbip_toolkit.log import log
+from usbip_toolkit.proto_struct import (
+    StructCodec,
+    build_cmd_submit,
+    parse_command_reply,
+)
+from usbip_toolkit.urb_engine import WAIT, RetryPolicy, URBEngine, URBScheduler
+from usbip_toolkit.usb import PID, token_addr_packet
+
+# Replays a session captured with --capture through the URB engine with no simulator attached.
+# The usbmon submit records become CMD_SUBMITs again and the simulator links supply the device:
+# every recorded response is filed under the token (PID, address, endpoint) it answered and
+# ReplaySim hands them back per token as the engine issues them. On any one endpoint the engine
+# issues the same tokens however the pipes end up interleaved, so the replay stays in step at any
+# speed as long as bulk_window matches the recording. Unlinked URBs are left out; one that was
+# cancelled mid-transfer leaves its responses behind and shows up as mismatches on that endpoint.
+# Isochronous OUT tokens are never answered, the usbmon records say which endpoints those are.
+# Descriptor probing and serving change what goes over the sim link, so like bulk_window they
+# have to be set as they were for the recording.
+
+_TOKEN_PIDS = frozenset((PID.TOK_OUT, PID.TOK_IN, PID.TOK_SETUP, PID.SPC_PING))
+_SET_ADDRESS_TOKEN = token_addr_packet(PID.TOK_SETUP, 0, 0)
+# seqnum in the common header of any USB/IP command or reply
+_hdr_seqnum = struct.Struct(">4xI")
+
+
+def _is_token(buf) -> bool:
+    return len(buf) == 3 and buf[0] & 0xF in _TOKEN_PIDS
+
+
+class RecordedURB:
+    __slots__ = ("busid", "ts_ns", "direction", "length", "cmd", "status", "data")
+
+    def __init__(self, busid, ts_ns, direction, length, cmd, status, data):
+        self.busid = busid
+        # submit time in the recording
+        self.ts_ns = ts_ns
+        self.direction = direction
+        self.length = length
+        # encoded CMD_SUBMIT, numbered in submit order from 1
+        self.cmd = cmd
+        # what the bridge completed it with
+        self.status = status
+        self.data = data
+
+
+class Trace:
+    def __init__(self):
+        # in submit order
+        self.urbs = []
+        # busid -> {token packet: deque of the device's responses to it}
+        self.responses = {}
+        # busid -> tokens the device doesn't answer, those of isochronous OUT endpoints
+        self.silent = {}
+        self.nunlinked = 0
+
+    def __len__(self):
+        return len(self.urbs)
+
+    @property
+    def duration_ns(self) -> int:
+        return self.urbs[-1].ts_ns - self.urbs[0].ts_ns if self.urbs else 0
+
+
+def _sim_busid(name: str) -> str:
+    # the bridges name each sim link "sim <busid>"
+    return name[4:] if name and name.startswith("sim ") else name
+
+
+def load_trace(paths) -> Trace:
+    # paths is a capture file or, for a rotated capture, its files in order
+    if isinstance(paths, str):
+        paths = [paths]
+    trace = Trace()
+    submits = {}
+    completed = []
+    # per sim link, the tokens sent that the device has not answered yet
+    unanswered = {}
+    for path in paths:
+        for linktype, name, ts_ns, flags, data in iter_pcapng(path):
+            if linktype == LINKTYPE_USB_2_0:
+                busid = _sim_busid(name)
+                tokens = unanswered.setdefault(busid, deque())
+                if flags & 3 == EPB_OUTBOUND:
+                    if _is_token(data) and data not in trace.silent.get(busid, ()):
+                        tokens.append(data)
+                elif tokens:
+                    resps = trace.responses.setdefault(busid, {})
+                    resps.setdefault(tokens.popleft(), deque()).append(data)
+            elif linktype == LINKTYPE_USB_LINUX_MMAPPED:
+                pkt = UsbmonPacket(data)
+                if pkt.type == ord("S"):
+                    submits[pkt.id] = ts_ns, pkt
+                    if pkt.xfer_type == USBMON_ISO and not pkt.epnum & 0x80:
+                        busid = f"{pkt.busnum}-{pkt.devnum}.0"
+                        token = token_addr_packet(PID.TOK_OUT, pkt.devnum, pkt.epnum & 0x7F)
+                        trace.silent.setdefault(busid, set()).add(token)
+                elif pkt.type == ord("C"):
+                    entry = submits.pop(pkt.id, None)
+                    if entry is None:
+                        continue
+                    if pkt.status == -errno.ECONNRESET:
+                        trace.nunlinked += 1
+                        continue
+                    completed.append((entry[0], entry[1], pkt))
+    # still pending when the client went away
+    trace.nunlinked += len(submits)
+    completed.sort(key=lambda c: c[0])
+    for seqnum, (ts_ns, sub, ret) in enumerate(completed, 1):
+        direction = sub.epnum >> 7
+        cmd = build_cmd_submit(
+            seqnum,
+            sub.busnum,
+            sub.devnum,
+            direction,
+            sub.epnum & 0x7F,
+            sub.length,
+            setup=sub.setup,
+            transfer_buffer=b"" if direction else sub.data,
+            transfer_flags=sub.xfer_flags,
+            interval=sub.interval,
+            start_frame=sub.start_frame,
+            iso_packet_descriptor=sub.iso,
+        )
+        trace.urbs.append(
+            RecordedURB(
+                f"{sub.busnum}-{sub.devnum}.0",
+                ts_ns,
+                direction,
+                sub.length,
+                cmd,
+                ret.status,
+                ret.data,
+            )
+        )
+    return trace
+
+
+class ReplaySim:
+    # stands in for one device's simulator, answering each token with the next response
+    # recorded for it
+
+    def __init__(self, responses: dict, silent=()):
+        self.responses = {token: deque(resps) for token, resps in responses.items()}
+        self.silent = frozenset(silent)
+
+    @property
+    def has_set_address(self) -> bool:
+        return _SET_ADDRESS_TOKEN in self.responses
+
+    def exchange(self, bufs, nresp: int) -> list:
+        resps = []
+        for buf in bufs:
+            if _is_token(buf) and buf not in self.silent:
+                pending = self.responses.get(bytes(buf))
+                if not pending:
+                    raise ValueError(f"replay diverged, nothing recorded for token {buf.hex(' ')}")
+                resps.append(pending.popleft())
+        if len(resps) != nresp:
+            raise ValueError(f"replay diverged, engine wants {nresp} responses to {len(resps)}")
+        return resps
+
+
+def _run_alone(gen, sim):
+    # drives an engine generator that runs before any URB, as a bridge's probe does
+    resps = None
+    try:
+        while True:
+            bufs, nresp = gen.send(resps)
+            resps = [] if bufs is WAIT else sim.exchange(bufs, nresp)
+    except StopIteration as e:
+        return e.value
+
+
+class _ReplayDevice:
+    __slots__ = ("sched", "sim", "inflight")
+
+    def __init__(self, sched, sim):
+        self.sched = sched
+        self.sim = sim
+        self.inflight = 0
+
+
+class ReplayReport:
+    def __init__(self, codec, bulk_window, speed, elapsed_ns, latencies_ns, nbytes, mismatches):
+        self.codec = codec
+        self.bulk_window = bulk_window
+        self.speed = speed
+        self.elapsed_ns = elapsed_ns
+        self.latencies_ns = latencies_ns
+        self.nbytes = nbytes
+        self.mismatches = mismatches
+
+    @property
+    def urbs_per_sec(self) -> float:
+        return len(self.latencies_ns) * 1e9 / self.elapsed_ns if self.elapsed_ns else 0.0
+
+    @property
+    def mb_per_sec(self) -> float:
+        return self.nbytes * 1e9 / self.elapsed_ns / (1024 * 1024) if self.elapsed_ns else 0.0
+
+    def percentile(self, pct: float) -> int:
+        lats = sorted(self.latencies_ns)
+        if not lats:
+            return 0
+        return lats[min(len(lats) - 1, int(len(lats) * pct / 100))]
+
+    def histogram(self) -> list:
+        # -> [(lo_us, hi_us, count)], power of two microsecond buckets from the fastest URB's
+        # to the slowest's
+        counts = {}
+        for ns in self.latencies_ns:
+            b = (ns // 1000).bit_length()
+            counts[b] = counts.get(b, 0) + 1
+        if not counts:
+            return []
+        return [
+            (1 << b >> 1, 1 << b, counts.get(b, 0)) for b in range(min(counts), max(counts) + 1)
+        ]
+
+    def as_dict(self) -> dict:
+        return {
+            "codec": self.codec,
+            "bulk_window": self.bulk_window,
+            "speed": self.speed,
+            "urbs": len(self.latencies_ns),
+            "bytes": self.nbytes,
+            "elapsed_s": self.elapsed_ns / 1e9,
+            "urbs_per_sec": self.urbs_per_sec,
+            "mb_per_sec": self.mb_per_sec,
+            "mismatches": self.mismatches,
+            "latency_us": {f"p{pct}": self.percentile(pct) / 1000 for pct in (50, 90, 99, 100)},
+            "latency_histogram_us": [
+                {"lo": lo, "hi": hi, "count": n} for lo, hi, n in self.histogram()
+            ],
+        }
+
+    def format(self) -> str:
+        lines = [
+            f"{len(self.latencies_ns)} URBs, {self.nbytes} bytes in {self.elapsed_ns / 1e9:.3f} s"
+            f" (codec {self.codec}, bulk window {self.bulk_window}, "
+            + (f"speed {self.speed:g}x)" if self.speed else "max speed)"),
+            f"{self.urbs_per_sec:.0f} URBs/s, {self.mb_per_sec:.2f} MB/s, "
+            f"{self.mismatches} mismatches",
+            "latency us: "
+            + " ".join(f"p{pct} {self.percentile(pct) / 1000:.1f}" for pct in (50, 90, 99, 100)),
+        ]
+        hist = self.histogram()
+        peak = max((n for _, _, n in hist), default=0)
+        for lo, hi, n in hist:
+            bar = "#" * (-(-40 * n // peak) if peak else 0)
+            lines.append(f"{lo:>8}-{hi:<8} us {n:>8} {bar}")
+        return "\n".join(lines)
+
+
+def replay(
+    trace: Trace,
+    codec=StructCodec,
+    bulk_window: int = 1,
+    speed: float = 0.0,
+    depth: int = 32,
+    ping: bool = True,
+    probe_descriptors: bool = False,
+    serve_descriptors: bool = False,
+) -> ReplayReport:
+    # speed 0 submits every URB as soon as its device has fewer than depth in flight, otherwise
+    # URBs are submitted at the recorded pace divided by speed. Latency is submit to RET_SUBMIT.
+    # Recorded NAKs are retried without backing off, the device's answers are already known.
+    retry = RetryPolicy(backoff_min=0, ping=ping)
+    devs = {}
+    for urb in trace.urbs:
+        if urb.busid in devs:
+            continue
+        if urb.busid not in trace.responses:
+            raise ValueError(f"trace has no simulator link for {urb.busid}")
+        busnum, devnum = map(int, urb.busid[:-2].split("-"))
+        engine = URBEngine(
+            codec,
+            busnum,
+            devnum,
+            bulk_window=bulk_window,
+            retry=retry,
+            serve_descriptors=serve_descriptors,
+        )
+        sim = ReplaySim(trace.responses[urb.busid], trace.silent.get(urb.busid, ()))
+        if not sim.has_set_address:
+            # recorded after the bridge had already addressed the device
+            engine._setup_addr_done = True
+        if probe_descriptors:
+            _run_alone(engine.probe(), sim)
+        devs[urb.busid] = _ReplayDevice(URBScheduler(engine), sim)
+    active = list(devs.values())
+    urbs = trace.urbs
+    n = len(urbs)
+    submitted = [0] * n
+    latencies = [0] * n
+    rets = [None] * n
+    ts0 = urbs[0].ts_ns if n else 0
+    i = 0
+    ndone = 0
+    start = time.perf_counter_ns()
+    while ndone < n:
+        now = time.perf_counter_ns()
+        while i < n:
+            urb = urbs[i]
+            if speed and start + (urb.ts_ns - ts0) / speed > now:
+                break
+            dev = devs[urb.busid]
+            if depth and dev.inflight >= depth:
+                break
+            dev.sched.submit(codec.parse_cmd(urb.cmd))
+            dev.inflight += 1
+            submitted[i] = now
+            i += 1
+        idle = True
+        for dev in active:
+            if not dev.sched.busy:
+                continue
+            idle = False
+            bufs, nresp, done = dev.sched.step()
+            if bufs:
+                resps = dev.sim.exchange(bufs, nresp)
+                if nresp:
+                    dev.sched.responses(resps)
+            if done:
+                now = time.perf_counter_ns()
+                for ret in done:
+                    idx = _hdr_seqnum.unpack_from(ret)[0] - 1
+                    latencies[idx] = now - submitted[idx]
+                    rets[idx] = ret
+                dev.inflight -= len(done)
+                ndone += len(done)
+        if idle and i < n and speed:
+            # nothing to do until the next URB is due
+            due = start + (urbs[i].ts_ns - ts0) / speed
+            time.sleep(max(0.0, due - time.perf_counter_ns()) / 1e9)
+    elapsed = time.perf_counter_ns() - start
+    nbytes = 0
+    mismatches = 0
+    for urb, ret in zip(urbs, rets):
+        body = parse_command_reply(ret, urb.direction).body
+        nbytes += len(body.transfer_buffer) if urb.direction else urb.length
+        if body.status != urb.status or (urb.direction and body.transfer_buffer != urb.data):
+            mismatches += 1
+            if mismatches <= 10:
+                log.warning(
+                    "replayed URB %d (%s) completed with status %d and %d bytes, recorded %d "
+                    "and %d bytes",
+                    _hdr_seqnum.unpack_from(urb.cmd)[0],
+                    urb.busid,
+                    body.status,
+                    len(body.transfer_buffer),
+                    urb.status,
+                    len(urb.data),
+                )
+    return ReplayReport(codec.name, bulk_window, speed, elapsed, latencies, nbytes, mismatches)
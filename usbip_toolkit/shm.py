@@ -0,0 +1,421 @@
+import mmap
+import os
+import select
+import socket
+import struct
+import tempfile
+import time
+from threading import Lock
+
+# A shared-memory sim link for a simulator on the same host as the bridge. The packets are
+# framed exactly as on the TCP link, a 4 byte big-endian length and the packet, but they go
+# through two single-producer/single-consumer byte rings in one shared mapping, h2d and d2h.
+# A busy link moves packets with memory copies alone; a side only makes a syscall to sleep
+# when its ring is empty (or full) and the other side only makes one to wake it, by ringing
+# the doorbell of a ring whose waiting flag is set. Doorbells are eventfds, or pipes where
+# there is no eventfd.
+#
+# The bridge listens on a unix socket path. A simulator that connects is sent a hello and, as
+# SCM_RIGHTS, the shared memory and doorbell fds; the socket then stays open only so either
+# side notices when the other goes away.
+#
+# Each ring has a control block of 64 bit words, each on its own cache line: tail (bytes
+# written, the producer's), head (bytes read, the consumer's) and the waiting flags. Records
+# are only published whole, by storing tail after the copy. That ordering, and single
+# aligned 8 byte stores through a memoryview, are what x86-64 gives; it is the platform this
+# is meant for.
+
+SHM_MAGIC = b"UTSM"
+SHM_VERSION = 1
+DEFAULT_RING_SIZE = 1 << 20
+# checks of an empty ring before going to sleep on its doorbell, pointless with one CPU
+DEFAULT_SPIN = 200 if (os.cpu_count() or 1) > 1 else 0
+
+_len_prefix = struct.Struct(">I")
+# magic, version, doorbell kind, ring size
+_hello = struct.Struct(">4sHHI")
+_BELL_EVENTFD = 0
+_BELL_PIPE = 1
+# control block words, a ring's block is _CTRL_WORDS words
+_TAIL = 0
+_HEAD = 8
+_CONSUMER_WAITING = 16
+_PRODUCER_WAITING = 24
+_CTRL_WORDS = 32
+_DATA_OFF = 4096
+# how long a side sleeps before looking at its ring again, in case a wakeup was missed
+_WAIT_TIMEOUT = 0.01
+
+# Acquiring a lock is a locked instruction, the only full memory fence Python code can get
+# at. Between setting a waiting flag and checking the ring once more it keeps the flag's
+# store from passing the load, the other side would miss the flag otherwise.
+_fence_lock = Lock()
+
+
+def _fence():
+    with _fence_lock:
+        pass
+
+
+class _EventfdBell:
+    kind = _BELL_EVENTFD
+    nfds = 1
+
+    def __init__(self, fds=None):
+        self.fd = fds[0] if fds is not None else os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+
+    def fds(self) -> list:
+        return [self.fd]
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def ring(self):
+        os.eventfd_write(self.fd, 1)
+
+    def clear(self):
+        try:
+            os.eventfd_read(self.fd)
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _PipeBell:
+    kind = _BELL_PIPE
+    nfds = 2
+
+    def __init__(self, fds=None):
+        self.rfd, self.wfd = fds if fds is not None else os.pipe()
+        os.set_blocking(self.rfd, False)
+        os.set_blocking(self.wfd, False)
+
+    def fds(self) -> list:
+        return [self.rfd, self.wfd]
+
+    def fileno(self) -> int:
+        return self.rfd
+
+    def ring(self):
+        try:
+            os.write(self.wfd, b"\0")
+        except BlockingIOError:
+            # a full pipe is rung already
+            pass
+
+    def clear(self):
+        try:
+            while os.read(self.rfd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+
+_BELLS = {_BELL_EVENTFD: _EventfdBell, _BELL_PIPE: _PipeBell}
+
+
+def _default_bell():
+    return _EventfdBell if hasattr(os, "eventfd") else _PipeBell
+
+
+class ShmRing:
+    # one direction of the link, the producer end uses put() and the consumer end get()
+
+    def __init__(self, mem, index: int, size: int, data_bell, space_bell):
+        if size & (size - 1):
+            raise ValueError(f"ring size {size} is not a power of two")
+        self.size = size
+        self.mask = size - 1
+        base = index * _CTRL_WORDS
+        self._ctrl = memoryview(mem)[:_DATA_OFF].cast("Q")
+        self._tail = base + _TAIL
+        self._head = base + _HEAD
+        self._consumer_waiting = base + _CONSUMER_WAITING
+        self._producer_waiting = base + _PRODUCER_WAITING
+        off = _DATA_OFF + index * size
+        self._data = memoryview(mem)[off : off + size]
+        # rung by the producer when there is data, by the consumer when there is space
+        self.data_bell = data_bell
+        self.space_bell = space_bell
+
+    def __len__(self):
+        # bytes in the ring
+        return self._ctrl[self._tail] - self._ctrl[self._head]
+
+    def release(self):
+        # drops the views so the mapping can be closed
+        self._ctrl.release()
+        self._data.release()
+
+    def _write(self, pos: int, buf):
+        i = pos & self.mask
+        n = len(buf)
+        first = self.size - i
+        if n <= first:
+            self._data[i : i + n] = buf
+        else:
+            buf = memoryview(buf)
+            self._data[i:] = buf[:first]
+            self._data[: n - first] = buf[first:]
+
+    def _read(self, pos: int, n: int) -> bytes:
+        i = pos & self.mask
+        first = self.size - i
+        if n <= first:
+            return bytes(self._data[i : i + n])
+        return bytes(self._data[i:]) + bytes(self._data[: n - first])
+
+    # producer
+
+    def put(self, bufs) -> int:
+        # -> how many of bufs fit and were written, each is a record of its own
+        ctrl = self._ctrl
+        tail = ctrl[self._tail]
+        free = self.size - (tail - ctrl[self._head])
+        n = 0
+        for buf in bufs:
+            need = 4 + len(buf)
+            if need > free:
+                if need > self.size:
+                    raise ValueError(f"{len(buf)} byte packet does not fit a {self.size} byte ring")
+                break
+            self._write(tail, _len_prefix.pack(len(buf)))
+            self._write(tail + 4, buf)
+            tail += need
+            free -= need
+            n += 1
+        if n:
+            ctrl[self._tail] = tail
+            _fence()
+            if ctrl[self._consumer_waiting]:
+                ctrl[self._consumer_waiting] = 0
+                self.data_bell.ring()
+        return n
+
+    def prepare_wait_space(self, need: int = 1) -> bool:
+        # -> True if the producer should sleep on space_bell (and clear it once rung), then call
+        # finish_wait_space()
+        ctrl = self._ctrl
+        ctrl[self._producer_waiting] = 1
+        _fence()
+        if self.size - (ctrl[self._tail] - ctrl[self._head]) >= need:
+            ctrl[self._producer_waiting] = 0
+            return False
+        return True
+
+    def finish_wait_space(self):
+        self._ctrl[self._producer_waiting] = 0
+
+    # consumer
+
+    def get(self):
+        # -> the next packet, None if the ring is empty
+        ctrl = self._ctrl
+        head = ctrl[self._head]
+        if ctrl[self._tail] - head < 4:
+            return None
+        n = _len_prefix.unpack(self._read(head, 4))[0]
+        buf = self._read(head + 4, n)
+        ctrl[self._head] = head + 4 + n
+        _fence()
+        if ctrl[self._producer_waiting]:
+            ctrl[self._producer_waiting] = 0
+            self.space_bell.ring()
+        return buf
+
+    def prepare_wait_data(self) -> bool:
+        # -> True if the consumer should sleep on data_bell (and clear it once rung), then call
+        # finish_wait_data()
+        ctrl = self._ctrl
+        ctrl[self._consumer_waiting] = 1
+        _fence()
+        if ctrl[self._tail] != ctrl[self._head]:
+            ctrl[self._consumer_waiting] = 0
+            return False
+        return True
+
+    def finish_wait_data(self):
+        self._ctrl[self._consumer_waiting] = 0
+
+
+def peer_closed(sock: socket.socket) -> bool:
+    try:
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+    except BlockingIOError:
+        return False
+    except OSError:
+        return True
+
+
+class ShmLink:
+    # one end of a shared-memory sim link: tx is the ring this end produces into, rx the one
+    # it consumes. send() and recv() block and may be called from two different threads.
+
+    def __init__(self, sock: socket.socket, mem: mmap.mmap, tx: ShmRing, rx: ShmRing, bells, spin):
+        self.sock = sock
+        self.mem = mem
+        self.tx = tx
+        self.rx = rx
+        self._bells = bells
+        self.spin = spin
+        self.closed = False
+
+    def fileno(self) -> int:
+        # readable once the other side has gone away
+        return self.sock.fileno()
+
+    def _sleep(self, bell) -> bool:
+        # -> False if the other side has gone away
+        readable, _, _ = select.select([bell, self.sock], [], [], _WAIT_TIMEOUT)
+        if bell in readable:
+            bell.clear()
+        if self.sock in readable and peer_closed(self.sock):
+            self.closed = True
+            return False
+        return True
+
+    def send(self, bufs) -> bool:
+        # -> False if the other side has gone away before all of bufs were written
+        tx = self.tx
+        i = tx.put(bufs)
+        while i < len(bufs):
+            if self.closed:
+                return False
+            if tx.prepare_wait_space(4 + len(bufs[i])):
+                alive = self._sleep(tx.space_bell)
+                tx.finish_wait_space()
+                if not alive:
+                    return False
+            i += tx.put(bufs[i:])
+        return True
+
+    def recv(self):
+        # -> the next packet, None once the other side has gone away
+        rx = self.rx
+        while True:
+            buf = rx.get()
+            if buf is not None:
+                return buf
+            for _ in range(self.spin):
+                if len(rx):
+                    break
+            else:
+                if self.closed:
+                    return None
+                if rx.prepare_wait_data():
+                    alive = self._sleep(rx.data_bell)
+                    rx.finish_wait_data()
+                    if not alive and not len(rx):
+                        return None
+
+    def close(self):
+        if self.mem is None:
+            return
+        self.closed = True
+        self.tx.release()
+        self.rx.release()
+        self.mem.close()
+        self.mem = None
+        for bell in self._bells:
+            bell.close()
+        self.sock.close()
+
+
+def _shared_memory(size: int) -> int:
+    # -> fd of size bytes of anonymous shared memory
+    if hasattr(os, "memfd_create"):
+        fd = os.memfd_create("usbiptk-sim", os.MFD_CLOEXEC)
+    else:
+        shm_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        fd, path = tempfile.mkstemp(prefix="usbiptk-sim-", dir=shm_dir)
+        os.unlink(path)
+    os.ftruncate(fd, size)
+    return fd
+
+
+def _make_link(sock, mem_fd, kind, size, bell_fds, bridge: bool, spin: int) -> ShmLink:
+    # takes ownership of the fds
+    mem = mmap.mmap(mem_fd, _DATA_OFF + 2 * size)
+    os.close(mem_fd)
+    cls = _BELLS[kind]
+    bells = [cls(bell_fds[i * cls.nfds : (i + 1) * cls.nfds]) for i in range(4)]
+    h2d = ShmRing(mem, 0, size, bells[0], bells[1])
+    d2h = ShmRing(mem, 1, size, bells[2], bells[3])
+    if bridge:
+        return ShmLink(sock, mem, h2d, d2h, bells, spin)
+    return ShmLink(sock, mem, d2h, h2d, bells, spin)
+
+
+def shm_path(path: str, i: int) -> str:
+    # where device i of a bridge listens, like sim port + i
+    return path if i == 0 else f"{path}.{i}"
+
+
+class ShmListener:
+    # the bridge end, one simulator at a time connects to path
+
+    def __init__(self, path: str, ring_size: int = DEFAULT_RING_SIZE, spin: int = DEFAULT_SPIN):
+        if ring_size & (ring_size - 1) or ring_size < 4096:
+            raise ValueError(f"ring size {ring_size} is not a power of two of at least 4096")
+        self.path = path
+        self.ring_size = ring_size
+        self.spin = spin
+        if os.path.exists(path):
+            # left behind by an earlier bridge
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(1)
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def accept(self) -> ShmLink:
+        conn, _ = self.sock.accept()
+        return self.attach(conn)
+
+    def attach(self, conn: socket.socket) -> ShmLink:
+        # sets up the link over a connection accepted from sock
+        conn.setblocking(True)
+        bell_cls = _default_bell()
+        mem_fd = _shared_memory(_DATA_OFF + 2 * self.ring_size)
+        bell_fds = [fd for _ in range(4) for fd in bell_cls().fds()]
+        hello = _hello.pack(SHM_MAGIC, SHM_VERSION, bell_cls.kind, self.ring_size)
+        socket.send_fds(conn, [hello], [mem_fd] + bell_fds)
+        return _make_link(conn, mem_fd, bell_cls.kind, self.ring_size, bell_fds, True, self.spin)
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def shm_connect(path: str, timeout: float = 10.0, spin: int = DEFAULT_SPIN) -> ShmLink:
+    # the simulator end: connects to a bridge's shm path, retrying until it is listening
+    deadline = time.monotonic() + timeout
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            break
+        except (FileNotFoundError, ConnectionRefusedError):
+            sock.close()
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+    msg, fds, _, _ = socket.recv_fds(sock, _hello.size, 1 + 4 * _PipeBell.nfds)
+    magic, version, kind, size = _hello.unpack(msg)
+    if magic != SHM_MAGIC or version != SHM_VERSION or kind not in _BELLS:
+        for fd in fds:
+            os.close(fd)
+        sock.close()
+        raise ConnectionError(f"{path} is not a usbiptk shm sim link (version {version})")
+    return _make_link(sock, fds[0], kind, size, fds[1:], False, spin)
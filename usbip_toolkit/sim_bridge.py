@@ -1,64 +1,480 @@
 import asyncio
-from collections import namedtuple
-from itertools import count
-
-import reactivex as rx
-import reactivex.operators as ops
-from reactivex.scheduler.eventloop import AsyncIOScheduler
-from reactivex.subject import Subject
+import errno
+import struct
+import threading
+from collections import deque
 
+from usbip_toolkit.log import DEBUG, LazyHex, log, sim_log, usbip_log
+from usbip_toolkit.metrics import URBMetrics
 from usbip_toolkit.proto import *
+from usbip_toolkit.proto_struct import StructCodec
+from usbip_toolkit.registry import DeviceRegistry, ExportedDevice
+from usbip_toolkit.shm import ShmListener, peer_closed
+from usbip_toolkit.transport import Endpoint, parse_endpoint, start_server, tcp_endpoint
+from usbip_toolkit.urb_engine import WAIT, URBEngine, URBScheduler
+from usbip_toolkit.usb import USB_SPEED_HIGH
 
-EchoItem = namedtuple("EchoItem", ["future", "data"])
+_len_prefix = struct.Struct(">I")
+# how long to sleep on a shared-memory ring before looking again, in case a wakeup was missed
+_SHM_WAIT_TIMEOUT = 0.01
 
 
-class USBIPSimBridgeServer:
-    def __init__(self, usbip_port: int = 3240, sim_port: int = 2443):
-        self.usbip_port = usbip_port
-        self.sim_port = sim_port
-        self.counter = count()
-
-    def serve(self):
-        loop = asyncio.get_event_loop()
-        proxy = Subject()
-        source = self.tcp_echo_server(proxy, loop)
-        aio_scheduler = AsyncIOScheduler(loop=loop)
-
-        source.pipe(ops.map(lambda i: i._replace(data="echo: {}".format(i.data)))).subscribe(
-            proxy, scheduler=aio_scheduler
-        )
+class SimBackend:
+    # one simulator connection and the URB engine for the device behind it
+    def __init__(
+        self,
+        endpoint: Endpoint,
+        engine: URBEngine,
+        capture=None,
+        name: str = None,
+        probe: bool = False,
+    ):
+        self.endpoint = endpoint
+        self.name = name or f"sim {endpoint}"
+        self.engine = engine
+        # read the device's descriptors as soon as the simulator connects
+        self.probe = probe
+        self.capture = capture
+        self.capture_iface = None
+        if capture is not None:
+            self.capture_iface = capture.add_sim_link(self.name)
+        self.reader = None
+        self.writer = None
+        self.connected = None
+        self.server = None
+        # the importing connection's scheduler and writer, while there is one
+        self.sched = None
+        self.client_writer = None
 
-        loop.run_forever()
-        print("done")
-        loop.close()
-
-    def tcp_echo_server(self, sink, loop):
-        def on_subscribe(observer, scheduler):
-            async def handle_echo(reader, writer):
-                print("new client connected")
-                while True:
-                    data = await reader.readline()
-                    data = data.decode("utf-8")
-                    if not data:
-                        break
+    def register_metrics(self, metrics: URBMetrics):
+        metrics.queue_gauge("urbs", lambda: len(self.sched) if self.sched is not None else 0)
+        metrics.write_buffer_gauge("sim", self.write_buffer_size)
+        metrics.write_buffer_gauge("usbip", lambda: _write_buffer_size(self.client_writer))
 
-                    future = asyncio.Future()
-                    observer.on_next(EchoItem(future=future, data=data))
-                    await future
-                    writer.write(future.result().encode("utf-8"))
+    async def start(self):
+        self.connected = asyncio.Event()
+        self.server = await start_server(self.on_connection, self.endpoint)
+        return self.server
 
-                print("Close the client socket")
+    async def on_connection(self, reader, writer):
+        if self.connected.is_set():
+            if not self.reader.at_eof():
+                sim_log.warning("rejecting second sim client connection on %s", self.endpoint)
                 writer.close()
+                return
+            # the last one closed its end while no URB was waiting on it
+            self.link_closed()
+        sim_log.info("got sim client connection on %s", self.endpoint)
+        self.endpoint.tune(writer.get_extra_info("socket"))
+        self.reader = reader
+        self.writer = writer
+        await self.attached()
+
+    async def attached(self):
+        if self.probe:
+            try:
+                await self.run(self.engine.probe())
+            except Exception:
+                sim_log.warning("probing the device of %s failed", self.name, exc_info=True)
+        self.connected.set()
+
+    def link_closed(self):
+        # the simulator went away, the next one to connect brings up a fresh device
+        if not self.connected.is_set():
+            return
+        sim_log.info("sim client of %s went away", self.name)
+        self.connected.clear()
+        self.engine.reset_device()
+        if self.writer is not None:
+            self.writer.close()
+
+    async def run(self, gen):
+        # drives one engine generator to the end on its own, nothing else may use the link
+        resps = None
+        while True:
+            try:
+                bufs, nresp = gen.send(resps)
+            except StopIteration as e:
+                return e.value
+            resps = []
+            if bufs is WAIT:
+                await asyncio.sleep(nresp)
+                continue
+            if bufs:
+                self.write(bufs)
+            if nresp:
+                await self.drain()
+                resps = [await self.read() for _ in range(nresp)]
+
+    def write(self, bufs):
+        if sim_log.isEnabledFor(DEBUG):
+            for buf in bufs:
+                sim_log.debug("h2d_raw: %s", LazyHex(buf))
+        if self.capture is not None:
+            self.capture.sim_h2d(self.capture_iface, bufs)
+        self._write(bufs)
+
+    def _write(self, bufs):
+        iov = []
+        for buf in bufs:
+            iov.append(_len_prefix.pack(len(buf)))
+            iov.append(buf)
+        self.writer.writelines(iov)
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def write_buffer_size(self) -> int:
+        return _write_buffer_size(self.writer)
+
+    async def _read(self):
+        nbytes = _len_prefix.unpack(await self.reader.readexactly(4))[0]
+        return await self.reader.readexactly(nbytes)
+
+    async def read(self):
+        while True:
+            buf = await self._read()
+            if len(buf) > 64 and not any(buf):
+                continue
+            if self.capture is not None:
+                self.capture.sim_d2h(self.capture_iface, buf)
+            if sim_log.isEnabledFor(DEBUG):
+                sim_log.debug("d2h_raw: %s", LazyHex(buf))
+            return buf
+
+
+async def _wait_any(*events):
+    waits = [asyncio.ensure_future(event.wait()) for event in events]
+    try:
+        await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for w in waits:
+            w.cancel()
+
+
+def _write_buffer_size(writer) -> int:
+    return writer.transport.get_write_buffer_size() if writer is not None else 0
+
+
+class ShmSimBackend(SimBackend):
+    # a SimBackend whose simulator connects to a shared-memory link, at an shm: endpoint.
+    # The doorbells stay registered with the event loop while a simulator is connected, so
+    # waiting on an empty (or full) ring costs no more than the wakeup itself.
+
+    def __init__(
+        self,
+        endpoint: Endpoint,
+        engine: URBEngine,
+        capture=None,
+        name: str = None,
+        probe: bool = False,
+    ):
+        super().__init__(endpoint, engine, capture, name, probe)
+        self.path = endpoint.path
+        self.listener = None
+        self.link = None
+        self._wakeup = None
+        # packets that did not fit the h2d ring yet, in order
+        self._pending = deque()
+
+    async def start(self):
+        self.connected = asyncio.Event()
+        self._wakeup = asyncio.Event()
+        self.listener = ShmListener(self.path)
+        self.listener.sock.setblocking(False)
+        return self
 
-            def on_next(i):
-                i.future.set_result(i.data)
+    async def serve_forever(self):
+        loop = asyncio.get_running_loop()
+        sim_log.info("waiting for sim client connection on %s", self.endpoint)
+        while True:
+            conn, _ = await loop.sock_accept(self.listener.sock)
+            if self.link is not None and not self.link.closed:
+                sim_log.warning("rejecting second sim client connection on %s", self.endpoint)
+                conn.close()
+                continue
+            if self.link is not None:
+                self.link.close()
+                self._pending.clear()
+            sim_log.info("got sim client connection on %s", self.endpoint)
+            link = self.link = self.listener.attach(conn)
+            loop.add_reader(link.rx.data_bell.fileno(), self._bell_rung, link.rx.data_bell)
+            loop.add_reader(link.tx.space_bell.fileno(), self._bell_rung, link.tx.space_bell)
+            loop.add_reader(link.fileno(), self._peer_readable)
+            await self.attached()
 
-            print("starting server")
-            server = asyncio.start_server(handle_echo, "127.0.0.1", 8888)
-            loop.create_task(server)
+    def _bell_rung(self, bell):
+        # doorbells are level triggered, left rung they would keep the loop spinning
+        bell.clear()
+        self._wakeup.set()
 
-            sink.subscribe(
-                on_next=on_next, on_error=observer.on_error, on_completed=observer.on_completed
+    def _peer_readable(self):
+        if not peer_closed(self.link.sock):
+            return
+        loop = asyncio.get_running_loop()
+        loop.remove_reader(self.link.rx.data_bell.fileno())
+        loop.remove_reader(self.link.tx.space_bell.fileno())
+        loop.remove_reader(self.link.fileno())
+        self.link.closed = True
+        self._wakeup.set()
+        self.link_closed()
+
+    async def _wait(self, prepare, finish):
+        self._wakeup.clear()
+        if prepare():
+            timeout = asyncio.get_running_loop().call_later(_SHM_WAIT_TIMEOUT, self._wakeup.set)
+            await self._wakeup.wait()
+            timeout.cancel()
+            finish()
+
+    def _write(self, bufs):
+        if self._pending:
+            self._pending.extend(bufs)
+            return
+        n = self.link.tx.put(bufs)
+        if n < len(bufs):
+            self._pending.extend(bufs[n:])
+
+    async def drain(self):
+        tx = self.link.tx
+        pending = self._pending
+        while pending:
+            n = tx.put(pending)
+            for _ in range(n):
+                pending.popleft()
+            if pending:
+                if self.link.closed:
+                    raise ConnectionResetError(f"sim client of {self.name} went away")
+                await self._wait(
+                    lambda: tx.prepare_wait_space(4 + len(pending[0])), tx.finish_wait_space
+                )
+
+    def write_buffer_size(self) -> int:
+        if self.link is None or self.link.mem is None:
+            return 0
+        return len(self.link.tx) + sum(map(len, self._pending))
+
+    async def _read(self):
+        rx = self.link.rx
+        while True:
+            buf = rx.get()
+            if buf is not None:
+                return buf
+            if self.link.closed:
+                raise ConnectionResetError(f"sim client of {self.name} went away")
+            await self._wait(rx.prepare_wait_data, rx.finish_wait_data)
+
+
+class USBIPSimBridgeServer:
+    def __init__(
+        self,
+        usbip_port: int = 3240,
+        sim_port: int = 2443,
+        codec=StructCodec,
+        verify: bool = False,
+        bulk_window: int = 1,
+        retry=None,
+        num_devices: int = 1,
+        busnum: int = 47,
+        devnum: int = 6,
+        capture=None,
+        metrics=None,
+        probe_descriptors: bool = False,
+        serve_descriptors: bool = False,
+        usbip_endpoint=None,
+        sim_endpoint=None,
+        speed: int = USB_SPEED_HIGH,
+    ):
+        # endpoints are URLs or transport.Endpoints, by default TCP on localhost at the ports
+        self.usbip_endpoint = parse_endpoint(
+            usbip_endpoint or tcp_endpoint("localhost", usbip_port)
+        )
+        sim_endpoint = parse_endpoint(sim_endpoint or tcp_endpoint("localhost", sim_port))
+        self.codec = codec
+        self.verify = verify
+        self.loop = None
+        self._loop_ready = threading.Event()
+        # a CaptureTap, or None to not capture
+        self.capture = capture
+        # a MetricsRegistry, or None to not instrument
+        self.metrics = metrics
+        # device i is at busid {busnum}-{devnum + i}.0 and its simulator connects to
+        # sim_endpoint.nth(i), the endpoint's port + i or PATH.i
+        self.registry = DeviceRegistry()
+        for i in range(num_devices):
+            dev = ExportedDevice(busnum, devnum + i, speed=speed)
+            urb_metrics = URBMetrics(metrics, dev.busid) if metrics is not None else None
+            engine = URBEngine(
+                codec,
+                busnum,
+                devnum + i,
+                bulk_window=bulk_window,
+                metrics=urb_metrics,
+                retry=retry,
+                serve_descriptors=serve_descriptors,
+                speed=speed,
+            )
+            backend_cls = ShmSimBackend if sim_endpoint.scheme == "shm" else SimBackend
+            dev.backend = backend_cls(
+                sim_endpoint.nth(i), engine, capture, f"sim {dev.busid}", probe_descriptors
             )
+            dev.descriptors = engine.descriptors
+            if urb_metrics is not None:
+                dev.backend.register_metrics(urb_metrics)
+            self.registry.add(dev)
+
+    def serve(self, listen: bool = True):
+        # with listen False usbip clients only come in through adopt()
+        log.info("server running")
+        asyncio.run(self.serve_async(listen))
+        log.info("server done")
+
+    async def serve_async(self, listen: bool = True):
+        self.loop = asyncio.get_running_loop()
+        self._loop_ready.set()
+        servers = [await dev.backend.start() for dev in self.registry]
+        if listen:
+            servers.append(await start_server(self.on_usbip_connection, self.usbip_endpoint))
+        log.info("waiting for sim and usbip client connections, exporting %d", len(self.registry))
+        await asyncio.gather(*(server.serve_forever() for server in servers))
+
+    def adopt(self, sock, addr=None):
+        # a usbip client connection accepted elsewhere, its op request not read yet. Thread
+        # safe, waits for serve() to get the loop going.
+        self._loop_ready.wait()
+        asyncio.run_coroutine_threadsafe(self._adopt(sock), self.loop)
+
+    async def _adopt(self, sock):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        await self.on_usbip_connection(reader, writer)
+
+    async def pump_urbs(self, sim, sched, wakeup, closing, writer, conn):
+        # URBs wait for a simulator to connect, and fail with ESHUTDOWN when it goes away
+        while True:
+            connected = sim.connected.is_set()
+            if not (sched.busy and connected):
+                if closing.is_set():
+                    # without a simulator what is left has nothing to unwind against
+                    return
+                wakeup.clear()
+                if connected:
+                    await wakeup.wait()
+                else:
+                    await _wait_any(wakeup, sim.connected)
+                continue
+            bufs, nresp, done = sched.step()
+            if bufs:
+                sim.write(bufs)
+            for smsg in done:
+                if self.capture is not None:
+                    self.capture.usbip_ret(conn, smsg)
+                writer.write(smsg)
+            if nresp:
+                try:
+                    await sim.drain()
+                    resps = [await sim.read() for _ in range(nresp)]
+                except (asyncio.IncompleteReadError, ConnectionError) as e:
+                    sim_log.warning("lost sim client of %s: %r", sim.name, e)
+                    sim.link_closed()
+                    failed = sched.fail_all(-errno.ESHUTDOWN)
+                    for smsg in failed:
+                        if self.capture is not None:
+                            self.capture.usbip_ret(conn, smsg)
+                        writer.write(smsg)
+                    done += failed
+                else:
+                    sched.responses(resps)
+            if done and not closing.is_set():
+                await writer.drain()
+            if not (bufs or done):
+                # every pipe is backing off from a NAKing device
+                delay = sched.delay()
+                if delay > 0:
+                    wakeup.clear()
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+
+    async def on_usbip_connection(self, reader, writer):
+        usbip_log.info("got usbip client connection from %s", writer.get_extra_info("peername"))
+        self.usbip_endpoint.tune(writer.get_extra_info("socket"))
+        dev = None
+        pump = None
+        conn = self.capture.new_connection() if self.capture is not None else None
+        try:
+            while True:
+                try:
+                    cmsg, cmsg_ty = await read_usbip_client_packet_async(
+                        reader, self.codec, self.verify
+                    )
+                except ValueError as e:
+                    usbip_log.warning("bad packet from usbip client: %s", e)
+                    break
+                if cmsg is None:
+                    break
+                usbip_log.debug("usbip read: cmsg_ty: %s cmsg: %s", cmsg_ty, cmsg)
+                if (
+                    self.capture is not None
+                    and cmsg_ty == USBIPClientPacketType.USBIPCommandRequest
+                ):
+                    self.capture.usbip_cmd(conn, cmsg)
+                if cmsg_ty == USBIPClientPacketType.USBIPOperationRequest:
+                    if dev is not None:
+                        usbip_log.warning("op request %s after import of %s", cmsg.code, dev.busid)
+                        break
+                    reply, dev = self.registry.handle_op(cmsg, writer)
+                    writer.write(reply)
+                    await writer.drain()
+                    if dev is None:
+                        break
+                    usbip_log.info("usbip client imported %s", dev.busid)
+                    sim = dev.backend
+                    sched = URBScheduler(sim.engine)
+                    sim.sched = sched
+                    sim.client_writer = writer
+                    wakeup = asyncio.Event()
+                    closing = asyncio.Event()
+                    pump = asyncio.create_task(
+                        self.pump_urbs(sim, sched, wakeup, closing, writer, conn)
+                    )
+                elif dev is None:
+                    usbip_log.warning("usbip client sent a command before importing a device")
+                    break
+                elif cmsg.command == UBSIPCommandEnum.CMD_SUBMIT:
+                    sched.submit(cmsg)
+                    wakeup.set()
+                elif cmsg.command == UBSIPCommandEnum.CMD_UNLINK:
+                    status = -errno.ECONNRESET if sched.cancel(cmsg.body.seqnum) else 0
+                    smsg = self.codec.build_ret_unlink(cmsg, status=status)
+                    if self.capture is not None:
+                        self.capture.usbip_ret(conn, smsg)
+                    writer.write(smsg)
+                    await writer.drain()
+                    # a cancelled head URB still needs a step to unwind
+                    wakeup.set()
+        finally:
+            try:
+                if pump is not None:
+                    # let in-flight transactions finish so the sim stream stays in sync for
+                    # the next client that imports this device
+                    sched.cancel_all()
+                    closing.set()
+                    wakeup.set()
+                    await pump
+            except Exception:
+                usbip_log.warning("URB pump of %s failed", dev.busid, exc_info=True)
+            finally:
+                if dev is not None:
+                    dev.backend.sched = None
+                    dev.backend.client_writer = None
+                    self.registry.release(dev, writer)
+                if self.capture is not None:
+                    self.capture.usbip_closed(conn)
+                usbip_log.info("usbip client closed socket")
+                writer.close()
+
 
-        return rx.create(on_subscribe)
+if __name__ == "__main__":
+    sim = USBIPSimBridgeServer()
+    sim.serve()
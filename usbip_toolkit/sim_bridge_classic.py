@@ -1,358 +1,738 @@
+import errno
 import socket
+import struct
 import sys
 import time
 from queue import Empty, Queue
-from threading import Thread
+from threading import Condition, Event, Thread
 
+from usbip_toolkit.log import DEBUG, LazyHex, log, sim_log, usbip_log
+from usbip_toolkit.metrics import URBMetrics
 from usbip_toolkit.proto import *
+from usbip_toolkit.proto_struct import StructCodec, parse_cmd_common_hdr
+from usbip_toolkit.registry import DeviceRegistry, ExportedDevice
+from usbip_toolkit.shm import ShmListener
+from usbip_toolkit.transport import (
+    Endpoint,
+    parse_endpoint,
+    server_socket,
+    tcp_endpoint,
+)
+from usbip_toolkit.urb_engine import URBEngine, URBScheduler, run_urb
 from usbip_toolkit.usb import *
-from usbip_toolkit.util import get_tcp_server_socket
-
-# real_print = print
-# print = lambda *args, **kwargs: real_print(*args, **kwargs, flush=True)
+from usbip_toolkit.util import recv_exact, sendmsg_all
+
+_len_prefix = struct.Struct(">I")
+# how long URBs waiting for a simulator to connect go without looking for client packets
+_SIM_WAIT_TIMEOUT = 0.01
+# what a URB costs beyond its data, the command header and struct overhead roughly
+_URB_OVERHEAD = 48
+
+
+def urb_nbytes(urb) -> int:
+    # -> what a CMD_SUBMIT holds on to while it is in flight: the OUT data it carries and any
+    # iso packet descriptors both ways. The IN data is only charged once its reply exists.
+    nbytes = _URB_OVERHEAD
+    if urb.direction == 0:
+        nbytes += urb.body.transfer_buffer_length
+    iso = urb.body.iso_packet_descriptor
+    if iso is not None:
+        nbytes += 2 * len(iso) * iso.itemsize
+    return nbytes
+
+
+class ByteBudget:
+    # The memory a usbip client connection may tie up in the bridge: every URB is charged
+    # urb_nbytes() when it is read off the socket, its charge becomes the size of its
+    # RET_SUBMIT once that is built, and is refunded once the RET_SUBMIT is written or the URB
+    # is unlinked. The reader takes the charge before passing the URB on and blocks while the
+    # budget is spent, so a client that outruns the simulator or doesn't read its replies
+    # finds the socket not read any more instead of the bridge growing. One URB over the
+    # limit still gets in when nothing else is charged. A limit of 0 is no limit.
+    #
+    # An unlink is only read once the URBs before it are, so the reader must not wait on URBs
+    # that only an unlink will finish: an IN URB parked on a NAKing device holds no data, and
+    # while every URB is backing off let_through() lets the reader past the limit.
+
+    def __init__(self, limit: int = 0):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        # seqnum -> bytes charged for that URB
+        self._charges = {}
+        self._cond = Condition()
+        self._closed = False
+        self._waiting = False
+        self._let_through = False
+        # a URBMetrics counter child bumped whenever the reader has to wait, or None
+        self.stalls = None
+
+    def charge(self, seqnum: int, nbytes: int):
+        with self._cond:
+            if self.limit and self.used and self.used + nbytes > self.limit and not self._closed:
+                if self.stalls is not None:
+                    self.stalls.value += 1
+                self._waiting = True
+                while (
+                    self.used
+                    and self.used + nbytes > self.limit
+                    and not (self._closed or self._let_through)
+                ):
+                    self._cond.wait()
+                self._waiting = self._let_through = False
+            self._charges[seqnum] = nbytes
+            self.used += nbytes
+            if self.used > self.peak:
+                self.peak = self.used
+
+    def replace(self, seqnum: int, nbytes: int):
+        # the URB finished and nbytes of reply stand in for its charge, never waits
+        with self._cond:
+            old = self._charges.get(seqnum)
+            if old is None:
+                return
+            self._charges[seqnum] = nbytes
+            self.used += nbytes - old
+            if self.used > self.peak:
+                self.peak = self.used
+            if nbytes < old:
+                self._cond.notify_all()
+
+    def let_through(self):
+        # the URBs holding the budget wait on the device, not on the client, so a waiting
+        # reader goes ahead over the limit and reads on to the next unlink
+        with self._cond:
+            if self._waiting:
+                self._let_through = True
+                self._cond.notify_all()
+
+    def refund(self, seqnum: int):
+        with self._cond:
+            nbytes = self._charges.pop(seqnum, 0)
+            if nbytes:
+                self.used -= nbytes
+                self._cond.notify_all()
+
+    def close(self):
+        # the replies will not be written, stop holding the reader back
+        with self._cond:
+            self._closed = True
+            self._charges.clear()
+            self.used = 0
+            self._cond.notify_all()
 
 
 class SimServer:
-    def __init__(self, d2h_raw: Queue, h2d_raw: Queue, port: int = 2443):
+    def __init__(
+        self,
+        d2h_raw: Queue,
+        h2d_raw: Queue,
+        endpoint: Endpoint,
+        flush_bytes: int = 64 * 1024,
+        flush_latency: float = 0.0,
+        capture=None,
+        name: str = None,
+    ):
         self.d2h_raw = d2h_raw
         self.h2d_raw = h2d_raw
-        self.port = port
-        self.serv_sock = get_tcp_server_socket(port)
+        self.endpoint = endpoint
+        self.name = name or f"sim {endpoint}"
+        self.capture = capture
+        self.capture_iface = None
+        if capture is not None:
+            self.capture_iface = capture.add_sim_link(self.name)
+        # a batch is written once flush_bytes are queued or the queue has been idle for
+        # flush_latency seconds, whichever comes first
+        self.flush_bytes = flush_bytes
+        self.flush_latency = flush_latency
+        self.serv_sock = self._listen()
+        # set while a simulator is connected. When it goes away gone is set and None is queued
+        # on d2h_raw and h2d_raw, SimDevice.sim_gone() cleans up and takes the next one.
+        self.connected = Event()
+        self.gone = False
+        # called from d2h_loop() once gone is set, and once a simulator is connected, or None
+        self.on_gone = None
+        self.on_connected = None
         self.accept_thread = None
         self.d2h_thread = None
         self.h2d_thread = None
 
-    def wait_for_connection(self):
-        print("waiting for sim client connection")
+    def _listen(self):
+        return server_socket(self.endpoint)
+
+    def _accept(self):
+        sim_log.info("waiting for sim client connection on %s", self.endpoint)
         self.serv_sock.listen(1)
         self.client_sock, _ = self.serv_sock.accept()
-        print("got sim client connection")
+        self.endpoint.tune(self.client_sock)
+        sim_log.info("got sim client connection on %s", self.endpoint)
+
+    def wait_for_connection(self):
+        self._accept()
         self.d2h_thread = Thread(target=self.d2h_loop, name="d2h_raw", daemon=True)
         self.h2d_thread = Thread(target=self.h2d_loop, name="h2d_raw", daemon=True)
-        self.d2h_thread.start()
+        # before d2h_loop() can see the simulator go away again, and sim_gone() join h2d_loop()
+        self.connected.set()
         self.h2d_thread.start()
+        self.d2h_thread.start()
         self.accept_thread = None
+        if self.on_connected is not None:
+            self.on_connected()
 
     def serve(self):
-        print("starting sim server")
         self.accept_thread = Thread(target=self.wait_for_connection, name="sim_wait", daemon=False)
         self.accept_thread.start()
-        print("ended sim server")
+
+    def accept_next(self):
+        # after the simulator went away and its threads are done
+        self.accept_thread = Thread(target=self.wait_for_connection, name="sim_wait", daemon=True)
+        self.accept_thread.start()
+
+    def close_link(self):
+        self.client_sock.close()
+
+    def _recv(self):
+        # -> the next packet from the simulator, None once it has gone away
+        nbytes_buf = recv_exact(self.client_sock, 4)
+        if nbytes_buf is None:
+            return None
+        buf = recv_exact(self.client_sock, int.from_bytes(nbytes_buf, "big"))
+        return bytes(buf) if buf is not None else None
+
+    def _send(self, bufs):
+        iov = []
+        for buf in bufs:
+            iov.append(_len_prefix.pack(len(buf)))
+            iov.append(buf)
+        sendmsg_all(self.client_sock, iov)
 
     def d2h_loop(self):
         while True:
-            nbytes_buf = self.client_sock.recv(4)
-            if not nbytes_buf:
-                break
-            nbytes = int.from_bytes(nbytes_buf, "big")
-            buf = self.client_sock.recv(nbytes)
-            if not buf:
+            buf = self._recv()
+            if buf is None:
                 break
             if all([b == 0 for b in buf]) and len(buf) > 64:
                 continue
-            print(f"d2h_raw: {buf.hex(' ')}")
+            if self.capture is not None:
+                self.capture.sim_d2h(self.capture_iface, buf)
+            if sim_log.isEnabledFor(DEBUG):
+                sim_log.debug("d2h_raw: %s", LazyHex(buf))
             self.d2h_raw.put(buf)
-        print("sim client closed socket")
+        sim_log.info("sim client of %s went away", self.name)
+        self.connected.clear()
+        self.gone = True
+        self.h2d_raw.put(None)
+        self.d2h_raw.put(None)
+        if self.on_gone is not None:
+            self.on_gone()
+
+    def h2d_gather(self):
+        items = [self.h2d_raw.get()]
+        nbytes = 0
+        deadline = None
+        while True:
+            bufs = items[-1]
+            if bufs is None:
+                break
+            nbytes += sum(map(len, bufs)) if isinstance(bufs, list) else len(bufs)
+            if nbytes >= self.flush_bytes:
+                break
+            try:
+                items.append(self.h2d_raw.get_nowait())
+                continue
+            except Empty:
+                if self.flush_latency <= 0:
+                    break
+            if deadline is None:
+                deadline = time.monotonic() + self.flush_latency
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                items.append(self.h2d_raw.get(timeout=timeout))
+            except Empty:
+                break
+        return items
 
     def h2d_loop(self):
         while True:
-            bufs = self.h2d_raw.get()
-            if not isinstance(bufs, list):
-                bufs = [bufs]
-            obuf = bytearray()
-            for buf in bufs:
-                smsg = len(buf).to_bytes(4, "big") + buf
-                obuf += smsg
-                print(f"h2d_raw: {buf.hex(' ')}")
-                # time.sleep(0.01)
-                self.client_sock.send(smsg)
-            # self.client_sock.send(obuf)
-            self.h2d_raw.task_done()
+            items = self.h2d_gather()
+            bufs = []
+            for item in items:
+                if isinstance(item, list):
+                    bufs += item
+                elif item is not None:
+                    bufs.append(item)
+            if sim_log.isEnabledFor(DEBUG):
+                for buf in bufs:
+                    sim_log.debug("h2d_raw: %s", LazyHex(buf))
+            if self.capture is not None:
+                self.capture.sim_h2d(self.capture_iface, bufs)
+            try:
+                self._send(bufs)
+            except OSError as e:
+                # d2h_loop() sees the simulator go away too
+                sim_log.debug("writing to sim client of %s failed: %s", self.name, e)
+            for _ in items:
+                self.h2d_raw.task_done()
+            if items[-1] is None:
+                return
+
+
+class ShmSimServer(SimServer):
+    # a SimServer whose simulator connects to a shared-memory link, at an shm: endpoint
+
+    def __init__(
+        self,
+        d2h_raw: Queue,
+        h2d_raw: Queue,
+        endpoint: Endpoint,
+        flush_bytes: int = 64 * 1024,
+        flush_latency: float = 0.0,
+        capture=None,
+        name: str = None,
+    ):
+        self.link = None
+        super().__init__(d2h_raw, h2d_raw, endpoint, flush_bytes, flush_latency, capture, name)
+
+    def _listen(self):
+        return ShmListener(self.endpoint.path)
+
+    def _accept(self):
+        sim_log.info("waiting for sim client connection on %s", self.endpoint)
+        self.link = self.serv_sock.accept()
+        sim_log.info("got sim client connection on %s", self.endpoint)
+
+    def _recv(self):
+        return self.link.recv()
+
+    def close_link(self):
+        self.link.close()
+
+    def _send(self, bufs):
+        self.link.send(bufs)
 
 
 class USBIPServer:
-    def __init__(self, d2h_ip: Queue, h2d_ip: Queue, port: int = 3240):
-        self.d2h_ip = d2h_ip
-        self.h2d_ip = h2d_ip
-        self.port = port
-        self.serv_sock = get_tcp_server_socket(port)
+    def __init__(
+        self,
+        registry: DeviceRegistry,
+        endpoint: Endpoint,
+        codec=StructCodec,
+        verify: bool = False,
+        capture=None,
+        client_budget: int = 0,
+    ):
+        self.registry = registry
+        self.endpoint = endpoint
+        self.codec = codec
+        self.verify = verify
+        self.capture = capture
+        # ByteBudget limit of each client connection, 0 for none
+        self.client_budget = client_budget
+        self.serv_sock = None
         self.accept_thread = None
-        self.d2h_thread = None
-        self.h2d_thread = None
 
     def wait_for_connection(self):
-        print("waiting for usbip clinent connection")
-        self.serv_sock.listen(1)
-        self.client_sock, _ = self.serv_sock.accept()
-        print("got usbip client conection")
-        self.d2h_thread = Thread(target=self.d2h_loop, name="d2h_ip", daemon=True)
-        self.h2d_thread = Thread(target=self.h2d_loop, name="h2d_ip", daemon=True)
-        self.d2h_thread.start()
-        self.h2d_thread.start()
-        self.accept_thread = None
+        usbip_log.info("waiting for usbip client connections on %s", self.endpoint)
+        self.serv_sock.listen()
+        while True:
+            client_sock, addr = self.serv_sock.accept()
+            self.adopt(client_sock, addr)
+
+    def adopt(self, client_sock, addr):
+        # also takes connections accepted elsewhere, as long as their op request is unread
+        self.endpoint.tune(client_sock)
+        usbip_log.info("got usbip client connection from %s", addr)
+        Thread(target=self.h2d_loop, args=(client_sock,), name="h2d_ip", daemon=True).start()
 
     def serve(self):
-        print("starting usbip server")
-        self.accept_thread = Thread(target=self.wait_for_connection, name="ip_wait", daemon=False)
+        self.serv_sock = server_socket(self.endpoint)
+        self.accept_thread = Thread(target=self.wait_for_connection, name="ip_wait", daemon=True)
         self.accept_thread.start()
-        print("ended usbip server")
 
-    def d2h_loop(self):
+    def d2h_loop(self, client_sock, d2h_ip: Queue, conn, budget: ByteBudget):
+        failed = False
         while True:
-            buf, smsg_ty = self.d2h_ip.get()
-            print(f"d2h_ip sock write: smsg_ty: {smsg_ty}")
-            self.client_sock.send(buf)
-            self.d2h_ip.task_done()
-
-    def h2d_loop(self):
-        while True:
-            cmsg, cmsg_ty = read_usbip_client_packet(self.client_sock)
-            if cmsg is None:
+            item = d2h_ip.get()
+            if item is None:
                 break
-            print(f"h2d_ip sock read: cmsg_ty: {cmsg_ty} cmsg: {cmsg}")
-            self.h2d_ip.put((cmsg, cmsg_ty))
-        print("usbip client closed socket")
-
-
-class USBIPSimBridgeServer_classic:
-    def __init__(self, usbip_port: int = 3240, sim_port: int = 2443):
-        self.usbip_port = usbip_port
-        self.sim_port = sim_port
+            d2h_ip.task_done()
+            if failed:
+                continue
+            buf, smsg_ty = item
+            usbip_log.debug("d2h_ip sock write: smsg_ty: %s", smsg_ty)
+            if self.capture is not None and smsg_ty == USBIPServerPacketType.USBIPCommandReply:
+                self.capture.usbip_ret(conn, buf)
+            try:
+                client_sock.sendall(buf)
+            except OSError as e:
+                # drop the rest, h2d_loop sees the connection end and cleans up
+                usbip_log.warning("writing to usbip client failed: %s", e)
+                failed = True
+                budget.close()
+                client_sock.shutdown(socket.SHUT_RDWR)
+                continue
+            if smsg_ty == USBIPServerPacketType.USBIPCommandReply:
+                hdr = parse_cmd_common_hdr(buf)
+                if hdr.command == UBSIPCommandEnum.RET_SUBMIT:
+                    budget.refund(hdr.seqnum)
+
+    def h2d_loop(self, client_sock):
+        # every reply for this client, op or URB, goes through its own d2h_ip queue
+        d2h_ip = Queue()
+        budget = ByteBudget(self.client_budget)
+        conn = self.capture.new_connection() if self.capture is not None else None
+        d2h_thread = Thread(
+            target=self.d2h_loop,
+            args=(client_sock, d2h_ip, conn, budget),
+            name="d2h_ip",
+            daemon=True,
+        )
+        d2h_thread.start()
+        framer = USBIPClientFramer(client_sock, self.codec, verify=self.verify)
+        dev = None
+        try:
+            while True:
+                try:
+                    cmsg, cmsg_ty = framer.read_packet()
+                except ValueError as e:
+                    usbip_log.warning("bad packet from usbip client: %s", e)
+                    break
+                except OSError as e:
+                    # a reset connection ends the client like EOF does
+                    usbip_log.info("usbip client connection lost: %s", e)
+                    break
+                if cmsg is None:
+                    break
+                usbip_log.debug("h2d_ip sock read: cmsg_ty: %s cmsg: %s", cmsg_ty, cmsg)
+                if cmsg_ty == USBIPClientPacketType.USBIPOperationRequest:
+                    if dev is not None:
+                        usbip_log.warning("op request %s after import of %s", cmsg.code, dev.busid)
+                        break
+                    reply, dev = self.registry.handle_op(cmsg, d2h_ip)
+                    d2h_ip.put((reply, USBIPServerPacketType.USBIPOperationReply))
+                    if dev is None:
+                        break
+                    usbip_log.info("usbip client imported %s", dev.busid)
+                    dev.backend.attach(d2h_ip, budget)
+                elif dev is None:
+                    usbip_log.warning("usbip client sent a command before importing a device")
+                    break
+                else:
+                    if self.capture is not None:
+                        self.capture.usbip_cmd(conn, cmsg)
+                    if cmsg.command == UBSIPCommandEnum.CMD_SUBMIT:
+                        # stops reading the socket while the client's budget is spent
+                        budget.charge(cmsg.seqnum, urb_nbytes(cmsg))
+                    dev.backend.h2d_ip.put((cmsg, cmsg_ty))
+        finally:
+            if dev is not None:
+                dev.backend.detach()
+                self.registry.release(dev, d2h_ip)
+            d2h_ip.put(None)
+            d2h_thread.join()
+            budget.close()
+            if self.capture is not None:
+                self.capture.usbip_closed(conn)
+            client_sock.close()
+        usbip_log.info("usbip client closed socket")
+
+
+class SimDevice:
+    # a SimServer and the URB loop feeding it from whichever usbip client imported the device
+    def __init__(
+        self,
+        engine: URBEngine,
+        sim_endpoint: Endpoint,
+        flush_bytes: int = 64 * 1024,
+        flush_latency: float = 0.0,
+        capture=None,
+        name: str = None,
+        probe: bool = False,
+    ):
+        self.engine = engine
+        # read the device's descriptors as soon as the simulator connects
+        self.probe = probe
         self.d2h_raw = Queue()
         self.h2d_raw = Queue()
-        self.d2h_ip = Queue()
         self.h2d_ip = Queue()
-        self.sim_server = SimServer(self.d2h_raw, self.h2d_raw, sim_port)
-        self.usbip_server = USBIPServer(self.d2h_ip, self.h2d_ip, usbip_port)
-        self._frame_num = 0
-        self._odds = [False] * USB_MAX_ENDPOINTS
-        self.busnum = 47
-        self.devnum = 6
-        self._setup_addr_done = False
+        self.d2h_ip = None
+        # the importing connection's ByteBudget, refunded here for unlinked URBs
+        self.budget = None
+        self.budget_stalls = None
+        server_cls = ShmSimServer if sim_endpoint.scheme == "shm" else SimServer
+        self.sim_server = server_cls(
+            self.d2h_raw, self.h2d_raw, sim_endpoint, flush_bytes, flush_latency, capture, name
+        )
+        # an idle urb_loop() waits on the client, wake it to clean up after the simulator and
+        # to probe the next one
+        self.sim_server.on_gone = self.sim_server.on_connected = self.wake
+        self.urb_thread = None
+        self.sched = None
+        # d2h_raw_pop() returned the None queued when the simulator went away
+        self._sim_eof = False
+        # a simulator connected after the last one went away and has not been probed yet
+        self._probe_pending = False
+        if engine.metrics is not None:
+            self.register_metrics(engine.metrics)
+
+    def register_metrics(self, metrics: URBMetrics):
+        metrics.queue_gauge("d2h_raw", self.d2h_raw.qsize)
+        metrics.queue_gauge("h2d_raw", self.h2d_raw.qsize)
+        metrics.queue_gauge("h2d_ip", self.h2d_ip.qsize)
+        metrics.queue_gauge("d2h_ip", lambda: self.d2h_ip.qsize() if self.d2h_ip is not None else 0)
+        metrics.queue_gauge("urbs", lambda: len(self.sched) if self.sched is not None else 0)
+        metrics.queue_bytes_gauge(
+            "client", lambda: self.budget.used if self.budget is not None else 0
+        )
+        self.budget_stalls = metrics.budget_stalls()
 
     def d2h_raw_pop(self):
         res = self.d2h_raw.get()
         self.d2h_raw.task_done()
+        if res is None:
+            self._sim_eof = True
         return res
 
+    def wake(self):
+        self.h2d_ip.put((None, None))
+
+    def sim_pop(self):
+        # d2h_raw_pop() that keeps returning None once the simulator has gone away
+        return None if self._sim_eof else self.d2h_raw_pop()
+
     def h2d_ip_pop(self):
         res = self.h2d_ip.get()
         self.h2d_ip.task_done()
         return res
 
     def serve(self):
-        print("server running")
         self.sim_server.serve()
-        self.usbip_server.serve()
+        self.urb_thread = Thread(target=self.urb_loop, name="urb", daemon=True)
+        self.urb_thread.start()
 
+    def attach(self, d2h_ip: Queue, budget: ByteBudget = None):
+        self.d2h_ip = d2h_ip
+        self.budget = budget
+        if budget is not None:
+            budget.stalls = self.budget_stalls
+
+    def detach(self):
+        # returns once the client's outstanding URBs are cancelled and unwound
+        detached = Event()
+        self.h2d_ip.put((detached, None))
+        detached.wait()
+
+    def probe_device(self):
+        # blocks until the simulator connects, client URBs queue up meanwhile
+        try:
+            run_urb(self.engine.probe(), self.h2d_raw.put, self.sim_pop)
+        except Exception:
+            sim_log.warning("probing the device failed", exc_info=True)
+
+    def urb_loop(self):
+        if self.probe:
+            self.probe_device()
+        sched = self.sched = URBScheduler(self.engine)
+        detached = None
         while True:
-            cmsg, cmsg_ty = self.h2d_ip_pop()
-            if cmsg_ty == USBIPClientPacketType.USBIPOperationRequest:
-                if cmsg.code == UBSIPCode.REQ_IMPORT:
-                    smsg = OpImportReply.build(
-                        {
-                            "status": 0,
-                            "body": {
-                                "udev": {
-                                    "path": "",
-                                    "busid": f"{self.busnum}-{self.devnum}.0",
-                                    "busnum": self.busnum,
-                                    "devnum": self.devnum,
-                                    "speed": 3,
-                                    "idVendor": 0x16D0,
-                                    "idProduct": 0x0F3B,
-                                    "bcdDevice": 0,
-                                    "bDeviceClass": 0,
-                                    "bDeviceSubClass": 0,
-                                    "bDeviceProtocol": 0,
-                                    "bConfigurationValue": 0,
-                                    "bNumConfigurations": 1,
-                                    "bNumInterfaces": 1,
-                                }
-                            },
-                        }
-                    )
-                    self.d2h_ip.put((smsg, USBIPServerPacketType.USBIPOperationReply))
-                else:
-                    raise NotImplementedError(repr(cmsg.code))
-            elif cmsg_ty == USBIPClientPacketType.USBIPCommandRequest:
-                if cmsg.command == UBSIPCommandEnum.CMD_SUBMIT:
-                    self.send_urb_to_sim(cmsg)
-                elif cmsg.command == UBSIPCommandEnum.CMD_UNLINK:
-                    print("got unlink!")
+            if detached is not None and not sched.busy:
+                self.d2h_ip = None
+                self.budget = None
+                detached.set()
+                detached = None
+            if self.sim_server.gone:
+                self.sim_gone(sched)
+            # block for the client only when there is nothing to push to the sim
+            if not sched.busy:
+                detached = self.handle_usbip_packet(sched, *self.h2d_ip_pop())
+            while detached is None:
+                try:
+                    pkt = self.h2d_ip.get_nowait()
+                except Empty:
                     break
-        print("server done")
+                self.h2d_ip.task_done()
+                detached = self.handle_usbip_packet(sched, *pkt)
+            if sched.busy and not self.sim_server.connected.is_set():
+                detached = self.wait_for_sim(sched, detached)
+                continue
+            if self._probe_pending and self.sim_server.connected.is_set():
+                # nothing has gone to the new simulator yet
+                self._probe_pending = False
+                self.probe_device()
+            bufs, nresp, done = sched.step()
+            if bufs:
+                self.h2d_raw.put(bufs)
+            for smsg in done:
+                if self.budget is not None:
+                    self.budget.replace(parse_cmd_common_hdr(smsg).seqnum, len(smsg))
+                self.d2h_ip.put((smsg, USBIPServerPacketType.USBIPCommandReply))
+            if nresp:
+                resps = []
+                while len(resps) < nresp:
+                    resp = self.d2h_raw_pop()
+                    if resp is None:
+                        # the simulator went away, sim_gone() fails this URB too
+                        break
+                    resps.append(resp)
+                else:
+                    sched.responses(resps)
+            elif not (bufs or done) and detached is None:
+                # every pipe is backing off from a NAKing device, sleep unless the client
+                # has something for us first
+                delay = sched.delay()
+                if delay > 0:
+                    if self.budget is not None:
+                        self.budget.let_through()
+                    try:
+                        pkt = self.h2d_ip.get(timeout=delay)
+                    except Empty:
+                        pass
+                    else:
+                        self.h2d_ip.task_done()
+                        detached = self.handle_usbip_packet(sched, *pkt)
+
+    def wait_for_sim(self, sched, detached):
+        # URBs wait for a simulator to connect, the client can still unlink them meanwhile
+        if detached is None:
+            # the URBs holding the budget wait on the simulator, not on the client
+            if self.budget is not None:
+                self.budget.let_through()
+            try:
+                pkt = self.h2d_ip.get(timeout=_SIM_WAIT_TIMEOUT)
+            except Empty:
+                return None
+            self.h2d_ip.task_done()
+            detached = self.handle_usbip_packet(sched, *pkt)
+        if detached is not None:
+            # the client is gone, and without a simulator there is nothing to unwind against
+            sched.fail_all(-errno.ESHUTDOWN)
+        return detached
+
+    def sim_gone(self, sched):
+        # The simulator went away: drop what was still queued to and from it, fail the URBs it
+        # had in flight and wait for the next one, which brings up a fresh device.
+        server = self.sim_server
+        while not self._sim_eof:
+            self.d2h_raw_pop()
+        self._sim_eof = False
+        server.h2d_thread.join()
+        while True:
+            try:
+                self.h2d_raw.get_nowait()
+            except Empty:
+                break
+            self.h2d_raw.task_done()
+        server.close_link()
+        self.engine.reset_device()
+        for smsg in sched.fail_all(-errno.ESHUTDOWN):
+            if self.budget is not None:
+                self.budget.replace(parse_cmd_common_hdr(smsg).seqnum, len(smsg))
+            self.d2h_ip.put((smsg, USBIPServerPacketType.USBIPCommandReply))
+        # the next simulator's device is probed before any URB goes to it
+        self._probe_pending = self.probe
+        server.gone = False
+        server.accept_next()
+
+    def handle_usbip_packet(self, sched, cmsg, cmsg_ty):
+        if cmsg is None:
+            # from wake()
+            return None
+        if cmsg_ty is None:
+            sched.cancel_all()
+            return cmsg
+        if cmsg.command == UBSIPCommandEnum.CMD_SUBMIT:
+            sched.submit(cmsg)
+        elif cmsg.command == UBSIPCommandEnum.CMD_UNLINK:
+            status = 0
+            if sched.cancel(cmsg.body.seqnum):
+                status = -errno.ECONNRESET
+                # its RET_SUBMIT never comes
+                if self.budget is not None:
+                    self.budget.refund(cmsg.body.seqnum)
+            smsg = self.engine.codec.build_ret_unlink(cmsg, status=status)
+            self.d2h_ip.put((smsg, USBIPServerPacketType.USBIPCommandReply))
+        return None
 
-    @property
-    def frame_num(self):
-        res = self._frame_num
-        self._frame_num = (res + 1) & ((1 << 11) - 1)
-        return res
 
-    def odd(self, endpoint):
-        res = self._odds[endpoint]
-        self._odds[endpoint] = not res
-        return res
+class USBIPSimBridgeServer_classic:
+    def __init__(
+        self,
+        usbip_port: int = 3240,
+        sim_port: int = 2443,
+        codec=StructCodec,
+        verify: bool = False,
+        sim_flush_bytes: int = 64 * 1024,
+        sim_flush_latency: float = 0.0,
+        bulk_window: int = 1,
+        retry=None,
+        num_devices: int = 1,
+        busnum: int = 47,
+        devnum: int = 6,
+        capture=None,
+        metrics=None,
+        probe_descriptors: bool = False,
+        serve_descriptors: bool = False,
+        usbip_endpoint=None,
+        sim_endpoint=None,
+        speed: int = USB_SPEED_HIGH,
+        client_budget: int = 64 * 1024 * 1024,
+    ):
+        # endpoints are URLs or transport.Endpoints, by default TCP on localhost at the ports
+        usbip_endpoint = parse_endpoint(usbip_endpoint or tcp_endpoint("localhost", usbip_port))
+        sim_endpoint = parse_endpoint(sim_endpoint or tcp_endpoint("localhost", sim_port))
+        self.codec = codec
+        # a CaptureTap, or None to not capture
+        self.capture = capture
+        # a MetricsRegistry, or None to not instrument
+        self.metrics = metrics
+        # device i is at busid {busnum}-{devnum + i}.0 and its simulator connects to
+        # sim_endpoint.nth(i), the endpoint's port + i or PATH.i
+        self.registry = DeviceRegistry()
+        for i in range(num_devices):
+            dev = ExportedDevice(busnum, devnum + i, speed=speed)
+            engine = URBEngine(
+                codec,
+                busnum,
+                devnum + i,
+                bulk_window=bulk_window,
+                metrics=URBMetrics(metrics, dev.busid) if metrics is not None else None,
+                retry=retry,
+                serve_descriptors=serve_descriptors,
+                speed=speed,
+            )
+            dev.backend = SimDevice(
+                engine,
+                sim_endpoint.nth(i),
+                sim_flush_bytes,
+                sim_flush_latency,
+                capture,
+                f"sim {dev.busid}",
+                probe_descriptors,
+            )
+            dev.descriptors = engine.descriptors
+            self.registry.add(dev)
+        # bytes of URBs and replies a usbip client can have in the bridge at once, see
+        # ByteBudget, 0 for no limit
+        self.usbip_server = USBIPServer(
+            self.registry, usbip_endpoint, codec, verify, capture, client_budget
+        )
 
-    def reset_odd(self, endpoint):
-        self._odds[endpoint] = False
-
-    def setup_addr(self):
-        dev = 0
-        ep = 0
-        setup_token = setup_token_packet(dev, ep)
-        setup_data = setup_data_packet(Recip.DEVICE, Dir.OUT, Req.SET_ADDRESS, self.devnum, 0, 0)
-        self.reset_odd(ep)
-        self.odd(ep)
-        self.h2d_raw.put([setup_token, setup_data])
-        setup_resp = self.d2h_raw_pop()
-        assert setup_resp == ack_packet()
-        in_token = in_token_packet(0, 0)
-        self.h2d_raw.put([sof_packet(self.frame_num), in_token])
-        resp_data = self.d2h_raw_pop()
-        resp_data_gold = data_packet(b"", odd=self.odd(ep))
-        if resp_data != resp_data_gold:
-            raise ValueError(f"resp actual: {resp_data.hex(' ')} gold: {resp_data_gold.hex(' ')}")
-        self.h2d_raw.put(ack_packet())
-        self._setup_addr_done = True
-
-    def handle_control(self, urb):
-        if len(urb.body.transfer_buffer):
-            raise NotImplementedError("setup packet with extra data? NYET!")
-        ep = 0
-        is_in = urb.body.setup[0] & Dir.IN != 0
-        # setup phase
-        setup_token = setup_token_packet(urb.devid_devnum, ep)
-        self.reset_odd(ep)
-        setup_data = data_packet(urb.body.setup, odd=False)
-        self.h2d_raw.put([setup_token, setup_data])
-        setup_resp = self.d2h_raw_pop()
-        print(f"setup_resp: {setup_resp.hex()}")
-        if setup_resp != ack_packet():
-            print("got bad setup_resp")
-            smsg = RetSubmit.build({**cmd_ret_hdr(urb), "body": {"status": 1, "error_count": 1}})
-            self.d2h_ip.put((smsg, USBIPServerPacketType.USBIPCommandReply))
+    def serve(self, listen: bool = True):
+        # with listen False usbip clients only come in through adopt(), and it returns at once
+        log.info("server running")
+        for dev in self.registry:
+            dev.backend.serve()
+        if not listen:
             return
-        setup_resp_data = b""
-        if urb.body.transfer_buffer_length:
-            # data phase
-            print("good good setup_resp, sending in token(s) to device")
-            in_token = in_token_packet(urb.devid_devnum, ep)
-            while len(setup_resp_data) < urb.body.transfer_buffer_length:
-                self.h2d_raw.put(in_token)
-                full_buf = self.d2h_raw_pop()
-                # fixme check PID and CRC
-                buf = full_buf[1:-2]
-                setup_resp_data += buf
-                self.h2d_raw.put(ack_packet())
-                if len(buf) != 64:
-                    break
-        print(f"setup_resp_data: {setup_resp_data.hex(' ')}")
-        # status phase
-        status_zlp = data_packet(b"", odd=True)
-        if is_in:
-            out_token = out_token_packet(urb.devid_devnum, ep)
-            self.h2d_raw.put([out_token, status_zlp])
-            self.reset_odd(ep)
-            status_resp = self.d2h_raw_pop()
-            print(f"status_resp: {status_resp.hex()}")
-            if status_resp != ack_packet():
-                print("got bad status_resp")
-                smsg = RetSubmit.build(
-                    {**cmd_ret_hdr(urb), "body": {"status": 1, "error_count": 1}}
-                )
-                self.d2h_ip.put((smsg, USBIPServerPacketType.USBIPCommandReply))
-                return
-        else:
-            in_token = in_token_packet(urb.devid_devnum, ep)
-            self.h2d_raw.put(in_token)
-            zlp_resp = self.d2h_raw_pop()
-            if zlp_resp != status_zlp:
-                print(f"RUHROH: {zlp_resp} {status_zlp}")
-            self.h2d_raw.put(ack_packet())
-        smsg = RetSubmit.build(
-            {
-                **cmd_ret_hdr(urb),
-                "body": {
-                    "status": 0,
-                    "error_count": 0,
-                    "actual_length": len(setup_resp_data),
-                    "transfer_buffer": setup_resp_data,
-                },
-            }
-        )
-        self.d2h_ip.put((smsg, USBIPServerPacketType.USBIPCommandReply))
-
-    def handle_bulk(self, urb):
-        MAX_PKT_SZ = 512
-        is_in = urb.direction == 1
-        print(f"urb dir: {Dir(urb.body.setup[0])} len: {urb.body.transfer_buffer_length}")
-        if is_in:
-            obuf = bytearray()
-        else:
-            ibuf = bytearray(urb.body.transfer_buffer)
-        len_rem = urb.body.transfer_buffer_length
-        while len_rem > 0:
-            obufs = []
-            if is_in:
-                token_pkt = in_token_packet(urb.devid_devnum, urb.ep)
-                obufs.append(token_pkt)
-            else:
-                token_pkt = out_token_packet(urb.devid_devnum, urb.ep)
-                obufs.append(token_pkt)
-                buf = ibuf[:512]
-                print(f"z buf: {buf.hex(' ')}")
-                data_out_pkt = data_packet(buf, odd=self.odd(urb.ep))
-                obufs.append(data_out_pkt)
-                del ibuf[:512]
-                len_rem -= len(buf)
-            self.h2d_raw.put(obufs)
-            if is_in:
-                resp_data_pkt = self.d2h_raw_pop()
-                # FIXME: check PID and CRC
-                resp_data = resp_data_pkt[1:-2]
-                len_rem -= len(resp_data)
-                obuf += resp_data
-                self.h2d_raw.put(ack_packet())
-            else:
-                resp = self.d2h_raw_pop()
-                assert resp == ack_packet()
-            print(f"len_rem: {len_rem}")
-        smsg = RetSubmit.build(
-            {
-                **cmd_ret_hdr(urb),
-                "body": {
-                    "status": 0,
-                    "error_count": 0,
-                    "actual_length": len(obuf) if is_in else 0,
-                    "transfer_buffer": obuf if is_in else b"",
-                },
-            }
-        )
-        self.d2h_ip.put((smsg, USBIPServerPacketType.USBIPCommandReply))
-
-    def handle_iso(self, urb):
-        raise NotImplementedError("iso transfers not implemented")
-
-    def handle_interrupt(self, urb):
-        raise NotImplementedError("interrrupt transfers not implemented")
-
-    def handle_transfer(self, urb):
-        if urb.ep == 0:
-            self.handle_control(urb)
-        elif urb.body.number_of_packets:
-            self.handle_iso(urb)
-        elif False:  # no way to detect transfer type without endpoint descriptor parsing??
-            self.handle_interrupt(urb)
-        else:
-            self.handle_bulk(urb)
-
-    def send_urb_to_sim(self, urb):
-        # print(f"submit: {urb}")
-        self.h2d_raw.put(sof_packet(self.frame_num))
-        if not self._setup_addr_done:
-            self.setup_addr()
-        self.handle_transfer(urb)
+        self.usbip_server.serve()
+        self.usbip_server.accept_thread.join()
+        log.info("server done")
+
+    def adopt(self, sock, addr=None):
+        # a usbip client connection accepted elsewhere, its op request not read yet
+        self.usbip_server.adopt(sock, addr)
 
 
 if __name__ == "__main__":
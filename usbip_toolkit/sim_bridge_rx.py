@@ -1,9 +1,7 @@
-import imp
 import os
 import socket
 import time
 from itertools import count
-from multiprocessing import pool
 
 import reactivex as rx
 import reactivex.run as rxrun
@@ -14,7 +12,15 @@ from reactivex.scheduler.scheduler import Scheduler
 from usbip_toolkit.proto import *
 from usbip_toolkit.util import get_tcp_server_socket
 
-pool_scheduler = ThreadPoolScheduler(os.cpu_count())
+_pool_scheduler = None
+
+
+def pool_scheduler() -> ThreadPoolScheduler:
+    # made on first use, importing the module starts no threads
+    global _pool_scheduler
+    if _pool_scheduler is None:
+        _pool_scheduler = ThreadPoolScheduler(os.cpu_count())
+    return _pool_scheduler
 
 
 class SimServer:
@@ -43,8 +49,8 @@ class SimServer:
             observer.on_completed()
             observer.dispose()
 
-        # self.source = rx.create(rx_loop).pipe(ops.observe_on(pool_scheduler))
-        self.source = rx.create(rx_loop).pipe(ops.subscribe_on(pool_scheduler))
+        # self.source = rx.create(rx_loop).pipe(ops.observe_on(pool_scheduler()))
+        self.source = rx.create(rx_loop).pipe(ops.subscribe_on(pool_scheduler()))
 
         # foo = self.source.subscribe(
         #     on_next=lambda i: print("Received A {0}".format(i)),
@@ -76,7 +82,7 @@ class SimServer:
 
         source2 = rx.create(push_five_strings)
 
-        s2 = source2.pipe(ops.observe_on(pool_scheduler))
+        s2 = source2.pipe(ops.observe_on(pool_scheduler()))
 
         def push_five_other_strings(observer, scheduler):
             observer.on_next("aardvark")
@@ -88,15 +94,15 @@ class SimServer:
 
         source3 = rx.create(push_five_other_strings)
 
-        s3 = source2.pipe(ops.subscribe_on(pool_scheduler), ops.delay(3))
-        # s2 = source2.pipe(ops.subscribe_on(pool_scheduler), ops.delay(3)).subscribe(
+        s3 = source2.pipe(ops.subscribe_on(pool_scheduler()), ops.delay(3))
+        # s2 = source2.pipe(ops.subscribe_on(pool_scheduler()), ops.delay(3)).subscribe(
         #     on_next=lambda i: print("Received B {0}".format(i)),
         #     on_error=lambda e: print("Error Occurred: {0}".format(e)),
         #     on_completed=lambda: print("Done! B"),
         # )
         # combo = rx.compose()
         # combo = self.source.pipe(ops.merge(s2))
-        combo = rx.merge(self.source, s2).pipe(ops.observe_on(pool_scheduler))
+        combo = rx.merge(self.source, s2).pipe(ops.observe_on(pool_scheduler()))
         # combo = rx.merge(s2, s3)
         # combo_s = rx.create(combo)
 
@@ -0,0 +1,280 @@
+import json
+import multiprocessing
+import os
+import select
+import socket
+import struct
+import time
+from threading import Lock, Thread
+
+from usbip_toolkit.log import log, stop_logging, usbip_log
+from usbip_toolkit.metrics import render_prometheus
+from usbip_toolkit.proto import *
+from usbip_toolkit.registry import DeviceRegistry
+from usbip_toolkit.transport import parse_endpoint, server_socket, tcp_endpoint
+from usbip_toolkit.util import recv_exact
+
+# A bridge spread over processes, one worker per exported device, so devices don't share a GIL.
+# The supervisor forks the workers, each builds a one-device bridge with make_bridge(i) and
+# serves that device's sim link itself. The supervisor keeps the USB/IP listening socket: it
+# peeks at every connection's op request and passes an OP_REQ_IMPORT, still unread, to the
+# worker owning the busid as SCM_RIGHTS, after which the client talks to the worker directly.
+# Everything else (DEVLIST, DEVINFO, imports of unknown busids) it answers itself, from device
+# info the workers send on request. The kernel's SO_REUSEPORT balancing can't do the routing,
+# it picks a listener by address hash before a busid has been sent.
+#
+# Control messages between supervisor and worker go over a unix socketpair, framed like the
+# sim link (4 byte big-endian length) and JSON inside: {"op": "conn"} with the connection's fd
+# attached, {"op": "devinfo"} and {"op": "metrics"}, the last two answered in order.
+
+_len_prefix = struct.Struct(">I")
+_OP_HDR_SIZE = OpCommonHdr.sizeof()
+# header and busid of an OP_REQ_IMPORT
+_IMPORT_REQ_SIZE = _OP_HDR_SIZE + 32
+# how long a client gets to send its op request
+_OP_TIMEOUT = 10.0
+
+
+def _send_msg(sock: socket.socket, msg: dict, fds=()):
+    body = json.dumps(msg).encode()
+    socket.send_fds(sock, [_len_prefix.pack(len(body)) + body], list(fds))
+
+
+def _recv_msg(sock: socket.socket):
+    # -> (msg, fds), (None, []) once the other side has gone away
+    head, fds, _, _ = socket.recv_fds(sock, _len_prefix.size, 1)
+    if not head:
+        return None, fds
+    if len(head) < _len_prefix.size:
+        rest = recv_exact(sock, _len_prefix.size - len(head))
+        if rest is None:
+            return None, fds
+        head += rest
+    body = recv_exact(sock, _len_prefix.unpack(head)[0])
+    if body is None:
+        return None, fds
+    return json.loads(body), fds
+
+
+def _peek(sock: socket.socket, nbytes: int) -> bytes:
+    # -> the first nbytes the client sent, left unread for whoever serves it. Fewer if it
+    # closed before sending them.
+    deadline = time.monotonic() + _OP_TIMEOUT
+    while True:
+        buf = sock.recv(nbytes, socket.MSG_PEEK | socket.MSG_WAITALL)
+        if len(buf) >= nbytes or not buf:
+            return buf
+        if time.monotonic() > deadline:
+            raise socket.timeout(f"op request not complete after {_OP_TIMEOUT}s")
+        time.sleep(0.001)
+
+
+class WorkerDevice:
+    # the supervisor's stand-in for a device exported by a worker, for the registry's replies
+    def __init__(self, worker, busid: str):
+        self.worker = worker
+        self.busid = busid
+        self.owner = None
+
+    def devinfo(self) -> dict:
+        return self.worker.request({"op": "devinfo"})["devs"][self.busid]
+
+
+class Worker:
+    def __init__(self, index: int, busid: str):
+        self.index = index
+        self.busid = busid
+        self.process = None
+        # the supervisor's end of the control socket
+        self.sock = None
+        # one request and its reply at a time
+        self._lock = Lock()
+
+    def request(self, msg: dict) -> dict:
+        with self._lock:
+            _send_msg(self.sock, msg)
+            reply, _ = _recv_msg(self.sock)
+        if reply is None:
+            raise ConnectionError(f"worker for {self.busid} went away")
+        return reply
+
+    def hand_over(self, conn: socket.socket, addr):
+        with self._lock:
+            _send_msg(self.sock, {"op": "conn", "addr": str(addr)}, [conn.fileno()])
+
+
+class WorkerMetrics:
+    # stands in for a MetricsRegistry in the supervisor, for serve_prometheus() and JSONDumper:
+    # the workers' registries merged. Their samples carry the busid, so none collide.
+
+    def __init__(self, workers):
+        self.workers = workers
+
+    def snapshot(self) -> dict:
+        res = {}
+        for worker in self.workers:
+            try:
+                metrics = worker.request({"op": "metrics"})["metrics"]
+            except (ConnectionError, OSError):
+                continue
+            for name, fam in metrics.items():
+                merged = res.setdefault(name, dict(fam, samples=[]))
+                merged["samples"] += fam["samples"]
+        return res
+
+    def prometheus_text(self) -> str:
+        return render_prometheus(self.snapshot())
+
+
+class Supervisor:
+    def __init__(
+        self,
+        make_bridge,
+        num_devices: int = 1,
+        busnum: int = 47,
+        devnum: int = 6,
+        usbip_endpoint=None,
+        setup_worker=None,
+    ):
+        # make_bridge(i) -> a bridge exporting only {busnum}-{devnum + i}.0, called in worker i
+        # after setup_worker(i), if given, which sets up logging and such for the process
+        self.make_bridge = make_bridge
+        self.setup_worker = setup_worker
+        self.busnum = busnum
+        self.devnum = devnum
+        self.usbip_endpoint = parse_endpoint(usbip_endpoint or tcp_endpoint("localhost", 3240))
+        self.workers = [Worker(i, f"{busnum}-{devnum + i}.0") for i in range(num_devices)]
+        self.registry = DeviceRegistry(WorkerDevice(w, w.busid) for w in self.workers)
+        self.metrics = WorkerMetrics(self.workers)
+        self._by_busid = {w.busid: w for w in self.workers}
+
+    def start_workers(self):
+        # forks, so before the supervisor starts any threads of its own
+        ctx = multiprocessing.get_context("fork")
+        for worker in self.workers:
+            ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            worker.sock = ours
+            worker.process = ctx.Process(
+                target=self._worker_main,
+                args=(worker, theirs),
+                name=f"worker {worker.busid}",
+                daemon=True,
+            )
+            worker.process.start()
+            theirs.close()
+            log.info("worker %d serves %s", worker.process.pid, worker.busid)
+
+    def _worker_main(self, worker: Worker, sock: socket.socket):
+        # the supervisor's ends of every control socket came along with the fork
+        for other in self.workers:
+            if other.sock is not None:
+                other.sock.close()
+        if self.setup_worker is not None:
+            self.setup_worker(worker.index)
+        status = 1
+        bridge = None
+        try:
+            bridge = self.make_bridge(worker.index)
+            Thread(
+                target=bridge.serve, kwargs={"listen": False}, name="bridge", daemon=True
+            ).start()
+            _control_loop(bridge, sock)
+            status = 0
+        except Exception:
+            log.exception("worker for %s failed", worker.busid)
+        finally:
+            if getattr(bridge, "capture", None) is not None:
+                bridge.capture.close()
+            stop_logging()
+            # the bridge's threads are not joined, the supervisor is gone or stopping
+            os._exit(status)
+
+    def serve(self) -> bool:
+        # -> False if it stopped because a worker died
+        if self.workers[0].process is None:
+            self.start_workers()
+        sock = server_socket(self.usbip_endpoint)
+        sock.listen()
+        sentinels = {w.process.sentinel: w for w in self.workers}
+        usbip_log.info("waiting for usbip client connections on %s", self.usbip_endpoint)
+        try:
+            while True:
+                readable, _, _ = select.select([sock, *sentinels], [], [])
+                for fd in readable:
+                    worker = sentinels.get(fd)
+                    if worker is not None:
+                        worker.process.join()
+                        log.error(
+                            "worker for %s exited with %s", worker.busid, worker.process.exitcode
+                        )
+                        return False
+                if sock in readable:
+                    conn, addr = sock.accept()
+                    self.usbip_endpoint.tune(conn)
+                    Thread(target=self._route, args=(conn, addr), name="route", daemon=True).start()
+        finally:
+            sock.close()
+            self.stop()
+
+    def stop(self, timeout: float = 2.0):
+        # workers exit once their control socket closes, the ones that don't are terminated
+        for worker in self.workers:
+            if worker.sock is not None:
+                worker.sock.close()
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            worker.process.join(max(0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join()
+
+    def _route(self, conn: socket.socket, addr):
+        try:
+            conn.settimeout(_OP_TIMEOUT)
+            hdr = _peek(conn, _OP_HDR_SIZE)
+            if len(hdr) < _OP_HDR_SIZE:
+                return
+            if OpCommonHdr.parse(hdr).code == UBSIPCode.REQ_IMPORT:
+                req = _peek(conn, _IMPORT_REQ_SIZE)
+                busid = req[_OP_HDR_SIZE:].split(b"\0")[0].decode(errors="replace")
+                worker = self._by_busid.get(busid)
+                if worker is not None:
+                    # blocking again, the worker's end shares the file description
+                    conn.settimeout(None)
+                    worker.hand_over(conn, addr)
+                    usbip_log.info("handed %s's import of %s to its worker", addr, busid)
+                    return
+            cmsg, cmsg_ty = read_usbip_client_packet(conn)
+            if cmsg is None:
+                return
+            if cmsg_ty != USBIPClientPacketType.USBIPOperationRequest:
+                usbip_log.warning("usbip client %s sent a command before importing a device", addr)
+                return
+            reply, _ = self.registry.handle_op(cmsg, None)
+            conn.sendall(reply)
+        except (OSError, ValueError, NotImplementedError) as e:
+            usbip_log.warning("usbip client %s: %s", addr, e)
+        finally:
+            conn.close()
+
+
+def _control_loop(bridge, sock: socket.socket):
+    # the worker's end: runs until the supervisor closes the control socket
+    while True:
+        msg, fds = _recv_msg(sock)
+        if msg is None:
+            for fd in fds:
+                os.close(fd)
+            return
+        op = msg["op"]
+        if op == "conn":
+            bridge.adopt(socket.socket(fileno=fds[0]), msg["addr"])
+        elif op == "devinfo":
+            _send_msg(sock, {"devs": {dev.busid: dev.devinfo() for dev in bridge.registry}})
+        elif op == "metrics":
+            metrics = bridge.metrics
+            _send_msg(sock, {"metrics": metrics.snapshot() if metrics is not None else {}})
+        else:
+            log.warning("unknown supervisor op %r", op)
@@ -1 +0,0 @@
-from usbip_toolkit.tools import usbiptk_sim_bridge
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import sys
+
+from usbip_toolkit.bench import (
+    BRIDGES,
+    BULK_MAX_PACKET_SIZE,
+    CONTROL_MAX_SIZE,
+    DEFAULT_BULK_SIZES,
+    DEFAULT_CONTROL_SIZES,
+    DEFAULT_DEPTHS,
+    DEFAULT_ISO_SIZES,
+    ISO_PACKET_SIZE,
+    SIM_LINKS,
+    bench_bridge,
+    bench_meta,
+    bench_startup,
+    sweep_cases,
+)
+from usbip_toolkit.proto import ISO_MAX_PACKETS
+from usbip_toolkit.proto_struct import CODECS
+
+
+def int_list(s: str) -> list:
+    return [int(v, 0) for v in s.split(",") if v]
+
+
+def print_progress(res):
+    print(
+        f"{res['bridge']:>8} {res['sim_link']:>4} {res['kind']:>7} {res['direction']:>3} "
+        f"{res['size']:>9} B "
+        f"depth {res['depth']:>3}: {res['urbs_per_sec']:9.0f} URBs/s {res['mb_per_sec']:8.2f} MB/s "
+        f"p50 {res['latency_us']['p50']:9.1f} us p99 {res['latency_us']['p99']:9.1f} us "
+        f"{res['bridge_cpu_us_per_urb']:8.1f} us CPU/URB",
+        file=sys.stderr,
+    )
+
+
+def print_startup(res):
+    print(
+        f"{res['bridge']:>8} startup: listening after {res['listen_ms']['p50']:7.1f} ms, "
+        f"--help {res['help_ms']['p50']:7.1f} ms, "
+        f"interpreter {res['interpreter_ms']['p50']:6.1f} ms",
+        file=sys.stderr,
+    )
+
+
+def write_report(args, report):
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+def real_main(args):
+    if args.startup:
+        results = []
+        for bridge in args.bridge or list(BRIDGES):
+            results.append(bench_startup(bridge, args.startup))
+            if not args.quiet:
+                print_startup(results[-1])
+        write_report(args, {"meta": bench_meta(args.codec, args.bulk_window), "startup": results})
+        return
+    for size in args.sizes:
+        if size % BULK_MAX_PACKET_SIZE:
+            sys.exit(f"bulk sizes must be multiples of {BULK_MAX_PACKET_SIZE}, got {size}")
+    for size in args.control_sizes:
+        if size > CONTROL_MAX_SIZE:
+            sys.exit(f"control sizes must be at most {CONTROL_MAX_SIZE}, got {size}")
+    for size in args.iso_sizes:
+        if not size or size % ISO_PACKET_SIZE or size // ISO_PACKET_SIZE > ISO_MAX_PACKETS:
+            sys.exit(
+                f"iso sizes must be 1 to {ISO_MAX_PACKETS} times {ISO_PACKET_SIZE}, got {size}"
+            )
+    cases = sweep_cases(
+        kinds=args.kinds.split(","),
+        directions=args.directions.split(","),
+        bulk_sizes=args.sizes,
+        control_sizes=args.control_sizes,
+        iso_sizes=args.iso_sizes,
+        depths=args.depths,
+        budget_bytes=int(args.budget_mb * 1024 * 1024),
+        min_urbs=args.min_urbs,
+        max_urbs=args.max_urbs,
+    )
+    results = []
+    for bridge in args.bridge or list(BRIDGES):
+        results += bench_bridge(
+            bridge,
+            cases,
+            codec=args.codec,
+            bulk_window=args.bulk_window,
+            trace_allocs=args.tracemalloc,
+            max_seconds=args.max_seconds,
+            progress=None if args.quiet else print_progress,
+            sim_link=args.sim_link,
+        )
+    write_report(args, {"meta": bench_meta(args.codec, args.bulk_window), "results": results})
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Benchmark bridge variants end to end against the reference device"
+    )
+    parser.add_argument(
+        "--bridge",
+        action="append",
+        choices=list(BRIDGES),
+        help="Bridge variant to benchmark, repeatable (default: all)",
+    )
+    parser.add_argument(
+        "--codec",
+        choices=list(CODECS),
+        default="struct",
+        help="USB/IP URB codec (struct is fast, construct is the reference)",
+    )
+    parser.add_argument(
+        "--bulk-window",
+        type=int,
+        default=8,
+        help="Bulk transactions kept in flight per endpoint (1 is stop-and-wait)",
+    )
+    parser.add_argument(
+        "--sim-link",
+        choices=SIM_LINKS,
+        default="tcp",
+        help="Transport between the bridge and the reference device",
+    )
+    parser.add_argument(
+        "--kinds",
+        default="control,bulk",
+        help="Comma separated transfer kinds to sweep: control, bulk, iso",
+    )
+    parser.add_argument(
+        "--directions", default="in,out", help="Comma separated bulk and iso directions to sweep"
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int_list,
+        default=list(DEFAULT_BULK_SIZES),
+        help="Comma separated bulk transfer sizes in bytes",
+    )
+    parser.add_argument(
+        "--control-sizes",
+        type=int_list,
+        default=list(DEFAULT_CONTROL_SIZES),
+        help="Comma separated control read sizes in bytes, 0 is a transfer without data stage",
+    )
+    parser.add_argument(
+        "--iso-sizes",
+        type=int_list,
+        default=list(DEFAULT_ISO_SIZES),
+        help=f"Comma separated iso URB sizes in bytes, of {ISO_PACKET_SIZE} byte packets",
+    )
+    parser.add_argument(
+        "--depths",
+        type=int_list,
+        default=list(DEFAULT_DEPTHS),
+        help="Comma separated numbers of URBs kept in flight",
+    )
+    parser.add_argument(
+        "--budget-mb", type=float, default=8, help="Approximate data moved per case"
+    )
+    parser.add_argument("--min-urbs", type=int, default=2, help="Fewest URBs per case")
+    parser.add_argument("--max-urbs", type=int, default=2000, help="Most URBs per case")
+    parser.add_argument(
+        "--max-seconds",
+        type=float,
+        default=5,
+        help="Stop submitting a case's URBs after this long (0 never stops early)",
+    )
+    parser.add_argument(
+        "--tracemalloc",
+        action="store_true",
+        help="Trace the bridge's allocations to report peak memory per case (slow)",
+    )
+    parser.add_argument(
+        "--startup",
+        type=int,
+        metavar="RUNS",
+        default=0,
+        help="Time RUNS cold starts of each bridge's CLI instead of sweeping transfers",
+    )
+    parser.add_argument("--output", metavar="PATH", help="Write the JSON report here, not stdout")
+    parser.add_argument("--quiet", action="store_true", help="No per-case progress on stderr")
+    args = parser.parse_args()
+    real_main(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import sys
+
+from usbip_toolkit.log import setup_logging
+from usbip_toolkit.proto_struct import CODECS, get_codec
+from usbip_toolkit.replay import load_trace, replay
+
+
+def real_main(args):
+    setup_logging(args.log_level.upper())
+    trace = load_trace(args.trace)
+    if trace.nunlinked:
+        print(f"skipping {trace.nunlinked} unlinked URBs", file=sys.stderr)
+    report = replay(
+        trace,
+        codec=get_codec(args.codec),
+        bulk_window=args.bulk_window,
+        speed=args.speed,
+        depth=args.depth,
+        ping=not args.no_ping,
+        probe_descriptors=args.probe_descriptors,
+        serve_descriptors=args.serve_descriptors,
+    )
+    if args.json:
+        json.dump(report.as_dict(), sys.stdout, indent=2)
+        print()
+    else:
+        print(report.format())
+    return 1 if report.mismatches else 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Replay a usbiptk-sim-bridge --capture through the URB engine, no simulator"
+    )
+    parser.add_argument(
+        "trace", nargs="+", help="pcapng capture, or every file of a rotated capture in order"
+    )
+    parser.add_argument(
+        "--codec",
+        choices=list(CODECS),
+        default="struct",
+        help="USB/IP URB codec (struct is fast, construct is the reference)",
+    )
+    parser.add_argument(
+        "--bulk-window",
+        type=int,
+        default=1,
+        help="Bulk transactions kept in flight per endpoint, must match the recording",
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=0.0,
+        help="Submit URBs at this multiple of the recorded pace (0 is as fast as possible)",
+    )
+    parser.add_argument(
+        "--depth",
+        type=int,
+        default=32,
+        help="URBs kept in flight per device at full speed (0 is unlimited)",
+    )
+    parser.add_argument(
+        "--no-ping",
+        action="store_true",
+        help="The recording was made with --no-ping, retry NAKed OUTs without PINGing first",
+    )
+    parser.add_argument(
+        "--probe-descriptors",
+        action="store_true",
+        help="The recording was made with --probe-descriptors, probe each device first",
+    )
+    parser.add_argument(
+        "--serve-descriptors",
+        action="store_true",
+        help="The recording was made with --serve-descriptors, answer repeats from the cache",
+    )
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    parser.add_argument("--log-level", default="WARNING", help="Log level for every channel")
+    args = parser.parse_args()
+    return real_main(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,34 +1,346 @@
 #!/usr/bin/env python3
 
 import argparse
+import os
 import sys
 
-from usbip_toolkit.sim_bridge import USBIPSimBridgeServer
-from usbip_toolkit.sim_bridge_aioreactive import USBIPSimBridgeServer_aioreactive
-from usbip_toolkit.sim_bridge_classic import USBIPSimBridgeServer_classic
-from usbip_toolkit.sim_bridge_rx import USBIPSimBridgeServer_rx
+from usbip_toolkit.backends import BACKENDS, load_backend
+from usbip_toolkit.capture import CaptureTap, PcapngWriter
+from usbip_toolkit.log import CHANNELS, LOG_FORMAT, parse_channel_levels, setup_logging
+from usbip_toolkit.metrics import JSONDumper, MetricsRegistry, serve_prometheus
+from usbip_toolkit.proto_struct import CODECS, get_codec
+from usbip_toolkit.transport import parse_endpoint, tcp_endpoint
+from usbip_toolkit.urb_engine import RetryPolicy
+from usbip_toolkit.usb import USB_SPEED_FULL, USB_SPEED_HIGH, USB_SPEED_LOW
 
+SPEEDS = {"low": USB_SPEED_LOW, "full": USB_SPEED_FULL, "high": USB_SPEED_HIGH}
 
-def real_main(args):
-    if args.aioreactive:
-        bridge = USBIPSimBridgeServer_aioreactive()
-    elif args.reactivex:
-        bridge = USBIPSimBridgeServer_rx()
-    elif args.classic:
-        bridge = USBIPSimBridgeServer_classic()
+
+def make_capture(args, path: str):
+    return CaptureTap(
+        PcapngWriter(
+            path,
+            max_bytes=int(args.capture_max_mb * 1024 * 1024),
+            max_files=args.capture_max_files,
+        )
+    )
+
+
+def make_bridge(args, retry, capture, metrics, **kwargs):
+    # the asyncio or classic bridge as the args ask, kwargs say which devices it exports
+    cls = load_backend(args.backend)
+    if args.backend == "classic":
+        return cls(
+            codec=get_codec(args.codec),
+            verify=args.verify,
+            sim_flush_bytes=args.sim_flush_bytes,
+            sim_flush_latency=args.sim_flush_latency_us / 1e6,
+            client_budget=int(args.client_budget_mb * 1024 * 1024),
+            bulk_window=args.bulk_window,
+            retry=retry,
+            capture=capture,
+            metrics=metrics,
+            probe_descriptors=args.probe_descriptors,
+            serve_descriptors=args.serve_descriptors,
+            usbip_endpoint=args.usbip_listen,
+            speed=SPEEDS[args.speed],
+            **kwargs,
+        )
+    return cls(
+        codec=get_codec(args.codec),
+        verify=args.verify,
+        bulk_window=args.bulk_window,
+        retry=retry,
+        capture=capture,
+        metrics=metrics,
+        probe_descriptors=args.probe_descriptors,
+        serve_descriptors=args.serve_descriptors,
+        usbip_endpoint=args.usbip_listen,
+        speed=SPEEDS[args.speed],
+        **kwargs,
+    )
+
+
+def serve_metrics(args, metrics):
+    # -> the JSONDumper to stop on the way out, if any
+    if args.metrics_port is not None:
+        serve_prometheus(metrics, args.metrics_port, args.metrics_host)
+    if args.metrics_json:
+        return JSONDumper(metrics, args.metrics_json, args.metrics_interval).start()
+    return None
+
+
+def run_workers(args, retry) -> int:
+    # a worker process per device, each with its own capture file and metrics registry
+    from usbip_toolkit.supervisor import Supervisor
+
+    sim_endpoint = parse_endpoint(args.sim_listen or tcp_endpoint("localhost", 2443))
+    want_metrics = args.metrics_port is not None or args.metrics_json
+
+    def setup_worker(i):
+        setup_logging(
+            args.log_level.upper(),
+            parse_channel_levels(args.log),
+            background=not args.log_sync,
+            fmt=f"[{supervisor.workers[i].busid}] {LOG_FORMAT}",
+        )
+
+    def make_worker_bridge(i):
+        capture = None
+        if args.capture:
+            root, ext = os.path.splitext(args.capture)
+            capture = make_capture(args, f"{root}-{supervisor.workers[i].busid}{ext}")
+        return make_bridge(
+            args,
+            retry,
+            capture,
+            MetricsRegistry() if want_metrics else None,
+            devnum=supervisor.devnum + i,
+            sim_endpoint=sim_endpoint.nth(i),
+        )
+
+    supervisor = Supervisor(
+        make_worker_bridge,
+        args.num_devices,
+        usbip_endpoint=args.usbip_listen,
+        setup_worker=setup_worker,
+    )
+    supervisor.start_workers()
+    dumper = serve_metrics(args, supervisor.metrics) if want_metrics else None
+    try:
+        ok = supervisor.serve()
+    finally:
+        if dumper is not None:
+            dumper.stop()
+    return 0 if ok else 1
+
+
+def real_main(args) -> int:
+    setup_logging(
+        args.log_level.upper(), parse_channel_levels(args.log), background=not args.log_sync
+    )
+    retry = RetryPolicy(
+        spins=args.nak_spins,
+        backoff_min=args.nak_backoff_us / 1e6,
+        backoff_max=args.nak_backoff_max_us / 1e6,
+        max_naks=args.max_naks,
+        ping=not args.no_ping,
+    )
+    if args.workers:
+        return run_workers(args, retry)
+    capture = make_capture(args, args.capture) if args.capture else None
+    metrics = None
+    dumper = None
+    if args.metrics_port is not None or args.metrics_json:
+        metrics = MetricsRegistry()
+        dumper = serve_metrics(args, metrics)
+    if args.backend in ("aioreactive", "reactivex"):
+        bridge = load_backend(args.backend)()
     else:
-        bridge = USBIPSimBridgeServer()
-    bridge.serve()
+        bridge = make_bridge(
+            args,
+            retry,
+            capture,
+            metrics,
+            num_devices=args.num_devices,
+            sim_endpoint=args.sim_listen,
+        )
+    try:
+        bridge.serve()
+    finally:
+        if dumper is not None:
+            dumper.stop()
+        if capture is not None:
+            capture.close()
+    return 0
 
 
 def main() -> int:
     parser = argparse.ArgumentParser(description="usbiptk-sim-bridge")
-    parser.add_argument("--aioreactive", action="store_true", help="Use aioreactive server")
-    parser.add_argument("--reactivex", action="store_true", help="Use ReactiveX server")
-    parser.add_argument("--classic", action="store_true", help="Use classic server")
+    backend = parser.add_mutually_exclusive_group()
+    backend.add_argument(
+        "--backend",
+        choices=list(BACKENDS),
+        default="asyncio",
+        help="Bridge implementation, only its module is imported (default: asyncio)",
+    )
+    backend.add_argument(
+        "--aioreactive",
+        dest="backend",
+        action="store_const",
+        const="aioreactive",
+        help="Use aioreactive server",
+    )
+    backend.add_argument(
+        "--reactivex",
+        dest="backend",
+        action="store_const",
+        const="reactivex",
+        help="Use ReactiveX server",
+    )
+    backend.add_argument(
+        "--classic",
+        dest="backend",
+        action="store_const",
+        const="classic",
+        help="Use classic server",
+    )
+    parser.add_argument(
+        "--codec",
+        choices=list(CODECS),
+        default="struct",
+        help="USB/IP URB codec (struct is fast, construct is the reference)",
+    )
+    parser.add_argument(
+        "--verify", action="store_true", help="Check that every parsed packet rebuilds identically"
+    )
+    parser.add_argument(
+        "--sim-flush-bytes",
+        type=int,
+        default=64 * 1024,
+        help="Coalesce simulator writes until this many bytes are queued",
+    )
+    parser.add_argument(
+        "--sim-flush-latency-us",
+        type=float,
+        default=0.0,
+        help="Wait up to this long for more simulator writes before flushing",
+    )
+    parser.add_argument(
+        "--client-budget-mb",
+        type=float,
+        default=64.0,
+        help="Stop reading a usbip client while its URBs and unsent replies hold this much "
+        "memory, 0 for no limit (classic only)",
+    )
+    parser.add_argument(
+        "--bulk-window",
+        type=int,
+        default=1,
+        help="Bulk transactions kept in flight per endpoint, OUT is capped at 2 (1 is "
+        "stop-and-wait)",
+    )
+    parser.add_argument(
+        "--nak-spins",
+        type=int,
+        default=2,
+        help="NAKs in a row retried at once before a pipe starts backing off",
+    )
+    parser.add_argument(
+        "--nak-backoff-us",
+        type=float,
+        default=20.0,
+        help="First backoff after the spins, doubling on every further NAK (0 never waits)",
+    )
+    parser.add_argument(
+        "--nak-backoff-max-us", type=float, default=1000.0, help="Longest backoff between retries"
+    )
+    parser.add_argument(
+        "--max-naks",
+        type=int,
+        default=0,
+        help="Fail a URB with -ETIMEDOUT after this many NAKs in a row (0 retries for ever)",
+    )
+    parser.add_argument(
+        "--no-ping",
+        action="store_true",
+        help="Retry NAKed bulk OUTs with the data instead of polling with PING first",
+    )
+    parser.add_argument(
+        "--num-devices",
+        type=int,
+        default=1,
+        help="Devices to export, device N's simulator connects to the sim port + N",
+    )
+    parser.add_argument(
+        "--speed",
+        choices=list(SPEEDS),
+        default="high",
+        help="Speed the devices are exported at, periodic intervals are in frames below high",
+    )
+    parser.add_argument(
+        "--workers",
+        action="store_true",
+        help="Serve each device from a worker process of its own, a supervisor keeps the usbip "
+        "port and hands each import to the device's worker (asyncio and classic only)",
+    )
+    parser.add_argument(
+        "--usbip-listen",
+        metavar="URL",
+        help="Take usbip clients here instead of tcp://localhost:3240, tcp://0.0.0.0:3240 for "
+        "every interface (see usbip_toolkit.transport, ?sndbuf=&rcvbuf= size the buffers)",
+    )
+    parser.add_argument(
+        "--sim-listen",
+        metavar="URL",
+        help="Take simulators here instead of tcp://localhost:2443: a tcp://, unix:PATH or "
+        "shm:PATH endpoint, device N's at the port + N or PATH.N",
+    )
+    parser.add_argument(
+        "--probe-descriptors",
+        action="store_true",
+        help="Read each device's descriptors when its simulator connects, for the devlist and "
+        "import replies",
+    )
+    parser.add_argument(
+        "--serve-descriptors",
+        action="store_true",
+        help="Answer GET_DESCRIPTOR from descriptors the device already returned once",
+    )
+    parser.add_argument(
+        "--capture", metavar="PATH", help="Capture both links to a pcapng file for Wireshark"
+    )
+    parser.add_argument(
+        "--capture-max-mb",
+        type=float,
+        default=0,
+        help="Rotate the capture into numbered files of about this size (0 never rotates)",
+    )
+    parser.add_argument(
+        "--capture-max-files",
+        type=int,
+        default=0,
+        help="Keep only this many of the newest rotated capture files (0 keeps all)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve counters, queue depths and latency histograms as Prometheus text over HTTP",
+    )
+    parser.add_argument(
+        "--metrics-host", default="localhost", help="Address to serve --metrics-port on"
+    )
+    parser.add_argument(
+        "--metrics-json", metavar="PATH", help="Periodically dump the metrics to a JSON file"
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=10.0,
+        help="Seconds between --metrics-json dumps",
+    )
+    parser.add_argument(
+        "--log-level", default="INFO", help="Log level for every channel (DEBUG dumps packets)"
+    )
+    parser.add_argument(
+        "--log",
+        action="append",
+        metavar="CHANNEL=LEVEL",
+        help=f"Override the log level of one channel ({', '.join(CHANNELS)}), repeatable",
+    )
+    parser.add_argument(
+        "--log-sync",
+        action="store_true",
+        help="Write log records from the logging thread instead of a background writer",
+    )
     args = parser.parse_args()
-    real_main(args)
-    return 0
+    if args.workers and args.backend not in ("asyncio", "classic"):
+        parser.error("--workers needs the asyncio or classic bridge")
+    try:
+        load_backend(args.backend)
+    except ImportError as e:
+        parser.error(str(e))
+    return real_main(args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+from threading import Thread
+
+from usbip_toolkit.device import USBDevice, reference_endpoints, run_sim_device
+from usbip_toolkit.log import setup_logging
+from usbip_toolkit.transport import parse_endpoint
+
+
+def real_main(args):
+    setup_logging(args.log_level.upper())
+    endpoint = parse_endpoint(args.connect) if args.connect else None
+    threads = []
+    for i in range(args.num_devices):
+        dev = USBDevice(
+            reference_endpoints(
+                loopback_depth=args.loopback_depth,
+                source_transfer_size=args.source_transfer_size,
+                iso=args.iso,
+            )
+        )
+        thread = Thread(
+            target=run_sim_device,
+            args=(dev, args.host, args.port + i, args.connect_timeout),
+            kwargs={"endpoint": endpoint.nth(i) if endpoint is not None else None},
+            name=f"sim_device{i}",
+        )
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Reference USB device for usbiptk-sim-bridge: EP1 loopback, EP2 sink/source"
+    )
+    parser.add_argument("--host", default="localhost", help="Bridge host")
+    parser.add_argument(
+        "--port", type=int, default=2443, help="Bridge sim port of the first device"
+    )
+    parser.add_argument(
+        "--connect",
+        metavar="URL",
+        help="Connect to the bridge's --sim-listen endpoint instead of --host and --port",
+    )
+    parser.add_argument(
+        "--num-devices",
+        type=int,
+        default=1,
+        help="Devices to run, device N connects to port + N (or PATH.N) like the bridge expects",
+    )
+    parser.add_argument(
+        "--loopback-depth",
+        type=int,
+        default=64,
+        help="Packets EP1 OUT buffers for EP1 IN before it NAKs",
+    )
+    parser.add_argument(
+        "--source-transfer-size",
+        type=int,
+        default=0,
+        help="End every this many EP2 IN bytes with a short packet (0 streams full packets)",
+    )
+    parser.add_argument(
+        "--iso",
+        action="store_true",
+        help="Add an isochronous sink on EP3 OUT and source on EP3 IN, 1024 bytes a microframe",
+    )
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=10.0,
+        help="Keep retrying the bridge connection for this long",
+    )
+    parser.add_argument("--log-level", default="INFO", help="Log level for every channel")
+    args = parser.parse_args()
+    real_main(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
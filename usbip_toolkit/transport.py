@@ -0,0 +1,240 @@
+import asyncio
+import errno
+import os
+import socket
+import time
+from collections import deque
+from threading import Lock
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from usbip_toolkit.shm import shm_connect, shm_path
+from usbip_toolkit.util import get_tcp_server_socket, tune_socket
+
+# Where a link listens, or connects to, written as a URL:
+#
+#   tcp://HOST:PORT   TCP with Nagle off (nodelay=0 turns it back on), "" or 0.0.0.0 as HOST
+#                     for every interface, [::1] for IPv6
+#   unix:PATH         a unix domain stream socket, unix:@NAME in Linux's abstract namespace
+#   pair:NAME         a socketpair with connect_endpoint() in the same process, for a simulator
+#                     that runs in the bridge's interpreter
+#   shm:PATH          the shared-memory sim link of shm.py
+#
+# tcp, unix and pair take ?sndbuf=BYTES&rcvbuf=BYTES to size the socket buffers. Both links
+# frame their packets the same way on every transport, so only the socket differs.
+
+SCHEMES = ("tcp", "unix", "pair", "shm")
+_OPTIONS = {
+    "nodelay": ("tcp",),
+    "sndbuf": ("tcp", "unix", "pair"),
+    "rcvbuf": ("tcp", "unix", "pair"),
+}
+
+
+class Endpoint:
+    __slots__ = ("scheme", "host", "port", "path", "options")
+
+    def __init__(
+        self, scheme: str, host: str = None, port: int = None, path: str = None, options=None
+    ):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.path = path
+        # option name -> int
+        self.options = options or {}
+
+    def __repr__(self):
+        return f"Endpoint({str(self)!r})"
+
+    def __str__(self):
+        if self.scheme == "tcp":
+            host = f"[{self.host}]" if ":" in self.host else self.host
+            url = f"tcp://{host}:{self.port}"
+        else:
+            url = f"{self.scheme}:{self.path}"
+        if self.options:
+            url += "?" + urlencode(self.options)
+        return url
+
+    def nth(self, i: int) -> "Endpoint":
+        # where device i of a bridge is, port + i or PATH.i
+        if self.scheme == "tcp":
+            return Endpoint("tcp", self.host, self.port + i, options=self.options)
+        return Endpoint(self.scheme, path=shm_path(self.path, i), options=self.options)
+
+    def tune(self, sock):
+        # sets the endpoint's options on a connected socket
+        nodelay = bool(self.options.get("nodelay", 1)) if self.scheme == "tcp" else None
+        tune_socket(sock, nodelay, self.options.get("sndbuf", 0), self.options.get("rcvbuf", 0))
+
+
+def tcp_endpoint(host: str, port: int) -> Endpoint:
+    return Endpoint("tcp", host, port)
+
+
+def parse_endpoint(url) -> Endpoint:
+    # an Endpoint passes through unchanged
+    if isinstance(url, Endpoint):
+        return url
+    parts = urlsplit(url)
+    scheme = parts.scheme
+    if scheme not in SCHEMES:
+        raise ValueError(f"{url!r} is not an endpoint URL ({', '.join(SCHEMES)})")
+    options = {}
+    for name, val in parse_qsl(parts.query):
+        if scheme not in _OPTIONS.get(name, ()):
+            raise ValueError(f"{url!r}: {scheme} endpoints have no {name} option")
+        options[name] = int(val)
+    if scheme == "tcp":
+        if parts.port is None:
+            raise ValueError(f"{url!r} has no port")
+        return Endpoint("tcp", parts.hostname or "", parts.port, options=options)
+    path = parts.netloc + parts.path
+    if not path:
+        raise ValueError(f"{url!r} has no path")
+    return Endpoint(scheme, path=path, options=options)
+
+
+def _unix_address(path: str):
+    return "\0" + path[1:] if path.startswith("@") else path
+
+
+# name -> PairListener listening on pair:name
+_pair_listeners = {}
+_pair_lock = Lock()
+
+
+class PairListener:
+    # stands in for a listening socket on pair:NAME, connect_endpoint() hands it one end of a
+    # socketpair. fileno() is readable while a connection waits to be accepted.
+
+    def __init__(self, name: str):
+        with _pair_lock:
+            if name in _pair_listeners:
+                raise OSError(errno.EADDRINUSE, f"pair:{name} is already listening")
+            _pair_listeners[name] = self
+        self.name = name
+        self._pending = deque()
+        self._ready, self._notify = socket.socketpair()
+
+    def fileno(self) -> int:
+        return self._ready.fileno()
+
+    def listen(self, backlog: int = 0):
+        pass
+
+    def setblocking(self, flag: bool):
+        self._ready.setblocking(flag)
+
+    def _connect(self) -> socket.socket:
+        ours, theirs = socket.socketpair()
+        self._pending.append(theirs)
+        self._notify.send(b"\0")
+        return ours
+
+    def accept(self):
+        # raises BlockingIOError if not blocking and nothing is waiting
+        self._ready.recv(1)
+        return self._pending.popleft(), f"pair:{self.name}"
+
+    def close(self):
+        with _pair_lock:
+            if _pair_listeners.get(self.name) is self:
+                del _pair_listeners[self.name]
+        self._ready.close()
+        self._notify.close()
+        while self._pending:
+            self._pending.popleft().close()
+
+
+def server_socket(endpoint: Endpoint):
+    # -> a bound socket to listen() on, like get_tcp_server_socket(). shm endpoints have their
+    # own ShmListener.
+    if endpoint.scheme == "tcp":
+        return get_tcp_server_socket(endpoint.port, endpoint.host, **endpoint.options)
+    if endpoint.scheme == "unix":
+        addr = _unix_address(endpoint.path)
+        if not addr.startswith("\0") and os.path.exists(addr):
+            # left behind by an earlier bridge
+            os.unlink(addr)
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        endpoint.tune(s)
+        s.bind(addr)
+        return s
+    if endpoint.scheme == "pair":
+        return PairListener(endpoint.path)
+    raise ValueError(f"{endpoint} has no server socket")
+
+
+def connect_endpoint(endpoint: Endpoint, retry_for: float = 0.0):
+    # -> a connected socket, or for shm: a ShmLink. Keeps retrying for retry_for seconds while
+    # nothing is listening yet.
+    if endpoint.scheme == "shm":
+        return shm_connect(endpoint.path, retry_for)
+    deadline = time.monotonic() + retry_for
+    while True:
+        try:
+            sock = _connect(endpoint)
+            break
+        except (ConnectionRefusedError, FileNotFoundError):
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+    endpoint.tune(sock)
+    return sock
+
+
+def _connect(endpoint: Endpoint) -> socket.socket:
+    if endpoint.scheme == "tcp":
+        return socket.create_connection((endpoint.host or "localhost", endpoint.port))
+    if endpoint.scheme == "unix":
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(_unix_address(endpoint.path))
+        except OSError:
+            sock.close()
+            raise
+        return sock
+    with _pair_lock:
+        listener = _pair_listeners.get(endpoint.path)
+    if listener is None:
+        raise ConnectionRefusedError(errno.ECONNREFUSED, f"nothing listens on {endpoint}")
+    return listener._connect()
+
+
+class _PairServer:
+    # what asyncio.start_server() would return for a PairListener
+    def __init__(self, listener: PairListener, client_connected_cb):
+        self.listener = listener
+        self.client_connected_cb = client_connected_cb
+        self._tasks = set()
+
+    async def serve_forever(self):
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        self.listener.setblocking(False)
+        loop.add_reader(self.listener.fileno(), ready.set)
+        try:
+            while True:
+                await ready.wait()
+                ready.clear()
+                while True:
+                    try:
+                        conn, _ = self.listener.accept()
+                    except BlockingIOError:
+                        break
+                    reader, writer = await asyncio.open_connection(sock=conn)
+                    task = loop.create_task(self.client_connected_cb(reader, writer))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+        finally:
+            loop.remove_reader(self.listener.fileno())
+            self.listener.close()
+
+
+async def start_server(client_connected_cb, endpoint: Endpoint):
+    # asyncio.start_server() on an endpoint, -> something to serve_forever()
+    sock = server_socket(endpoint)
+    if endpoint.scheme == "pair":
+        return _PairServer(sock, client_connected_cb)
+    return await asyncio.start_server(client_connected_cb, sock=sock)
@@ -0,0 +1,1160 @@
+import errno
+import struct
+from collections import deque
+from time import monotonic, perf_counter_ns, sleep
+
+from usbip_toolkit.descriptors import DEVICE_DESCRIPTOR_SIZE, DescriptorCache
+from usbip_toolkit.log import DEBUG, LazyHex, urb_log
+from usbip_toolkit.proto import *
+from usbip_toolkit.proto_struct import StructCodec, build_cmd_submit
+from usbip_toolkit.usb import *
+
+# The URB state machine is written sans-IO so every bridge can drive it. Each handler is a
+# generator that yields (packets, nresp): the packets to send to the simulator in order and
+# the number of simulator responses it needs back. The driver sends the list of responses
+# into the generator, and the generator's return value is the encoded RET_SUBMIT. A handler
+# waiting out a NAKing device yields (WAIT, seconds) instead.
+
+# status and actual_length of an encoded RET_SUBMIT
+_ret_status_len = struct.Struct(">20xii")
+
+# Yielded as (WAIT, seconds) in place of (packets, nresp): the handler has nothing to send
+# until that much time has passed. Drivers park the URB's pipe meanwhile and serve the others.
+WAIT = None
+
+_DATA_PIDS = (PID.DAT_DATA0, PID.DAT_DATA1)
+# handshakes that accept an OUT packet, NYET also asks for a PING before the next one
+_OUT_ACCEPTED = (PID.HND_ACK, PID.HND_NYET)
+# handshakes to an OUT packet sent after one the device NAKed, it was dropped and goes again
+_OUT_RESENDABLE = (PID.HND_ACK, PID.HND_NYET, PID.HND_NACK)
+# most bulk OUT packets in flight, see handle_bulk_out_windowed()
+_OUT_WINDOW = 2
+_ISO_IN_PIDS = (PID.DAT_DATA0, PID.DAT_DATA1, PID.DAT_DATA2)
+# PIDs of the OUT transactions of one high-bandwidth iso packet, by transaction count
+_ISO_OUT_PIDS = {
+    1: (PID.DAT_DATA0,),
+    2: (PID.DAT_MDATA, PID.DAT_DATA1),
+    3: (PID.DAT_MDATA, PID.DAT_MDATA, PID.DAT_DATA2),
+}
+# IN transactions still to come in the microframe after one with this PID
+_ISO_IN_MORE = {PID.DAT_DATA0: 0, PID.DAT_DATA1: 1, PID.DAT_DATA2: 2}
+# most iso packets that go to the simulator in one round trip
+ISO_BATCH = 32
+# bmRequestType and bRequest of a standard GET_DESCRIPTOR for the device
+_GET_DEVICE_DESCRIPTOR = bytes((Dir.IN, Req.GET_DESCRIPTOR))
+
+
+class NakTimeout(Exception):
+    pass
+
+
+class RetryPolicy:
+    # How a NAKed transaction is re-issued. The first spins retries go straight back out (the
+    # scheduler gives every other pipe a turn in between), after that the pipe waits, starting
+    # at backoff_min seconds and doubling up to backoff_max. max_naks 0 retries for ever like a
+    # host controller, an unlink from the client is what times a transfer out. With ping set, a
+    # NAK or NYET on a bulk OUT endpoint makes the next OUT wait for a PING to be ACKed first,
+    # so a busy device is polled with 3 byte tokens instead of whole data packets.
+
+    def __init__(
+        self,
+        spins: int = 2,
+        backoff_min: float = 20e-6,
+        backoff_max: float = 1e-3,
+        max_naks: int = 0,
+        ping: bool = True,
+    ):
+        self.spins = spins
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.max_naks = max_naks
+        self.ping = ping
+
+    def delay(self, naks: int) -> float:
+        # -> seconds to wait after the naks'th NAK in a row
+        if naks <= self.spins or self.backoff_min <= 0:
+            return 0.0
+        return min(self.backoff_max, self.backoff_min * (1 << min(naks - self.spins - 1, 30)))
+
+
+class URBEngine:
+    def __init__(
+        self,
+        codec=StructCodec,
+        busnum: int = 47,
+        devnum: int = 6,
+        bulk_window: int = 1,
+        metrics=None,
+        retry: RetryPolicy = None,
+        serve_descriptors: bool = False,
+        speed: int = USB_SPEED_HIGH,
+    ):
+        self.codec = codec
+        self.busnum = busnum
+        self.devnum = devnum
+        # a USB_SPEED_*, full- and low-speed periodic intervals count 1 ms frames
+        self.speed = speed
+        # the (micro)frame clock SOFs and interrupt polling run on
+        self._t0 = monotonic()
+        # data toggles, OUT endpoints first then IN endpoints
+        self._odds = [False] * USB_MAX_ENDPOINTS
+        # per OUT endpoint, the device NAKed or NYETed and gets PINGed before the next OUT
+        self._ping = [False] * (USB_MAX_ENDPOINTS // 2)
+        # number of bulk transactions kept in flight per endpoint, 1 is stop-and-wait
+        self.bulk_window = bulk_window
+        # IN payloads that arrived after a short packet ended the URB they were fetched for
+        self._in_carry = [deque() for _ in range(USB_MAX_ENDPOINTS // 2)]
+        # endpoint address -> EndpointInfo of the active configuration and alternate settings,
+        # learned from the configuration descriptor as the client reads it
+        self.ep_info = {}
+        # (bInterfaceNumber, bAlternateSetting) -> [EndpointInfo], every alternate setting
+        self._ep_alts = {}
+        # every complete descriptor the device has returned, outlives client connections but
+        # not the simulator
+        self.descriptors = DescriptorCache()
+        # answer GET_DESCRIPTORs that are in the cache without asking the device again
+        self.serve_descriptors = serve_descriptors
+        # bMaxPacketSize0, a short packet ends a control data stage
+        self._max_packet_size0 = 64
+        # microframe each periodic endpoint may next be polled in, indexed like _odds
+        self._next_poll = [0] * USB_MAX_ENDPOINTS
+        self._setup_addr_done = False
+        # a metrics.URBMetrics, or None to not instrument
+        self.metrics = metrics
+        self.retry = retry if retry is not None else RetryPolicy()
+
+    @staticmethod
+    def _send(bufs):
+        yield bufs, 0
+
+    @staticmethod
+    def _xact(bufs):
+        resps = yield bufs, 1
+        return resps[0]
+
+    @staticmethod
+    def _xact_n(bufs, nresp):
+        return (yield bufs, nresp)
+
+    def _backoff(self, naks):
+        if self.retry.max_naks and naks >= self.retry.max_naks:
+            raise NakTimeout(f"{naks} NAKs in a row")
+        delay = self.retry.delay(naks)
+        if delay > 0:
+            yield WAIT, delay
+
+    def _xact_retry(self, bufs):
+        # one transaction, sent again for as long as the device NAKs it
+        naks = 0
+        while True:
+            resp = yield from self._xact(bufs)
+            if resp[0] & 0xF != PID.HND_NACK:
+                return resp
+            naks += 1
+            yield from self._backoff(naks)
+
+    def _ping_wait(self, addr, ep):
+        # -> 0 once the device ACKs a PING, -EPIPE if it STALLs
+        resp = yield from self._xact_retry([token_addr_packet(PID.SPC_PING, addr, ep)])
+        pid = resp[0] & 0xF
+        if pid == PID.HND_ACK:
+            self._ping[ep] = False
+            return 0
+        if pid == PID.HND_STALL:
+            return -errno.EPIPE
+        urb_log.warning("PING ep %d answered with %s", ep, LazyHex(resp))
+        return -errno.EPROTO
+
+    def _reset_toggles(self, ep_addr=None):
+        # after CLEAR_FEATURE(ENDPOINT_HALT) of ep_addr, or SET_CONFIGURATION/SET_INTERFACE for
+        # every endpoint, the device starts each pipe over at DATA0
+        eps = range(1, USB_MAX_ENDPOINTS // 2) if ep_addr is None else (ep_addr & 0xF,)
+        for ep in eps:
+            if ep_addr is None or not ep_addr & Dir.IN:
+                self._odds[ep] = False
+                self._ping[ep] = False
+            if ep_addr is None or ep_addr & Dir.IN:
+                self._odds[USB_MAX_ENDPOINTS // 2 + ep] = False
+                self._in_carry[ep].clear()
+
+    def reset_device(self):
+        # a new simulator connected, its device is back at address 0 with every pipe at DATA0,
+        # and may not even be the same design
+        self._setup_addr_done = False
+        self._reset_toggles()
+        self._next_poll = [0] * USB_MAX_ENDPOINTS
+        self.descriptors.clear()
+        self._ep_alts = {}
+        self.ep_info = {}
+        self._max_packet_size0 = 64
+
+    @property
+    def microframe(self) -> int:
+        # 125 us microframes since the engine started
+        return int((monotonic() - self._t0) * 8000)
+
+    @property
+    def frame_num(self):
+        # the 11 bit frame number an SOF sent now carries
+        return (self.microframe >> 3) & ((1 << 11) - 1)
+
+    def odd(self, endpoint):
+        res = self._odds[endpoint]
+        self._odds[endpoint] = not res
+        return res
+
+    def reset_odd(self, endpoint):
+        self._odds[endpoint] = False
+
+    def setup_addr(self):
+        if self._setup_addr_done:
+            # a probe got there first
+            return
+        dev = 0
+        ep = 0
+        setup_token = setup_token_packet(dev, ep)
+        setup_data = setup_data_packet(Recip.DEVICE, Dir.OUT, Req.SET_ADDRESS, self.devnum, 0, 0)
+        self.reset_odd(ep)
+        self.odd(ep)
+        setup_resp = yield from self._xact([setup_token, setup_data])
+        if setup_resp != ack_packet():
+            raise ValueError(f"SET_ADDRESS setup_resp: {setup_resp.hex(' ')}")
+        in_token = in_token_packet(0, 0)
+        yield from self._send([sof_packet(self.frame_num)])
+        resp_data = yield from self._xact_retry([in_token])
+        resp_data_gold = data_packet(b"", odd=self.odd(ep))
+        if resp_data != resp_data_gold:
+            raise ValueError(f"resp actual: {resp_data.hex(' ')} gold: {resp_data_gold.hex(' ')}")
+        yield from self._send([ack_packet()])
+        self._setup_addr_done = True
+
+    def handle_control(self, urb):
+        if len(urb.body.transfer_buffer):
+            raise NotImplementedError("setup packet with extra data? NYET!")
+        ep = 0
+        setup = urb.body.setup
+        is_in = setup[0] & Dir.IN != 0
+        m = self.metrics
+        if m is not None:
+            t = perf_counter_ns()
+        # setup phase, a device can neither NAK nor STALL a SETUP
+        setup_token = setup_token_packet(urb.devid_devnum, ep)
+        self.reset_odd(ep)
+        setup_data = data_packet(setup, odd=False)
+        setup_resp = yield from self._xact([setup_token, setup_data])
+        urb_log.debug("setup_resp: %s", LazyHex(setup_resp))
+        if setup_resp != ack_packet():
+            urb_log.warning("got bad setup_resp: %s", LazyHex(setup_resp))
+            return self.codec.build_ret_submit(urb, status=-errno.EPROTO, error_count=1)
+        if m is not None:
+            t = self._phase_done(m.control_setup, t)
+        setup_resp_data = b""
+        if urb.body.transfer_buffer_length:
+            # data phase
+            in_token = in_token_packet(urb.devid_devnum, ep)
+            odd = True
+            while len(setup_resp_data) < urb.body.transfer_buffer_length:
+                full_buf = yield from self._xact_retry([in_token])
+                pid = full_buf[0] & 0xF
+                if pid not in _DATA_PIDS:
+                    return self._control_failed(urb, "data", full_buf, setup_resp_data)
+                yield from self._send([ack_packet()])
+                if (pid == PID.DAT_DATA1) != odd:
+                    # our ACK got lost and the device sent the packet again
+                    continue
+                odd = not odd
+                buf = full_buf[1:-2]
+                setup_resp_data += buf
+                if len(buf) != self._max_packet_size0:
+                    break
+            if m is not None:
+                t = self._phase_done(m.control_data, t)
+        urb_log.debug("setup_resp_data: %s", LazyHex(setup_resp_data))
+        # status phase
+        status_zlp = data_packet(b"", odd=True)
+        if is_in:
+            out_token = out_token_packet(urb.devid_devnum, ep)
+            self.reset_odd(ep)
+            status_resp = yield from self._xact_retry([out_token, status_zlp])
+            urb_log.debug("status_resp: %s", LazyHex(status_resp))
+            if status_resp != ack_packet():
+                return self._control_failed(urb, "status", status_resp, setup_resp_data)
+        else:
+            in_token = in_token_packet(urb.devid_devnum, ep)
+            zlp_resp = yield from self._xact_retry([in_token])
+            if zlp_resp[0] & 0xF not in _DATA_PIDS:
+                return self._control_failed(urb, "status", zlp_resp, setup_resp_data)
+            if zlp_resp != status_zlp:
+                urb_log.warning(
+                    "status ZLP %s, expected %s", LazyHex(zlp_resp), LazyHex(status_zlp)
+                )
+            yield from self._send([ack_packet()])
+        if m is not None:
+            self._phase_done(m.control_status, t)
+        if setup[0] & 0x60 == 0:
+            self._snoop_standard_request(setup, setup_resp_data)
+        return self.codec.build_ret_submit(urb, transfer_buffer=setup_resp_data)
+
+    def _snoop_standard_request(self, setup, data):
+        # tracks the endpoints and data toggles of a standard request that just completed
+        req = setup[1]
+        if req == Req.GET_DESCRIPTOR and setup[0] & 0x1F == Recip.DEVICE:
+            wValue = setup[2] | setup[3] << 8
+            # the first read is usually just a header, to learn bMaxPacketSize0 or wTotalLength
+            stored = self.descriptors.store(wValue, setup[4] | setup[5] << 8, data)
+            if setup[3] == DescType.DEVICE >> 8 and len(data) >= 8 and data[7] in (8, 16, 32, 64):
+                self._max_packet_size0 = data[7]
+            elif (
+                stored
+                and setup[3] == DescType.CONFIGURATION >> 8
+                and setup[2] == 0
+                and not self.descriptors.configuration
+            ):
+                # until SET_CONFIGURATION picks one, the endpoints of the first configuration
+                self._ep_alts = parse_config_endpoints(data)
+                self.ep_info = self._default_endpoints()
+                urb_log.debug("endpoints: %s", list(self.ep_info.values()))
+        elif req == Req.CLEAR_FEATURE and setup[0] & 0x1F == Recip.ENDPOINT:
+            if setup[2] == Feature.ENDPOINT_HALT:
+                self._reset_toggles(setup[4])
+        elif req == Req.SET_CONFIGURATION:
+            self._reset_toggles()
+            self.descriptors.configuration = setup[2]
+            if self.descriptors.config_by_value(setup[2]) is not None:
+                self._ep_alts = self.descriptors.endpoints(setup[2])
+            # configuration 0 is the unconfigured state, no endpoints besides ep0
+            self.ep_info = self._default_endpoints() if setup[2] else {}
+        elif req == Req.SET_INTERFACE:
+            intf, alt = setup[4], setup[2]
+            if not self._ep_alts:
+                self._reset_toggles()
+            for (i, a), eps in self._ep_alts.items():
+                if i != intf:
+                    continue
+                for ep in eps:
+                    self._reset_toggles(ep.addr)
+                    if a == alt:
+                        self.ep_info[ep.addr] = ep
+                    elif self.ep_info.get(ep.addr) is ep:
+                        del self.ep_info[ep.addr]
+
+    def _default_endpoints(self) -> dict:
+        # every interface in alternate setting 0
+        return {ep.addr: ep for (_, alt), eps in self._ep_alts.items() if alt == 0 for ep in eps}
+
+    def _control_failed(self, urb, stage, resp, data):
+        # a STALL is the device refusing the request, -EPIPE like a host controller reports it
+        if resp[0] & 0xF == PID.HND_STALL:
+            urb_log.debug("control request %s STALLed in %s stage", LazyHex(urb.body.setup), stage)
+            status = -errno.EPIPE
+        else:
+            urb_log.warning("got bad %s stage response: %s", stage, LazyHex(resp))
+            status = -errno.EPROTO
+        return self.codec.build_ret_submit(urb, status=status, transfer_buffer=data)
+
+    def handle_bulk(self, urb):
+        urb_log.debug(
+            "bulk %s ep %d len %d",
+            "IN" if urb.direction == 1 else "OUT",
+            urb.ep,
+            urb.body.transfer_buffer_length,
+        )
+        info = self.ep_info.get(urb.ep | (Dir.IN if urb.direction == 1 else 0))
+        max_pkt_sz = info.max_packet_size if info is not None else 512
+        if self.bulk_window > 1:
+            if urb.direction == 1:
+                return (yield from self.handle_bulk_in_windowed(urb, max_pkt_sz))
+            return (yield from self.handle_bulk_out_windowed(urb, max_pkt_sz))
+        if urb.direction == 1:
+            return (yield from self.handle_bulk_in(urb, max_pkt_sz))
+        return (yield from self.handle_bulk_out(urb, max_pkt_sz))
+
+    def handle_bulk_out(self, urb, max_pkt_sz=512):
+        # stop-and-wait, one OUT transaction per round trip
+        ep = urb.ep
+        addr = urb.devid_devnum
+        out_token = out_token_packet(addr, ep)
+        ibuf = memoryview(urb.body.transfer_buffer)
+        dump = urb_log.isEnabledFor(DEBUG)
+        m = self.metrics
+        status = 0
+        off = 0
+        naks = 0
+        while off < len(ibuf) and not status:
+            if self._ping[ep]:
+                status = yield from self._ping_wait(addr, ep)
+                if status:
+                    break
+            buf = ibuf[off : off + max_pkt_sz]
+            if dump:
+                urb_log.debug("bulk OUT data: %s", LazyHex(buf))
+            if m is not None:
+                t = perf_counter_ns()
+            resp = yield from self._xact([out_token, data_packet(buf, odd=self._odds[ep])])
+            if m is not None:
+                m.bulk_out_packet.observe(perf_counter_ns() - t)
+            pid = resp[0] & 0xF
+            if pid in _OUT_ACCEPTED:
+                self._odds[ep] = not self._odds[ep]
+                off += len(buf)
+                naks = 0
+                if pid == PID.HND_NYET and self.retry.ping:
+                    self._ping[ep] = True
+            elif pid == PID.HND_NACK:
+                naks += 1
+                if self.retry.ping:
+                    self._ping[ep] = True
+                yield from self._backoff(naks)
+            else:
+                status = self._handshake_error(ep, "bulk OUT", resp)
+        urb_log.debug("bulk OUT ep %d: %d/%d bytes status %d", ep, off, len(ibuf), status)
+        return self.codec.build_ret_submit(urb, status=status, actual_length=0)
+
+    def handle_bulk_in(self, urb, max_pkt_sz=512):
+        # stop-and-wait, the ACK goes out once the data packet is in
+        ep = urb.ep
+        odd_idx = USB_MAX_ENDPOINTS // 2 + ep
+        in_token = in_token_packet(urb.devid_devnum, ep)
+        length = urb.body.transfer_buffer_length
+        dump = urb_log.isEnabledFor(DEBUG)
+        m = self.metrics
+        obuf = bytearray()
+        status = 0
+        while len(obuf) < length:
+            if m is not None:
+                t = perf_counter_ns()
+            resp = yield from self._xact_retry([in_token])
+            if m is not None:
+                m.bulk_in_packet.observe(perf_counter_ns() - t)
+            pid = resp[0] & 0xF
+            if pid not in _DATA_PIDS:
+                status = self._handshake_error(ep, "bulk IN", resp)
+                break
+            yield from self._send([ack_packet()])
+            if (pid == PID.DAT_DATA1) != self._odds[odd_idx]:
+                # retransmission of a packet we already have
+                continue
+            self._odds[odd_idx] = not self._odds[odd_idx]
+            buf = resp[1:-2]
+            if dump:
+                urb_log.debug("bulk IN data: %s", LazyHex(buf))
+            obuf += buf
+            if len(buf) < max_pkt_sz:
+                break
+        status = status or self._check_overflow(obuf, length)
+        urb_log.debug("bulk IN ep %d: %d/%d bytes status %d", ep, len(obuf), length, status)
+        return self.codec.build_ret_submit(urb, status=status, transfer_buffer=obuf)
+
+    @staticmethod
+    def _handshake_error(ep, kind, resp):
+        if resp[0] & 0xF == PID.HND_STALL:
+            urb_log.debug("%s ep %d STALLed", kind, ep)
+            return -errno.EPIPE
+        urb_log.warning("%s ep %d: unexpected response %s", kind, ep, LazyHex(resp))
+        return -errno.EPROTO
+
+    @staticmethod
+    def _check_overflow(obuf, length):
+        # the device sent more than the URB asked for
+        if len(obuf) > length:
+            del obuf[length:]
+            return -errno.EOVERFLOW
+        return 0
+
+    def handle_bulk_out_windowed(self, urb, max_pkt_sz=512):
+        # Up to _OUT_WINDOW OUT transactions per round trip. A device that NAKs a packet keeps
+        # its toggle, so it takes the packet after it for a retransmission, ACKs and drops it.
+        # With two in flight that is harmless, the URB resends from the NAKed packet. With
+        # three the device would take the third in the NAKed one's place. After a NAK the
+        # window restarts at 1 and grows back with every fully accepted round trip.
+        ep = urb.ep
+        addr = urb.devid_devnum
+        out_token = out_token_packet(addr, ep)
+        tbuf = memoryview(urb.body.transfer_buffer)
+        chunks = [tbuf[off : off + max_pkt_sz] for off in range(0, len(tbuf), max_pkt_sz)]
+        status = 0
+        max_window = min(self.bulk_window, _OUT_WINDOW)
+        window_sz = max_window
+        m = self.metrics
+        naks = 0
+        i = 0
+        while i < len(chunks):
+            if self._ping[ep]:
+                status = yield from self._ping_wait(addr, ep)
+                if status:
+                    break
+            window = chunks[i : i + window_sz]
+            start_odd = self._odds[ep]
+            obufs = []
+            for j, chunk in enumerate(window):
+                obufs.append(out_token)
+                obufs.append(data_packet(chunk, odd=start_odd ^ bool(j & 1)))
+            if m is not None:
+                t = perf_counter_ns()
+            resps = yield from self._xact_n(obufs, len(window))
+            if m is not None:
+                m.bulk_out_packet.observe((perf_counter_ns() - t) // len(window), len(window))
+            nacc = 0
+            while nacc < len(resps) and resps[nacc][0] & 0xF in _OUT_ACCEPTED:
+                nacc += 1
+            # a device only advances its toggle on ACK, so re-sync to the first unacked packet
+            self._odds[ep] = start_odd ^ bool(nacc & 1)
+            i += nacc
+            if nacc and resps[nacc - 1][0] & 0xF == PID.HND_NYET and self.retry.ping:
+                self._ping[ep] = True
+            if nacc == len(resps):
+                naks = 0
+                window_sz = min(max_window, window_sz * 2)
+                continue
+            # whatever the device said to packets after the first unaccepted one, they were
+            # dropped, only a STALL of them still counts
+            bad = [r for r in resps[nacc:] if r[0] & 0xF not in _OUT_RESENDABLE]
+            if resps[nacc][0] & 0xF != PID.HND_NACK or bad:
+                status = self._handshake_error(ep, "bulk OUT", bad[0] if bad else resps[nacc])
+                break
+            naks += 1
+            window_sz = 1
+            if self.retry.ping:
+                self._ping[ep] = True
+            yield from self._backoff(naks)
+        nsent = min(i * max_pkt_sz, len(tbuf))
+        urb_log.debug("bulk OUT ep %d: %d/%d bytes status %d", ep, nsent, len(tbuf), status)
+        return self.codec.build_ret_submit(urb, status=status, actual_length=0)
+
+    def handle_bulk_in_windowed(self, urb, max_pkt_sz=512):
+        # Up to bulk_window IN transactions per round trip, the window shrinking to a single
+        # polling token while the device NAKs and growing back as it has data again.
+        ep = urb.ep
+        odd_idx = USB_MAX_ENDPOINTS // 2 + ep
+        in_token = in_token_packet(urb.devid_devnum, ep)
+        ack = ack_packet()
+        length = urb.body.transfer_buffer_length
+        carry = self._in_carry[ep]
+        obuf = bytearray()
+        done = length <= 0
+        while carry and not done:
+            buf = carry.popleft()
+            obuf += buf
+            done = len(buf) < max_pkt_sz or len(obuf) >= length
+        status = 0
+        window_sz = self.bulk_window
+        m = self.metrics
+        naks = 0
+        while not done:
+            npkts = min(window_sz, -(-(length - len(obuf)) // max_pkt_sz))
+            if m is not None:
+                t = perf_counter_ns()
+            # the ACK is queued behind each token, a NAKing device ignores the stray handshake
+            resps = yield from self._xact_n([in_token, ack] * npkts, npkts)
+            if m is not None:
+                m.bulk_in_packet.observe((perf_counter_ns() - t) // npkts, npkts)
+            ndata = 0
+            for resp in resps:
+                pid = resp[0] & 0xF
+                if pid not in _DATA_PIDS:
+                    if pid != PID.HND_NACK and not status:
+                        status = self._handshake_error(ep, "bulk IN", resp)
+                        done = True
+                    continue
+                ndata += 1
+                if (pid == PID.DAT_DATA1) != self._odds[odd_idx]:
+                    # retransmission of a packet we already have
+                    continue
+                self._odds[odd_idx] = not self._odds[odd_idx]
+                buf = resp[1:-2]
+                if done:
+                    carry.append(buf)
+                    continue
+                obuf += buf
+                done = len(buf) < max_pkt_sz or len(obuf) >= length
+            if done:
+                break
+            if ndata == npkts:
+                naks = 0
+                window_sz = min(self.bulk_window, window_sz * 2)
+            elif not ndata:
+                naks += 1
+                window_sz = 1
+                yield from self._backoff(naks)
+        status = status or self._check_overflow(obuf, length)
+        urb_log.debug("bulk IN ep %d: %d/%d bytes status %d", ep, len(obuf), length, status)
+        return self.codec.build_ret_submit(urb, status=status, transfer_buffer=obuf)
+
+    @staticmethod
+    def _iso_in_packet(res, k, resps, obuf):
+        # fills in the descriptor at k from the packet's transactions, its data goes on obuf
+        length = res[k + ISO_LENGTH]
+        nbytes = 0
+        status = 0
+        for resp in resps:
+            pid = resp[0] & 0xF
+            if pid not in _ISO_IN_PIDS:
+                status = -errno.EPIPE if pid == PID.HND_STALL else -errno.EPROTO
+                break
+            data = memoryview(resp)[1:-2]
+            if nbytes + len(data) > length:
+                data = data[: length - nbytes]
+                status = -errno.EOVERFLOW
+            obuf += data
+            nbytes += len(data)
+            if status:
+                break
+        res[k + ISO_ACTUAL_LENGTH] = nbytes
+        res[k + ISO_STATUS] = status
+
+    def _iso_start(self, urb, idx) -> int:
+        # -> microframe the URB's first packet is due in. An ASAP URB follows the endpoint's
+        # previous one, or starts now once the stream has run dry. start_frame is an 11 bit
+        # frame number; one already gone by starts now too, a simulator can't keep real time
+        # so there is nothing to gain from failing its packets as missed.
+        now = self.microframe
+        if not urb.body.transfer_flags & URB_ISO_ASAP:
+            ahead = (urb.body.start_frame - (now >> 3)) & ((1 << 11) - 1)
+            if ahead < 1 << 10:
+                return max(now, ((now >> 3) + ahead) << 3)
+            urb_log.debug("iso ep %d start_frame %d has passed", urb.ep, urb.body.start_frame)
+        return max(now, self._next_poll[idx])
+
+    def handle_iso(self, urb):
+        # Packet i goes out in the i'th service interval from the start, as one to three
+        # transactions on a high-bandwidth endpoint. Whatever is due when the pipe gets its turn
+        # goes to the simulator in one round trip, so a simulator that lags real time gets
+        # batches instead of a round trip per packet. Isochronous transactions have no
+        # handshake and are never retried: a packet that fails gets a status in its descriptor
+        # and the URB still completes with status 0.
+        ep = urb.ep
+        is_in = urb.direction == 1
+        addr = urb.devid_devnum
+        info = self.ep_info.get(ep | (Dir.IN if is_in else 0))
+        max_pkt_sz = info.max_packet_size if info is not None else 1024
+        mult = info.mult if info is not None else 1
+        period = self._interval_uframes(urb, info)
+        idx = USB_MAX_ENDPOINTS // 2 + ep if is_in else ep
+        # the reply's descriptors, actual_length and status filled in as packets complete
+        res = array("i", urb.body.iso_packet_descriptor or ())
+        npackets = len(res) // ISO_FIELDS
+        start = self._iso_start(urb, idx)
+        # the next URB on this endpoint can start right after this one
+        self._next_poll[idx] = start + npackets * period
+        if is_in:
+            token = in_token_packet(addr, ep)
+            obuf = bytearray()
+            # a high-bandwidth IN packet's first PID says how many transactions follow, so
+            # those go one packet per round trip
+            batch = ISO_BATCH if mult == 1 else 1
+        else:
+            token = out_token_packet(addr, ep)
+            tbuf = memoryview(urb.body.transfer_buffer)
+            batch = ISO_BATCH
+        due = start
+        frame = -1
+        i = 0
+        while i < npackets:
+            now = self.microframe
+            if due > now:
+                yield WAIT, (due - now) / 8000
+                continue
+            n = min(npackets - i, batch, (now - due) // period + 1)
+            bufs = []
+            for j in range(i, i + n):
+                # the simulator gets an SOF as each packet's frame begins
+                pkt_frame = (due + (j - i) * period) >> 3 & ((1 << 11) - 1)
+                if pkt_frame != frame:
+                    frame = pkt_frame
+                    bufs.append(sof_packet(frame))
+                if is_in:
+                    bufs.append(token)
+                    continue
+                k = j * ISO_FIELDS
+                off = res[k + ISO_OFFSET]
+                length = res[k + ISO_LENGTH]
+                ntx = max(1, -(-length // max_pkt_sz))
+                if ntx > mult or off + length > len(tbuf):
+                    res[k + ISO_STATUS] = -errno.EMSGSIZE
+                    continue
+                pkt = tbuf[off : off + length]
+                for t, pid in enumerate(_ISO_OUT_PIDS[ntx]):
+                    bufs.append(token)
+                    bufs.append(data_pid_packet(pid, pkt[t * max_pkt_sz : (t + 1) * max_pkt_sz]))
+                res[k + ISO_ACTUAL_LENGTH] = length
+            if not is_in:
+                yield from self._send(bufs)
+                i += n
+                due += n * period
+                continue
+            resps = yield from self._xact_n(bufs, n)
+            if mult == 1:
+                for j in range(n):
+                    self._iso_in_packet(res, (i + j) * ISO_FIELDS, resps[j : j + 1], obuf)
+            else:
+                more = min(_ISO_IN_MORE.get(resps[0][0] & 0xF, 0), mult - 1)
+                if more:
+                    resps += yield from self._xact_n([token] * more, more)
+                self._iso_in_packet(res, i * ISO_FIELDS, resps, obuf)
+            i += n
+            due += n * period
+        error_count = sum(1 for k in range(ISO_STATUS, len(res), ISO_FIELDS) if res[k])
+        urb_log.debug(
+            "iso %s ep %d: %d packets from frame %d, %d errors",
+            "IN" if is_in else "OUT",
+            ep,
+            npackets,
+            start >> 3 & ((1 << 11) - 1),
+            error_count,
+        )
+        actual_length = len(obuf) if is_in else sum(res[ISO_ACTUAL_LENGTH::ISO_FIELDS])
+        return self.codec.build_ret_submit(
+            urb,
+            transfer_buffer=obuf if is_in else b"",
+            actual_length=actual_length,
+            error_count=error_count,
+            start_frame=start >> 3 & ((1 << 11) - 1),
+            iso_packet_descriptor=res,
+        )
+
+    def _interval_uframes(self, urb, info) -> int:
+        # The client's URB interval is in microframes at high speed and frames below it.
+        # bInterval is an exponent at high speed and for full-speed iso, a full- or low-speed
+        # interrupt endpoint's is a plain number of frames.
+        high = self.speed >= USB_SPEED_HIGH
+        if urb.body.interval > 0:
+            return urb.body.interval if high else urb.body.interval * 8
+        if info is not None and info.interval:
+            if high:
+                return 1 << (min(info.interval, 16) - 1)
+            if info.ep_type == EPType.ISO:
+                return 8 << (min(info.interval, 16) - 1)
+            return info.interval * 8
+        return 8
+
+    def _poll_wait(self, idx, period):
+        # holds the pipe until its next service interval comes round
+        while True:
+            now = self.microframe
+            due = self._next_poll[idx]
+            if now >= due:
+                break
+            yield WAIT, (due - now) / 8000
+        self._next_poll[idx] = now + period
+
+    def handle_interrupt(self, urb):
+        # One transaction per bInterval: a NAK means nothing to send or no room this interval,
+        # so the pipe sleeps until the next one instead of retrying, however long the device
+        # stays idle. It never times out.
+        ep = urb.ep
+        is_in = urb.direction == 1
+        info = self.ep_info.get(ep | (Dir.IN if is_in else 0))
+        max_pkt_sz = info.max_packet_size if info is not None else 64
+        period = self._interval_uframes(urb, info)
+        idx = USB_MAX_ENDPOINTS // 2 + ep if is_in else ep
+        status = 0
+        if is_in:
+            in_token = in_token_packet(urb.devid_devnum, ep)
+            length = urb.body.transfer_buffer_length
+            obuf = bytearray()
+            while len(obuf) < length:
+                yield from self._poll_wait(idx, period)
+                resp = yield from self._xact([in_token])
+                pid = resp[0] & 0xF
+                if pid == PID.HND_NACK:
+                    continue
+                if pid not in _DATA_PIDS:
+                    status = self._handshake_error(ep, "interrupt IN", resp)
+                    break
+                yield from self._send([ack_packet()])
+                if (pid == PID.DAT_DATA1) != self._odds[idx]:
+                    continue
+                self._odds[idx] = not self._odds[idx]
+                buf = resp[1:-2]
+                obuf += buf
+                if len(buf) < max_pkt_sz:
+                    break
+            status = status or self._check_overflow(obuf, length)
+            urb_log.debug("interrupt IN ep %d: %d/%d bytes", ep, len(obuf), length)
+            return self.codec.build_ret_submit(urb, status=status, transfer_buffer=obuf)
+        out_token = out_token_packet(urb.devid_devnum, ep)
+        tbuf = memoryview(urb.body.transfer_buffer)
+        off = 0
+        while off < len(tbuf):
+            yield from self._poll_wait(idx, period)
+            buf = tbuf[off : off + max_pkt_sz]
+            resp = yield from self._xact([out_token, data_packet(buf, odd=self._odds[idx])])
+            pid = resp[0] & 0xF
+            if pid in _OUT_ACCEPTED:
+                self._odds[idx] = not self._odds[idx]
+                off += len(buf)
+            elif pid != PID.HND_NACK:
+                status = self._handshake_error(ep, "interrupt OUT", resp)
+                break
+        urb_log.debug("interrupt OUT ep %d: %d/%d bytes", ep, off, len(tbuf))
+        return self.codec.build_ret_submit(urb, status=status, actual_length=0)
+
+    def transfer_type(self, urb) -> int:
+        # from the snooped endpoint descriptors; failing those, vhci only fills in the
+        # interval of periodic URBs
+        if urb.ep == 0:
+            return EPType.CONTROL
+        if urb.body.number_of_packets > 0:
+            return EPType.ISO
+        info = self.ep_info.get(urb.ep | (Dir.IN if urb.direction == 1 else 0))
+        if info is not None:
+            return info.ep_type
+        return EPType.INTERRUPT if urb.body.interval > 0 else EPType.BULK
+
+    def handle_transfer(self, urb):
+        ep_type = self.transfer_type(urb)
+        if ep_type == EPType.CONTROL:
+            if self.serve_descriptors and urb.body.setup[:2] == _GET_DEVICE_DESCRIPTOR:
+                data = self.descriptors.lookup(urb.body.setup)
+                if data is not None:
+                    urb_log.debug("GET_DESCRIPTOR %s from the cache", LazyHex(urb.body.setup))
+                    ret = self.codec.build_ret_submit(urb, transfer_buffer=data)
+                    if self.metrics is not None:
+                        self.metrics.descriptor_hits.value += 1
+                        self._count_urb(urb, "control", ret)
+                    return ret
+            kind, gen = "control", self.handle_control(urb)
+        elif ep_type == EPType.ISO:
+            kind, gen = "iso", self.handle_iso(urb)
+        elif ep_type == EPType.INTERRUPT:
+            kind, gen = "interrupt", self.handle_interrupt(urb)
+        else:
+            kind, gen = "bulk", self.handle_bulk(urb)
+        try:
+            ret = yield from gen
+        except NakTimeout as e:
+            urb_log.warning("URB seqnum %d timed out: %s", urb.seqnum, e)
+            ret = self.codec.build_ret_submit(urb, status=-errno.ETIMEDOUT)
+        if self.metrics is not None:
+            self._count_urb(urb, kind, ret)
+        return ret
+
+    @staticmethod
+    def _phase_done(hist, t):
+        now = perf_counter_ns()
+        hist.observe(now - t)
+        return now
+
+    def _count_urb(self, urb, kind, ret):
+        m = self.metrics
+        status, actual_length = _ret_status_len.unpack_from(ret)
+        m.urb_done(kind, urb.ep, urb.direction, status)
+        if urb.direction:
+            m.bytes_in.value += actual_length
+        else:
+            m.bytes_out.value += len(urb.body.transfer_buffer)
+
+    def transfer(self, urb):
+        yield from self._send([sof_packet(self.frame_num)])
+        return (yield from self.handle_transfer(urb))
+
+    def submit(self, urb):
+        yield from self._send([sof_packet(self.frame_num)])
+        if not self._setup_addr_done:
+            yield from self.setup_addr()
+        return (yield from self.handle_transfer(urb))
+
+    def _get_descriptor(self, wValue, wIndex, wLength):
+        # -> what a standard GET_DESCRIPTOR of our own returned, b"" if the device refused it
+        setup = struct.pack("<BBHHH", Dir.IN, Req.GET_DESCRIPTOR, wValue, wIndex, wLength)
+        urb = self.codec.parse_cmd(
+            build_cmd_submit(0, self.busnum, self.devnum, 1, 0, wLength, setup=setup)
+        )
+        body = self.codec.parse_ret((yield from self.handle_control(urb)), 1).body
+        return body.transfer_buffer if body.status == 0 else b""
+
+    def probe(self):
+        # Reads the device descriptor, every configuration and the manufacturer, product and
+        # serial number strings into the descriptor cache. For a bridge to run once, when the
+        # simulator connects and before any client is let at the device.
+        yield from self._send([sof_packet(self.frame_num)])
+        if not self._setup_addr_done:
+            yield from self.setup_addr()
+        # bMaxPacketSize0 is in the first 8 bytes, it says how long the data stage's packets are
+        yield from self._get_descriptor(DescType.DEVICE, 0, 8)
+        yield from self._get_descriptor(DescType.DEVICE, 0, DEVICE_DESCRIPTOR_SIZE)
+        dev = self.descriptors.device
+        if dev is None:
+            urb_log.warning("probe of %d-%d got no device descriptor", self.busnum, self.devnum)
+            return self.descriptors
+        for i in range(dev.bNumConfigurations):
+            hdr = yield from self._get_descriptor(DescType.CONFIGURATION | i, 0, 9)
+            if config_total_length(hdr) > len(hdr):
+                yield from self._get_descriptor(
+                    DescType.CONFIGURATION | i, 0, config_total_length(hdr)
+                )
+        yield from self._get_descriptor(DescType.STRING, 0, 0xFF)
+        langids = self.descriptors.langids
+        if langids:
+            for index in (dev.iManufacturer, dev.iProduct, dev.iSerialNumber):
+                if index:
+                    yield from self._get_descriptor(DescType.STRING | index, langids[0], 0xFF)
+        urb_log.info(
+            "probed %d-%d: %04x:%04x %r %r, %d descriptors",
+            self.busnum,
+            self.devnum,
+            dev.idVendor,
+            dev.idProduct,
+            self.descriptors.string(dev.iManufacturer),
+            self.descriptors.string(dev.iProduct),
+            len(self.descriptors),
+        )
+        return self.descriptors
+
+
+# _advance() result for a URB that yielded WAIT
+_PARKED = -1
+
+
+class _PendingURB:
+    __slots__ = ("urb", "gen", "resps", "started", "cancelled", "submitted", "not_before")
+
+    def __init__(self, urb, gen):
+        self.urb = urb
+        self.gen = gen
+        self.resps = None
+        self.started = False
+        self.cancelled = False
+        self.submitted = 0
+        # monotonic() time a backing off URB may run again, 0 when it is not
+        self.not_before = 0
+
+
+class URBScheduler:
+    # Keeps a FIFO of URBs per pipe and round-robins the pipe heads one transaction at a time,
+    # so a NAKing bulk IN cannot hold up control or other endpoints. RET_SUBMITs complete in
+    # whatever order the pipes finish. A pipe whose head URB is backing off is skipped until
+    # its time comes; when step() returns nothing for that reason, delay() says how long the
+    # driver can sleep.
+
+    def __init__(self, engine: URBEngine):
+        self.engine = engine
+        self._pipes = {}
+        self._ready = deque()
+        self._exclusive = None
+        self._waiting = None
+        self._by_seqnum = {}
+
+    @staticmethod
+    def pipe_key(urb):
+        # the control pipe is bidirectional, every other endpoint number has an IN and OUT pipe
+        if urb.ep == 0:
+            return urb.devid_devnum, 0, 0
+        return urb.devid_devnum, urb.ep, urb.direction
+
+    @property
+    def busy(self) -> bool:
+        return bool(self._ready) or self._exclusive is not None
+
+    def __len__(self):
+        return sum(map(len, self._pipes.values()))
+
+    def delay(self) -> float:
+        # -> seconds until step() has something to do, 0 if it has now
+        if self._exclusive is not None:
+            heads = [self._exclusive]
+        else:
+            heads = [self._pipes[key][0] for key in self._ready]
+        earliest = None
+        for head in heads:
+            if not head.not_before or head.cancelled:
+                return 0.0
+            if earliest is None or head.not_before < earliest:
+                earliest = head.not_before
+        if earliest is None:
+            return 0.0
+        return max(0.0, earliest - monotonic())
+
+    def submit(self, urb):
+        if not self.engine._setup_addr_done and self._exclusive is None:
+            self._exclusive = _PendingURB(None, self.engine.setup_addr())
+        key = self.pipe_key(urb)
+        pipe = self._pipes.get(key)
+        if pipe is None:
+            pipe = self._pipes[key] = deque()
+            self._ready.append(key)
+        pending = _PendingURB(urb, self.engine.transfer(urb))
+        if self.engine.metrics is not None:
+            pending.submitted = perf_counter_ns()
+        pipe.append(pending)
+        self._by_seqnum[urb.seqnum] = key, pending
+
+    def cancel(self, seqnum: int) -> bool:
+        # -> False if the URB already completed (or never existed), its RET_SUBMIT is never sent
+        # once this returns True
+        entry = self._by_seqnum.pop(seqnum, None)
+        if entry is None:
+            return False
+        key, pending = entry
+        if pending.started:
+            # mid-transfer, step() unwinds it at its next transaction boundary
+            pending.cancelled = True
+            return True
+        pipe = self._pipes[key]
+        pipe.remove(pending)
+        if not pipe:
+            del self._pipes[key]
+            self._ready.remove(key)
+        return True
+
+    def cancel_all(self):
+        for seqnum in list(self._by_seqnum):
+            self.cancel(seqnum)
+
+    def fail_all(self, status: int) -> list:
+        # -> a RET_SUBMIT with status for every URB that has not completed. For when the
+        # simulator has gone away, there is nothing left to unwind against.
+        done = [
+            self.engine.codec.build_ret_submit(pending.urb, status=status)
+            for _, pending in self._by_seqnum.values()
+        ]
+        for pipe in self._pipes.values():
+            for pending in pipe:
+                pending.gen.close()
+        if self._exclusive is not None:
+            self._exclusive.gen.close()
+        self._pipes.clear()
+        self._ready.clear()
+        self._by_seqnum.clear()
+        self._exclusive = None
+        self._waiting = None
+        return done
+
+    def responses(self, resps):
+        if self.engine.metrics is not None:
+            self.engine.metrics.responses(resps)
+        self._waiting.resps = resps
+        self._waiting = None
+
+    def _advance(self, pending, done):
+        # runs one URB up to its next simulator round trip, nresp is 0 once it has finished and
+        # _PARKED if it is backing off
+        if pending.cancelled:
+            return self._unwind(pending), 0
+        pending.started = True
+        bufs = []
+        try:
+            while True:
+                new_bufs, nresp = pending.gen.send(pending.resps)
+                if new_bufs is WAIT:
+                    pending.not_before = monotonic() + nresp
+                    pending.resps = []
+                    return bufs, _PARKED
+                bufs += new_bufs
+                if nresp:
+                    self._waiting = pending
+                    return bufs, nresp
+                pending.resps = []
+        except StopIteration as e:
+            if pending.urb is not None:
+                del self._by_seqnum[pending.urb.seqnum]
+                done.append(e.value)
+                if pending.submitted:
+                    self.engine.metrics.urb_latency.observe(perf_counter_ns() - pending.submitted)
+        except Exception:
+            if pending.urb is None:
+                # The device did not take its address, none of the URBs queued behind it can
+                # get through. Fail them and start over with the next one.
+                urb_log.warning("setting the device address failed", exc_info=True)
+                self.engine.reset_device()
+                done += self.fail_all(-errno.EPROTO)
+                return bufs, 0
+            urb_log.warning("URB seqnum %d failed", pending.urb.seqnum, exc_info=True)
+            del self._by_seqnum[pending.urb.seqnum]
+            done.append(self.engine.codec.build_ret_submit(pending.urb, status=-errno.EPROTO))
+        return bufs, 0
+
+    def _unwind(self, pending):
+        # Feed the cancelled handler the responses it is owed so handshakes and toggles stay in
+        # step with the device, then drop it before it issues another token.
+        bufs = []
+        try:
+            while True:
+                new_bufs, nresp = pending.gen.send(pending.resps)
+                if nresp:
+                    break
+                bufs += new_bufs
+                pending.resps = []
+        except StopIteration:
+            pass
+        except Exception:
+            urb_log.warning("cancelled URB seqnum %d failed", pending.urb.seqnum, exc_info=True)
+        pending.gen.close()
+        urb_log.debug("unlinked URB seqnum %d", pending.urb.seqnum)
+        return bufs
+
+    def step(self):
+        # -> (packets to send, responses needed, completed RET_SUBMITs)
+        assert self._waiting is None, "responses() not called for the previous step"
+        done = []
+        bufs = []
+        now = 0
+        if self._exclusive is not None:
+            pending = self._exclusive
+            if pending.not_before:
+                now = monotonic()
+                if pending.not_before > now:
+                    return bufs, 0, done
+                pending.not_before = 0
+            new_bufs, nresp = self._advance(pending, done)
+            bufs += new_bufs
+            if nresp:
+                return bufs, max(nresp, 0), done
+            self._exclusive = None
+        # pipes passed over because they are backing off, once every ready pipe has been the
+        # step is over
+        nparked = 0
+        while nparked < len(self._ready):
+            key = self._ready.popleft()
+            pipe = self._pipes[key]
+            pending = pipe[0]
+            if pending.not_before and not pending.cancelled:
+                now = now or monotonic()
+                if pending.not_before > now:
+                    self._ready.append(key)
+                    nparked += 1
+                    continue
+                pending.not_before = 0
+            new_bufs, nresp = self._advance(pending, done)
+            bufs += new_bufs
+            if nresp == _PARKED:
+                self._ready.append(key)
+                nparked += 1
+                continue
+            if nresp:
+                self._ready.append(key)
+                return bufs, nresp, done
+            pipe.popleft()
+            if pipe:
+                self._ready.append(key)
+            else:
+                del self._pipes[key]
+        return bufs, 0, done
+
+
+def run_urb(gen, write, read):
+    # blocking driver: write(list of packets), read() -> one simulator packet
+    resps = None
+    pending = []
+    try:
+        while True:
+            bufs, nresp = gen.send(resps)
+            if bufs is WAIT:
+                if pending:
+                    write(pending)
+                    pending = []
+                sleep(nresp)
+                resps = []
+                continue
+            pending += bufs
+            if nresp:
+                write(pending)
+                pending = []
+                resps = [read() for _ in range(nresp)]
+            else:
+                resps = []
+    except StopIteration as e:
+        return e.value
+    finally:
+        if pending:
+            write(pending)
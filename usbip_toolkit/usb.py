@@ -1,9 +1,14 @@
 from enum import IntEnum
+from functools import lru_cache
 
-from usbip_toolkit._tables import _crc16_table
+from usbip_toolkit.crc import crc16
 from usbip_toolkit.util import bit_reverse
 
 USB_MAX_ENDPOINTS = 32
+# Linux's enum usb_device_speed, what USB/IP replies carry
+USB_SPEED_LOW = 1
+USB_SPEED_FULL = 2
+USB_SPEED_HIGH = 3
 
 # fmt: off
 class PID(IntEnum):
@@ -69,6 +74,18 @@ class DescType(IntEnum):
     DEVICE_QUALIFIER = 0x0600
     OTHER_SPEED      = 0x0700
 
+
+class EPType(IntEnum):
+    CONTROL   = 0
+    ISO       = 1
+    BULK      = 2
+    INTERRUPT = 3
+
+
+class Feature(IntEnum):
+    ENDPOINT_HALT        = 0
+    DEVICE_REMOTE_WAKEUP = 1
+
 # fmt: on
 
 
@@ -91,15 +108,6 @@ def crc5(val, nbits):
     return crc
 
 
-def crc16(buf):
-    crc = 0xFFFF
-    for b in buf:
-        i = (crc ^ b) & 0xFF
-        crc = (crc >> 8) ^ _crc16_table[(crc ^ b) & 0xFF]
-    crc ^= 0xFFFF
-    return bytes([crc & 0xFF, crc >> 8])
-
-
 def pid_val(pid):
     assert 0 <= pid <= 0xF
     return ((pid ^ 0xF) << 4) | pid
@@ -117,6 +125,8 @@ def bmRequestType_byte(recip, ty, direction):
     return bytes([bmRequestType_val(direction, ty, recip)])
 
 
+# 4 token PIDs (OUT/IN/SETUP/PING) x 16 endpoints x 128 addresses
+@lru_cache(maxsize=4 * 16 * 128)
 def token_addr_packet(pid, addr, endp):
     assert 0 <= addr <= 0x7F
     assert 0 <= endp <= 0xF
@@ -135,8 +145,18 @@ def in_token_packet(addr, endp):
     return token_addr_packet(PID.TOK_IN, addr, endp)
 
 
+_sof_table = None
+
+
 def sof_packet(num):
+    global _sof_table
     assert 0 <= num < (1 << 11)
+    if _sof_table is None:
+        _sof_table = [_sof_packet(n) for n in range(1 << 11)]
+    return _sof_table[num]
+
+
+def _sof_packet(num):
     mid_byte = num & 0xFF
     val4crc = bit_reverse(num, 11)
     crc_val = crc5(val4crc, 11)
@@ -153,6 +173,11 @@ def data_packet(buf, odd=False):
     return pb + buf + crc16(buf)
 
 
+def data_pid_packet(pid, buf):
+    # any data PID, DATA2 and MDATA are for high-bandwidth isochronous transactions
+    return pid_byte(pid) + buf + crc16(buf)
+
+
 def ack_packet():
     return pid_byte(PID.HND_ACK)
 
@@ -178,3 +203,55 @@ def setup_data_packet(recip, direction, req, val, idx, sz, ty=Type.STANDARD):
         + sz.to_bytes(2, "little")
     )
     return data_packet(buf, odd=False)
+
+
+class EndpointInfo:
+    __slots__ = ("addr", "ep_type", "max_packet_size", "interval", "mult")
+
+    def __init__(self, addr: int, ep_type: int, max_packet_size: int, interval: int, mult: int = 1):
+        self.addr = addr
+        self.ep_type = ep_type
+        self.max_packet_size = max_packet_size
+        self.interval = interval
+        # transactions per microframe, up to 3 for a high-bandwidth periodic endpoint
+        self.mult = mult
+
+    def __repr__(self):
+        mult = f", mult={self.mult}" if self.mult > 1 else ""
+        return (
+            f"EndpointInfo(0x{self.addr:02x}, {EPType(self.ep_type).name}, "
+            f"{self.max_packet_size}, {self.interval}{mult})"
+        )
+
+
+def config_total_length(buf) -> int:
+    # wTotalLength of a configuration descriptor, 0 if buf is too short to say
+    return int.from_bytes(buf[2:4], "little") if len(buf) >= 4 else 0
+
+
+def parse_config_endpoints(buf) -> dict:
+    # configuration descriptor -> {(bInterfaceNumber, bAlternateSetting): [EndpointInfo]}
+    res = {}
+    alt = None
+    off = 0
+    while off + 2 <= len(buf):
+        blen = buf[off]
+        if blen < 2 or off + blen > len(buf):
+            break
+        dtype = buf[off + 1]
+        if dtype == DescType.INTERFACE >> 8 and blen >= 4:
+            alt = res.setdefault((buf[off + 2], buf[off + 3]), [])
+        elif dtype == DescType.ENDPOINT >> 8 and blen >= 7 and alt is not None:
+            wMaxPacketSize = int.from_bytes(buf[off + 4 : off + 6], "little")
+            # bits 11-12 are the extra transactions per microframe of a high-bandwidth endpoint
+            alt.append(
+                EndpointInfo(
+                    buf[off + 2],
+                    buf[off + 3] & 3,
+                    wMaxPacketSize & 0x7FF,
+                    buf[off + 6],
+                    min((wMaxPacketSize >> 11 & 3) + 1, 3),
+                )
+            )
+        off += blen
+    return res
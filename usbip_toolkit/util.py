@@ -1,8 +1,20 @@
+import os
 import socket
 from re import S
 
+from usbip_toolkit._tables import _bitrev_table
+
 
 def bit_reverse(val, nbits):
+    if nbits <= 8:
+        return _bitrev_table[val & 0xFF] >> (8 - nbits)
+    if nbits <= 16:
+        rval = (_bitrev_table[val & 0xFF] << 8) | _bitrev_table[(val >> 8) & 0xFF]
+        return rval >> (16 - nbits)
+    return bit_reverse_slow(val, nbits)
+
+
+def bit_reverse_slow(val, nbits):
     rval = 0
     for i in range(nbits):
         bit_shift = nbits - i - 1
@@ -12,9 +24,75 @@ def bit_reverse(val, nbits):
     return rval
 
 
-def get_tcp_server_socket(port: int, hostname: str = "localhost") -> socket.socket:
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+def recv_exact_into(sock: socket.socket, buf: memoryview) -> bool:
+    while buf:
+        nread = sock.recv_into(buf)
+        if not nread:
+            return False
+        buf = buf[nread:]
+    return True
+
+
+def recv_exact(sock: socket.socket, nbytes: int):
+    buf = bytearray(nbytes)
+    if not recv_exact_into(sock, memoryview(buf)):
+        return None
+    return buf
+
+
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+def sendmsg_all(sock: socket.socket, bufs: list):
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(bufs))
+        return
+    i = 0
+    nbufs = len(bufs)
+    while i < nbufs:
+        sent = sock.sendmsg(bufs[i : i + IOV_MAX])
+        # drop fully sent buffers and trim a partially sent one
+        while i < nbufs and sent >= len(bufs[i]):
+            sent -= len(bufs[i])
+            i += 1
+        if sent:
+            bufs[i] = memoryview(bufs[i])[sent:]
+
+
+def tune_socket(sock, nodelay: bool = None, sndbuf: int = 0, rcvbuf: int = 0):
+    # nodelay None leaves Nagle alone (it must for unix sockets), buffer sizes of 0 the kernel's
+    if nodelay is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(nodelay))
+    if sndbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+    if rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+
+
+def get_tcp_server_socket(
+    port: int,
+    hostname: str = "localhost",
+    nodelay: bool = True,
+    sndbuf: int = 0,
+    rcvbuf: int = 0,
+) -> socket.socket:
+    # bound to hostname's first IPv4 address, "" for every interface. Only an IPv6 literal
+    # binds IPv6: where /etc/hosts also maps localhost to ::1 that usually comes first, and an
+    # IPv6-only listener refuses everything connecting to 127.0.0.1. The socket is made with
+    # IPPROTO_TCP rather than 0: asyncio only turns Nagle off on its transports for sockets
+    # that say they are TCP. Buffer sizes are set before listen() so the window scale offered
+    # to clients matches them; accepted sockets inherit them, TCP_NODELAY only on some platforms.
+    family = socket.AF_INET6 if hostname and ":" in hostname else socket.AF_INET
+    family, type_, proto, _, addr = socket.getaddrinfo(
+        hostname or None, port, family, socket.SOCK_STREAM, flags=socket.AI_PASSIVE
+    )[0]
+    s = socket.socket(family, type_, proto or socket.IPPROTO_TCP)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-    s.bind(("localhost", port))
+    if hasattr(socket, "SO_REUSEPORT"):
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    tune_socket(s, nodelay, sndbuf, rcvbuf)
+    s.bind(addr)
     return s